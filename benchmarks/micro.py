@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# Microbenchmarks for the in-process parts of whodunit.
+#
+# Usage (from the top of the source tree):
+#    python -m benchmarks.micro [--repeat N] [--update-baseline]
+#                               [--record-fixtures]
+#
+# The parsing, sorting, and coverage scanning functions are timed on
+# recorded 'git blame --line-porcelain' output and coverage HTML reports, at
+# several sizes (see fixtures/). Times are divided by the time of a fixed
+# calibration workload, so that they can be compared between machines, and
+# the peak memory allocated is measured with tracemalloc.
+#
+# Results are compared against baseline.json, and any benchmark that is
+# slower, or uses more memory, than the baseline allows for (by the
+# tolerance) is reported. The test suite does the same check (see
+# tests/test_performance.py). Use --update-baseline, after an intended
+# change in performance, and --record-fixtures to rebuild the fixtures.
+
+from __future__ import print_function
+
+import argparse
+import gc
+import gzip
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import whodunit
+
+from benchmarks import synthetic
+
+
+AREA = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(AREA, 'fixtures')
+BASELINE = os.path.join(AREA, 'baseline.json')
+
+# Name and number of lines in the blamed file, for each fixture size
+SCALES = [('small', 200), ('medium', 2000), ('large', 10000)]
+
+# Allowed growth over the baseline, before reporting a regression
+TIME_TOLERANCE = 1.5
+MEMORY_TOLERANCE = 1.25
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def fixture_path(kind, scale):
+    extension = 'txt' if kind == 'porcelain' else 'html'
+    return os.path.join(FIXTURES, '%s_%s.%s.gz' % (kind, scale, extension))
+
+
+fixtures = {}
+
+
+def read_fixture(kind, scale):
+    if (kind, scale) not in fixtures:
+        with gzip.open(fixture_path(kind, scale), 'rb') as fixture:
+            fixtures[kind, scale] = fixture.read().decode('utf-8')
+    return fixtures[kind, scale]
+
+
+def record_fixtures():
+    """Record blame output and coverage reports, for each size of file."""
+    if not os.path.isdir(FIXTURES):
+        os.mkdir(FIXTURES)
+    for scale, lines in SCALES:
+        commits = min(300, max(20, lines // 20))
+        shape = argparse.Namespace(files=1, lines=lines, commits=commits,
+                                   authors=25, depth=commits)
+        area = tempfile.mkdtemp(prefix='whodunit-fixture-')
+        try:
+            synthetic.make_repository(area, shape)
+            name = synthetic.file_names(1)[0]
+            porcelain = subprocess.check_output(
+                ['git', 'blame', '--line-porcelain', '--root', name],
+                cwd=area)
+        finally:
+            shutil.rmtree(area)
+        report = synthetic.coverage_report(name, lines, 0.2,
+                                           random.Random(0))
+        for kind, data in (('porcelain', porcelain),
+                           ('coverage', report.encode('utf-8'))):
+            with gzip.open(fixture_path(kind, scale), 'wb') as fixture:
+                fixture.write(data)
+    fixtures.clear()
+
+
+def parsed(owner_class, porcelain):
+    owners = owner_class('.')
+    owners.parse_info_records(porcelain)
+    return owners
+
+
+def coverage_sort(owners):
+    """Sort consumes the commits, so each run sorts a new list of them."""
+    owners.commits = list(owners.parsed_commits)
+    return owners.sort()
+
+
+def coverage_owners(porcelain):
+    owners = parsed(whodunit.CoverageOwners, porcelain)
+    owners.parsed_commits = owners.commits
+    return owners
+
+
+def missing_lines(html):
+    lines = []
+    for line in html:
+        m = whodunit.source_re.match(line)
+        if m:
+            lines.append(int(m.group(1)))
+    return lines
+
+
+def benchmarks():
+    """Provides (name, setup, run) for each microbenchmark.
+
+    The setup is not timed, and provides the argument for run, which may
+    be called many times with it.
+    """
+    for scale, lines in SCALES:
+        porcelain = read_fixture('porcelain', scale)
+        html = read_fixture('coverage', scale).splitlines()
+        yield ('parse_info_records/' + scale,
+               lambda porcelain=porcelain: porcelain,
+               lambda porcelain: whodunit.Owners('.').parse_info_records(
+                   porcelain))
+        yield ('parse_info_records_unique/' + scale,
+               lambda porcelain=porcelain: porcelain,
+               lambda porcelain: whodunit.CoverageOwners(
+                   '.').parse_info_records(porcelain))
+        yield ('SizeOwners.sort/' + scale,
+               lambda porcelain=porcelain: parsed(whodunit.SizeOwners,
+                                                  porcelain),
+               lambda owners: owners.sort())
+        yield ('SizeOwners.merge_user_commits/' + scale,
+               lambda porcelain=porcelain: parsed(whodunit.Owners,
+                                                  porcelain).commits,
+               whodunit.SizeOwners.merge_user_commits)
+        yield ('DateOwners.sort/' + scale,
+               lambda porcelain=porcelain: parsed(whodunit.DateOwners,
+                                                  porcelain),
+               lambda owners: owners.sort())
+        yield ('CoverageOwners.sort/' + scale,
+               lambda porcelain=porcelain: coverage_owners(porcelain),
+               coverage_sort)
+        yield ('CoverageOwners.make_ranges/' + scale,
+               lambda html=html: missing_lines(html),
+               lambda lines: whodunit.CoverageOwners.make_ranges(list(lines)))
+        yield ('CoverageOwners.determine_coverage/' + scale,
+               lambda html=html: html,
+               whodunit.CoverageOwners.determine_coverage)
+
+
+def calibration_work(_=None):
+    """A fixed amount of pure Python work, used to normalize timings."""
+    table = {}
+    for i in range(50000):
+        table[i % 1000] = table.get(i % 1000, 0) + i
+    return sorted(str(v) for v in table.values())
+
+
+def batch_size(run, argument, min_batch):
+    """Number of calls needed for a batch to take at least min_batch."""
+    number = 1
+    while True:
+        start = timer()
+        for _ in range(number):
+            run(argument)
+        elapsed = timer() - start
+        if elapsed >= min_batch:
+            return number
+        number *= 10 if elapsed < min_batch / 10 else 2
+
+
+def relative_time(run, argument, repeat, min_batch=0.1):
+    """Time for one call, relative to the time of the calibration work.
+
+    Batches of calls (sized like timeit does) alternate with batches of the
+    calibration work, and the median of the ratios is used, so that the
+    result is not thrown off by the machine being busy for a while. Garbage
+    collection is turned off, while timing.
+    """
+    def batch(run, argument, number):
+        start = timer()
+        for _ in range(number):
+            run(argument)
+        return (timer() - start) / number
+
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        number = batch_size(run, argument, min_batch)
+        calibration_number = batch_size(calibration_work, None, min_batch)
+        ratios = sorted(batch(run, argument, number) /
+                        batch(calibration_work, None, calibration_number)
+                        for _ in range(repeat))
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return ratios[len(ratios) // 2]
+
+
+def peak_memory(run, argument):
+    tracemalloc.start()
+    run(argument)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def run_benchmarks(repeat=5, names=None, min_batch=0.1):
+    """Provides {name: {'time': relative time, 'memory': peak bytes}}."""
+    results = {}
+    for name, setup, run in benchmarks():
+        if names and name not in names:
+            continue
+        argument = setup()
+        results[name] = {'time': relative_time(run, argument, repeat,
+                                               min_batch),
+                         'memory': peak_memory(run, argument)}
+    return results
+
+
+def python_version():
+    return '%d.%d' % sys.version_info[:2]
+
+
+def load_baseline():
+    """Provides the Python version used for the baseline, and the results.
+
+    Relative times vary between versions of Python, so a baseline is only
+    meaningful for the version it was recorded with.
+    """
+    with open(BASELINE) as baseline:
+        data = json.load(baseline)
+    return data['python'], data['results']
+
+
+def save_baseline(results):
+    with open(BASELINE, 'w') as baseline:
+        json.dump({'python': python_version(), 'results': results},
+                  baseline, indent=2, sort_keys=True)
+        baseline.write('\n')
+
+
+def compare(results, baseline, time_tolerance=TIME_TOLERANCE,
+            memory_tolerance=MEMORY_TOLERANCE):
+    """Provides a description of each benchmark exceeding the baseline."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        result, expected = results[name], baseline[name]
+        if result['time'] > expected['time'] * time_tolerance:
+            regressions.append("%s: time is %.2fx the baseline" % (
+                name, result['time'] / expected['time']))
+        if result['memory'] > expected['memory'] * memory_tolerance:
+            regressions.append("%s: memory is %.2fx the baseline" % (
+                name, float(result['memory']) / expected['memory']))
+    return regressions
+
+
+def show(results, baseline):
+    print("%-45s %10s %8s %12s %8s" % ('benchmark', 'time', 'vs base',
+                                       'memory', 'vs base'))
+    for name in sorted(results):
+        result = results[name]
+        expected = baseline.get(name, result)
+        print("%-45s %10.4f %7.2fx %12d %7.2fx" % (
+            name, result['time'], result['time'] / expected['time'],
+            result['memory'],
+            float(result['memory']) / max(expected['memory'], 1)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run whodunit microbenchmarks against the baseline.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Times to run each benchmark. Default=5.')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Save the results as the new baseline.')
+    parser.add_argument('--record-fixtures', action='store_true',
+                        help='Rebuild the fixtures, before running.')
+    args = parser.parse_args(argv)
+    if args.record_fixtures:
+        record_fixtures()
+    results = run_benchmarks(args.repeat)
+    if args.update_baseline:
+        save_baseline(results)
+        return
+    version, baseline = load_baseline()
+    if version != python_version():
+        print("Baseline was recorded with Python %s, so times may not be "
+              "comparable" % version)
+    show(results, baseline)
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print("REGRESSION:", regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# End-to-end benchmarks for whodunit, on generated git repositories.
+#
+# Usage (from the top of the source tree):
+#    python -m benchmarks.synthetic [--files N] [--lines N] [--commits N]
+#                                   [--authors N] [--depth N] [--missing F]
+#                                   [--modes MODE ...] [--repeat N]
+#                                   [--whodunit-args ARGS] [--keep DIR]
+#                                   [--json FILE]
+#
+# A repository is built with 'git fast-import', having the requested number
+# of files (spread over directories), lines per file, commits, and authors.
+# Each file is modified by --depth commits, so that blame has history to
+# walk. A 'cover' directory is also created with coverage.py style HTML
+# reports, having about --missing fraction of the lines without coverage.
+#
+# Each mode (date, size, history, cover) is run, like the whodunit command,
+# in a fresh Python process, and the files per second, peak RSS of whodunit,
+# and number of git processes started are reported. Git processes started by
+# -p worker processes are counted where workers are forked (the default on
+# Linux); where they are spawned, only those of the main process are.
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+FILES_PER_DIR = 20
+BASE_TIME = 1262304000  # 2010-01-01
+COMMIT_INTERVAL = 3600 * 7
+
+
+def file_names(num_files):
+    return ['pkg%d/mod%d.py' % (i // FILES_PER_DIR, i)
+            for i in range(num_files)]
+
+
+def revise(lines, rng, commit, fraction=0.2):
+    """Rewrite a random run of lines, as if the commit had changed them."""
+    count = max(1, int(len(lines) * fraction))
+    start = rng.randrange(0, max(1, len(lines) - count + 1))
+    for i in range(start, min(start + count, len(lines))):
+        lines[i] = "value_%d = %d  # changed in commit %d\n" % (i, commit,
+                                                               commit)
+
+
+def fast_import_stream(shape, rng):
+    """Generator for the 'git fast-import' commands to build the history.
+
+    The first commit adds all the files, and the remaining commits each
+    modify a share of the files, so that every file gets about 'depth'
+    commits.
+    """
+    names = file_names(shape.files)
+    contents = dict((name, ["value_%d = 0\n" % i for i in range(shape.lines)])
+                    for name in names)
+    touches = max(1, shape.files * (shape.depth - 1) //
+                  max(1, shape.commits - 1))
+    for commit in range(shape.commits):
+        if commit == 0:
+            changed = names
+        else:
+            changed = rng.sample(names, min(touches, len(names)))
+            for name in changed:
+                revise(contents[name], rng, commit)
+        author = rng.randrange(shape.authors)
+        when = BASE_TIME + commit * COMMIT_INTERVAL
+        ident = "Author %d <author%d@example.com> %d +0000" % (author, author,
+                                                              when)
+        message = "Commit %d\n" % commit
+        yield "commit refs/heads/master\n"
+        yield "author %s\ncommitter %s\n" % (ident, ident)
+        yield "data %d\n%s" % (len(message), message)
+        for name in changed:
+            data = ''.join(contents[name])
+            yield "M 100644 inline %s\ndata %d\n%s\n" % (name, len(data), data)
+
+
+def make_repository(path, shape, seed=0):
+    """Build a git repository of the given shape, and check it out."""
+    rng = random.Random(seed)
+    subprocess.check_call(['git', 'init', '-q', path])
+    p = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path,
+                         stdin=subprocess.PIPE)
+    for chunk in fast_import_stream(shape, rng):
+        p.stdin.write(chunk.encode('utf-8'))
+    p.stdin.close()
+    if p.wait():
+        raise RuntimeError("Unable to build repository with git fast-import")
+    subprocess.check_call(['git', 'checkout', '-q', '-f', 'master'], cwd=path)
+
+
+def coverage_report(name, num_lines, missing, rng):
+    """Coverage.py style HTML report, with some runs of missed lines."""
+    missed = set()
+    while len(missed) < int(num_lines * missing):
+        start = rng.randrange(1, num_lines + 1)
+        missed.update(range(start, min(start + rng.randrange(1, 6),
+                                       num_lines + 1)))
+    percent = 100 - (100 * len(missed) // num_lines)
+    html = ['<html>\n<head>\n',
+            '    <title>Coverage for %s: %d%%</title>\n' % (name, percent),
+            '</head>\n<body>\n<table>\n<tr>\n    <td class="linenos">\n']
+    for line in range(1, num_lines + 1):
+        state = 'stm mis' if line in missed else 'stm run hide_run'
+        html.append('<p id="n%d" class="%s"><a href="#n%d">%d</a></p>\n' %
+                    (line, state, line, line))
+    html.append('            </td>\n            <td class="text">\n')
+    html.append('</td>\n</tr>\n</table>\n</body>\n</html>\n')
+    return ''.join(html)
+
+
+def make_coverage_reports(path, shape, seed=0):
+    rng = random.Random(seed)
+    cover_dir = os.path.join(path, 'cover')
+    os.mkdir(cover_dir)
+    with open(os.path.join(cover_dir, 'index.html'), 'w') as index:
+        index.write('<html></html>\n')
+    for name in file_names(shape.files):
+        report = coverage_report(name, shape.lines, shape.missing, rng)
+        html_name = name.replace('/', '_').replace('.', '_') + '.html'
+        with open(os.path.join(cover_dir, html_name), 'w') as html:
+            html.write(report)
+
+
+def measure(argv):
+    """Run whodunit in this process, and print the cost of the run as JSON.
+
+    Used in a child process, so that the peak memory is for this run only.
+    """
+    import whodunit
+
+    # Shared with the -p worker processes, which are forked from this one
+    # and so inherit the counting Popen as well.
+    processes = multiprocessing.Value('l', 0)
+    popen = subprocess.Popen
+
+    class CountingPopen(popen):
+        def __init__(self, *args, **kwargs):
+            with processes.get_lock():
+                processes.value += 1
+            popen.__init__(self, *args, **kwargs)
+    subprocess.Popen = CountingPopen
+
+    files = [0]
+    add = whodunit.Report.add
+
+    def counting_add(report, result):
+        files[0] += 1
+        add(report, result)
+    whodunit.Report.add = counting_add
+
+    stdout = sys.stdout
+    start = time.time()
+    with open(os.devnull, 'w') as sys.stdout:
+        whodunit.main(argv)
+    elapsed = time.time() - start
+    sys.stdout = stdout
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    kb = 1 if sys.platform != 'darwin' else 1024  # Units of ru_maxrss
+    print(json.dumps({'files': files[0],
+                      'seconds': elapsed,
+                      'peak_rss_kb': own.ru_maxrss // kb,
+                      'git_processes': processes.value}))
+
+
+def run_case(repo, mode, whodunit_args):
+    source_tree = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [source_tree] + [p for p in [env.get('PYTHONPATH')] if p])
+    command = [sys.executable, '-m', 'benchmarks.synthetic', 'measure',
+               '--', '-s', mode] + whodunit_args + [repo]
+    out = subprocess.check_output(command, env=env, cwd=source_tree)
+    result = json.loads(out.decode('utf-8').splitlines()[-1])
+    result['mode'] = mode
+    result['files_per_second'] = result['files'] / max(result['seconds'],
+                                                       1e-9)
+    return result
+
+
+def show(results):
+    print("%-6s %7s %9s %9s %9s %6s" % (
+        'mode', 'files', 'seconds', 'files/s', 'RSS(MB)', 'git'))
+    for r in results:
+        print("%-6s %7d %9.2f %9.1f %9.1f %6d" % (
+            r['mode'], r['files'], r['seconds'], r['files_per_second'],
+            r['peak_rss_kb'] / 1024.0, r['git_processes']))
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark whodunit on a generated git repository.')
+    parser.add_argument('--files', type=int, default=200,
+                        help='Number of files. Default=200.')
+    parser.add_argument('--lines', type=int, default=200,
+                        help='Lines per file. Default=200.')
+    parser.add_argument('--commits', type=int, default=100,
+                        help='Number of commits. Default=100.')
+    parser.add_argument('--authors', type=int, default=10,
+                        help='Number of authors. Default=10.')
+    parser.add_argument('--depth', type=int, default=10,
+                        help='Number of commits touching each file. '
+                        'Default=10.')
+    parser.add_argument('--missing', type=float, default=0.2,
+                        help='Fraction of lines without coverage. '
+                        'Default=0.2.')
+    parser.add_argument('--modes', nargs='+',
+                        default=['date', 'size', 'history', 'cover'],
+                        choices=['date', 'size', 'history', 'cover'],
+                        help='Modes to run. Default is all.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Times to run each mode. Default=1.')
+    parser.add_argument('--whodunit-args', default='',
+                        help="Extra arguments for whodunit (e.g. '-j 4').")
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the repository contents.')
+    parser.add_argument('--keep', metavar='DIR',
+                        help='Build the repository in DIR, and keep it.')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also save the results in JSON to FILE.')
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['measure']:
+        argv = argv[1:]
+        if argv[:1] == ['--']:
+            argv = argv[1:]
+        return measure(argv)
+    args = setup_parser().parse_args(argv)
+    args.commits = max(1, args.commits)
+    args.depth = max(1, min(args.depth, args.commits))
+    area = args.keep or tempfile.mkdtemp(prefix='whodunit-bench-')
+    try:
+        start = time.time()
+        make_repository(area, args, args.seed)
+        make_coverage_reports(area, args, args.seed)
+        print("Built repository with %d files, %d lines each, %d commits, "
+              "in %.1fs" % (args.files, args.lines, args.commits,
+                            time.time() - start))
+        results = []
+        for mode in args.modes:
+            for _ in range(args.repeat):
+                results.append(run_case(area, mode,
+                                        shlex.split(args.whodunit_args)))
+        show(results)
+        if args.json:
+            with open(args.json, 'w') as json_file:
+                json.dump(results, json_file, indent=2)
+    finally:
+        if not args.keep:
+            shutil.rmtree(area)
+
+
+if __name__ == '__main__':
+    main()
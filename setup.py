@@ -46,7 +46,9 @@ setup(
     url="https://github.com/pmichali/whodunit",
     license="Apache Software License",
     platforms='any',
+    python_requires='>=3.8',
     tests_require=['pytest', 'mock'],
+    extras_require={'coverage': ['coverage'], 'numpy': ['numpy']},
     cmdclass={'tests': PyTest},
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -55,10 +57,11 @@ setup(
         'License :: OSI Approved :: Apache Software License',
         'Natural Language :: English',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],)
@@ -0,0 +1,66 @@
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+
+import pytest
+
+from benchmarks import synthetic
+import whodunit
+
+
+@pytest.fixture()
+def shape():
+    return argparse.Namespace(files=25, lines=30, commits=8, authors=3,
+                              depth=3, missing=0.2)
+
+
+@pytest.fixture()
+def repo_area(request):
+    area = tempfile.mkdtemp()
+
+    def teardown():
+        shutil.rmtree(area)
+    request.addfinalizer(teardown)
+    return area
+
+
+def test_synthetic_repository(repo_area, shape, capsys):
+    synthetic.make_repository(repo_area, shape)
+    commits = subprocess.check_output(['git', 'rev-list', '--count', 'HEAD'],
+                                      cwd=repo_area)
+    assert int(commits) == shape.commits
+    files = subprocess.check_output(['git', 'ls-files'],
+                                    cwd=repo_area).decode().split()
+    assert sorted(files) == sorted(synthetic.file_names(shape.files))
+    assert os.path.isdir(os.path.join(repo_area, 'pkg1'))
+
+    whodunit.main(['-s', 'size', repo_area])
+    out, err = capsys.readouterr()
+    assert out.count('mod') == shape.files
+    assert 'All authors: Author' in out
+
+
+def test_synthetic_coverage_reports(repo_area, shape):
+    report = synthetic.coverage_report('pkg0/mod0.py', 100, 0.2,
+                                       random.Random(0))
+    name, ranges = whodunit.CoverageOwners.determine_coverage(
+        report.splitlines())
+    assert name == 'pkg0/mod0.py'
+    assert sum(last - first + 1 for first, last in ranges) >= 20
+
+    synthetic.make_repository(repo_area, shape)
+    synthetic.make_coverage_reports(repo_area, shape)
+    owners = whodunit.CoverageOwners(repo_area)
+    modules = list(owners.collect_modules())
+    assert len(modules) == shape.files
+
+
+def test_measure_keeps_later_separators(monkeypatch):
+    calls = []
+    monkeypatch.setattr(synthetic, 'measure', calls.append)
+    synthetic.main(['measure', '--', '-s', 'size', '--', 'repo'])
+    synthetic.main(['measure', '-s', 'size', 'repo'])
+    assert calls == [['-s', 'size', '--', 'repo'], ['-s', 'size', 'repo']]
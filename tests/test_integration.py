@@ -0,0 +1,498 @@
+import argparse
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+from benchmarks import synthetic
+import whodunit
+
+
+@pytest.fixture()
+def shape():
+    return argparse.Namespace(files=25, lines=30, commits=8, authors=3,
+                              depth=3, missing=0.2)
+
+
+@pytest.fixture()
+def area(request):
+    area = tempfile.mkdtemp()
+
+    def teardown():
+        shutil.rmtree(area)
+    request.addfinalizer(teardown)
+    return area
+
+
+@pytest.fixture()
+def repository(area, shape):
+    """A synthetic repository, with the shape given."""
+    synthetic.make_repository(area, shape)
+    return area
+
+
+def test_progress_is_on_stderr(repository, shape, capsys):
+    whodunit.main(['--progress', '-j', '2', repository])
+    out, err = capsys.readouterr()
+    assert '%d/%d files (100%%)' % (shape.files, shape.files) in err
+    assert 'files (' not in out
+    assert 'All authors: Author' in out
+
+
+def test_prepare_commit_graph(repository, shape, capsys):
+    state = whodunit.commit_graph_state(repository)
+    assert whodunit.commit_graph_problems(state) == ['no commit-graph']
+    with pytest.raises(SystemExit) as excinfo:
+        whodunit.main(['prepare', '--check', repository])
+    assert excinfo.value.code == 1
+
+    stats_file = os.path.join(repository, 'stats.json')
+    whodunit.main(['--stats', stats_file, repository])
+    out, err = capsys.readouterr()
+    assert "warning: no commit-graph" in err
+    with open(stats_file) as stats:
+        gauges = json.load(stats)['gauges']
+    assert gauges['commit_graph_prepared'] == 0
+    assert gauges['estimated_blame_savings_seconds'] >= 0
+
+    whodunit.main(['prepare', repository])
+    state = whodunit.commit_graph_state(repository)
+    assert state.commits == shape.commits
+    assert state.changed_paths and state.covers_head
+    whodunit.main(['prepare', '--check', os.path.join(repository, 'pkg0')])
+    out, err = capsys.readouterr()
+    assert out.endswith("Commit-graph is up to date, with %d commits and "
+                        "changed paths\n" % shape.commits)
+
+    subprocess.check_call(['git', '-c', 'user.name=A', '-c',
+                           'user.email=a@example.com', 'commit', '-q',
+                           '--allow-empty', '-m', 'Later'], cwd=repository)
+    state = whodunit.commit_graph_state(repository)
+    assert whodunit.commit_graph_problems(state) == [
+        'commit-graph is out of date']
+    whodunit.main(['--stats', stats_file, repository])
+    out, err = capsys.readouterr()
+    assert "warning: commit-graph is out of date" in err
+
+
+def test_stats_and_profile(repository, shape, capsys):
+    stats_file = os.path.join(repository, 'stats.json')
+    profile_file = os.path.join(repository, 'run.prof')
+    whodunit.main(['--stats', stats_file, '--profile', profile_file,
+                   repository])
+    capsys.readouterr()
+    with open(stats_file) as stats:
+        data = json.load(stats)
+    assert data['counters']['files_scanned'] == shape.files
+    assert data['counters']['files_blamed'] == shape.files
+    assert data['counters']['records_parsed'] == shape.files * shape.lines
+    assert data['total']['child_cpu_seconds'] > 0
+    for stage in ('enumerate', 'classify', 'blame', 'parse', 'sort',
+                  'report'):
+        assert data['stages'][stage]['wall_seconds'] >= 0
+    assert os.path.getsize(profile_file) > 0
+
+
+def test_revision_of_bare_repository(repository, shape, capsys):
+    whodunit.main(['-s', 'size', '-d', repository])
+    expected, err = capsys.readouterr()
+
+    bare = os.path.join(repository, 'bare.git')
+    subprocess.check_call(['git', 'clone', '-q', '--bare', repository, bare])
+    whodunit.main(['-s', 'size', '-d', '--rev', 'HEAD', bare])
+    out, err = capsys.readouterr()
+    assert out == expected.replace(repository, bare)
+
+
+def test_queries_from_stdin(repository, shape, capsys, monkeypatch):
+    first, second = synthetic.file_names(2)
+    queries = '%s:1-3,5\0%s\0' % (first, os.path.join(repository, second))
+    monkeypatch.setattr('sys.stdin', io.TextIOWrapper(
+        io.BytesIO(queries.encode())))
+    stats_file = os.path.join(repository, 'stats.json')
+    whodunit.main(['--stdin', '-z', '-s', 'size', '-d', '--stats',
+                   stats_file, repository])
+    out, err = capsys.readouterr()
+    assert out.count('mod') == 2
+    assert sum(int(line.split()[1]) for line in out.splitlines()
+               if line.startswith('    ')) == 4 + shape.lines
+    with open(stats_file) as stats:
+        assert json.load(stats)['counters']['files_blamed'] == 2
+
+
+def test_timeline_reuses_unchanged_files(repository, shape, capsys):
+    owners = whodunit.SizeOwners(repository)
+    series = list(whodunit.ownership_timeline(owners, ['HEAD~3', 'HEAD']))
+    changed = subprocess.check_output(['git', 'diff', '--name-only',
+                                       'HEAD~3', 'HEAD'], cwd=repository)
+    assert [blamed for revision, files, blamed in series] == [
+        shape.files, len(changed.split())]
+    fresh = list(whodunit.ownership_timeline(whodunit.SizeOwners(repository),
+                                             ['HEAD']))
+    assert series[-1][1] == fresh[0][1]
+
+    json_file = os.path.join(repository, 'timeline.json')
+    whodunit.main(['timeline', '--json', json_file, repository, 'HEAD~3',
+                   'HEAD'])
+    out, err = capsys.readouterr()
+    assert out.startswith('Author')
+    assert 'HEAD: %d files, %d blamed' % (shape.files,
+                                         len(changed.split())) in err
+    with open(json_file) as timeline:
+        data = json.load(timeline)
+    assert sum(data['directories']['HEAD']['.'].values()) == (
+        shape.files * shape.lines)
+
+
+def test_ownership_table_matches_report(repository, shape, capsys):
+    numpy = pytest.importorskip('numpy')
+    table_file = os.path.join(repository, 'owners.npz')
+    for options in (['-j', '3'], ['-p', '2'], ['-j', '2', '-p', '2']):
+        whodunit.main(['-s', 'size', '--npz', table_file] + options +
+                      [repository])
+        capsys.readouterr()
+        data = numpy.load(table_file)
+        assert sorted(data['files']) == sorted(
+            synthetic.file_names(shape.files))
+        assert data['length'].sum() == shape.files * shape.lines
+
+    owners = whodunit.SizeOwners(repository)
+    owners.table = whodunit.OwnershipTable(repository)
+    owners.details = True
+    for result in owners.collect_ownership(owners.collect_modules()):
+        file_id = owners.table.files.index(
+            os.path.relpath(result.filename, repository))
+        expected = [(r.author_mail, r.line_count) for r in result.summary[1]]
+        file_ids, author_ids, lines = owners.table.size_ranking()
+        ranked = [(owners.table.authors[a], n) for f, a, n in
+                  zip(file_ids, author_ids, lines) if f == file_id]
+        assert sorted(ranked) == sorted(expected)
+
+
+def test_codeowners_reuses_cache(repository, shape, capsys):
+    whodunit.main(['codeowners', '--threshold', '0.01', repository])
+    out, err = capsys.readouterr()
+    assert err == '%d files, %d blamed, 0 from the cache\n' % (shape.files,
+                                                               shape.files)
+    assert out.startswith('# Generated by whodunit codeowners')
+    assert '\n* author' in out
+    assert os.path.exists(os.path.join(repository, '.git',
+                                       'whodunit-cache.json'))
+
+    whodunit.main(['codeowners', '--threshold', '0.01', repository])
+    again, err = capsys.readouterr()
+    assert again == out
+    assert err.endswith(', 0 blamed, %d from the cache\n' % shape.files)
+
+    name = synthetic.file_names(1)[0]
+    with open(os.path.join(repository, name), 'a') as changed:
+        changed.write('more\n')
+    subprocess.check_call(['git', '-c', 'user.name=New', '-c',
+                           'user.email=new@example.com', 'commit', '-q',
+                           '-am', 'Change'], cwd=repository)
+    whodunit.main(['codeowners', os.path.join(repository,
+                                              os.path.dirname(name))])
+    out, err = capsys.readouterr()
+    assert ', 1 blamed, ' in err
+    patterns = [line.split()[0] for line in out.splitlines()[2:]]
+    assert patterns[0] == '/%s/' % os.path.dirname(name)
+    assert all(pattern.startswith(patterns[0]) for pattern in patterns)
+
+
+def test_several_repositories_and_submodules(area, shape, capsys):
+    top, other = [os.path.join(area, name) for name in ('top', 'other')]
+    synthetic.make_repository(top, shape)
+    synthetic.make_repository(other, shape)
+    stats_file = os.path.join(area, 'stats.json')
+    whodunit.main(['-j', '3', '--stats', stats_file, top, other])
+    out, err = capsys.readouterr()
+    assert out.count('.py (') == 2 * shape.files
+    assert out.count('All authors:') == 1
+    assert '\n%s/pkg0/\n' % other in out
+
+    subprocess.check_call(['git', '-c', 'protocol.file.allow=always',
+                           'submodule', '--quiet', 'add', other, 'sub'],
+                          cwd=top)
+    subprocess.check_call(['git', '-c', 'user.name=A', '-c',
+                           'user.email=a@example.com', 'commit', '-q', '-m',
+                           'Add submodule'], cwd=top)
+    assert whodunit.find_submodules(top) == [os.path.join(top, 'sub')]
+    whodunit.main(['-j', '3', '--stats', stats_file, top])
+    out, err = capsys.readouterr()
+    assert out.count('.py (') == shape.files
+    whodunit.main(['-j', '3', '--recurse-submodules', '--stats', stats_file,
+                   top])
+    out, err = capsys.readouterr()
+    assert out.count('.py (') == 2 * shape.files
+    assert '\n%s/sub/pkg0/\n' % top in out
+    with open(stats_file) as stats:
+        # Along with .gitmodules
+        assert json.load(stats)['counters']['files_blamed'] == (
+            2 * shape.files + 1)
+
+
+def test_plan_does_not_blame(repository, shape, capsys):
+    stats_file = os.path.join(repository, 'stats.json')
+    whodunit.main(['--plan', '-j', '4', '--stats', stats_file, repository])
+    out, err = capsys.readouterr()
+    assert out.startswith('Plan for %s (nothing was blamed):' % repository)
+    assert 'Files to blame:        %d' % shape.files in out
+    assert 'Lines to blame:        %d of %d' % ((shape.files * shape.lines,) *
+                                                2) in out
+    assert 'All authors' not in out
+    with open(stats_file) as stats:
+        assert json.load(stats)['counters'].get('files_blamed', 0) == 0
+
+
+def test_windowed_blame_matches_whole_files(repository, shape, capsys):
+    synthetic.make_coverage_reports(repository, shape)
+    for options in (['-s', 'size', '-d'], ['-s', 'date', '-d', '--symbols'],
+                    ['-s', 'cover']):
+        whodunit.main(options + [repository])
+        expected, err = capsys.readouterr()
+        whodunit.main(options + ['--window', '7', '--window-jobs', '3',
+                                 repository])
+        out, err = capsys.readouterr()
+        assert out == expected
+
+
+def test_mailmap_merges_identities(area, shape, capsys):
+    top, other = [os.path.join(area, name) for name in ('top', 'other')]
+    synthetic.make_repository(top, shape)
+    synthetic.make_repository(other, shape)
+    name = os.path.join(other, synthetic.file_names(1)[0])
+    with open(name, 'a') as changed:
+        changed.write('more\n')
+    subprocess.check_call(['git', '-c', 'user.name=Alias', '-c',
+                           'user.email=alias@example.com', 'commit', '-q',
+                           '-am', 'Change'], cwd=other)
+    assert whodunit.Mailmap.for_repository(top) is None
+    with open(os.path.join(top, '.mailmap'), 'w') as mailmap:
+        mailmap.write('Author 0 <author0@example.com> <alias@example.com>\n')
+    assert whodunit.Mailmap.for_repository(top) is not None
+
+    # The mailmap of one repository isn't used for another
+    whodunit.main(['-s', 'size', '-j', '2', top, other])
+    out, err = capsys.readouterr()
+    assert 'Alias' in out
+    shutil.copy(os.path.join(top, '.mailmap'), other)
+    whodunit.main(['-s', 'size', '-j', '2', top, other])
+    out, err = capsys.readouterr()
+    assert 'Alias' not in out
+
+
+def test_diff_joins_stored_results(repository, shape, capsys):
+    name = synthetic.file_names(1)[0]
+    with open(os.path.join(repository, name), 'w') as changed:
+        changed.write(''.join('new %d\n' % i for i in range(100)))
+    subprocess.check_call(['git', '-c', 'user.name=New', '-c',
+                           'user.email=new@example.com', 'commit', '-q',
+                           '-am', 'Rewrite'], cwd=repository)
+    json_file = os.path.join(repository, 'diff.json')
+    whodunit.main(['diff', '--json', json_file, repository, 'HEAD~1', 'HEAD'])
+    out, err = capsys.readouterr()
+    assert err == 'HEAD~1: %d files, %d blamed\nHEAD: %d files, 1 blamed\n' % (
+        (shape.files, ) * 3)
+    assert out.startswith('Ownership drift from HEAD~1 to HEAD\n')
+    assert '    %s: author' % name in out
+    assert ' -> new@example.com (100%)\n' in out
+    with open(json_file) as diff:
+        data = json.load(diff)
+    assert [change[0] for change in data['files']] == [name]
+    assert data['directory_shares']['.'][0][0] == '<new@example.com>'
+
+    whodunit.main(['diff', repository, 'HEAD~1', 'HEAD'])
+    again, err = capsys.readouterr()
+    assert again == out
+    assert err == 'HEAD~1: %d files, 0 blamed\nHEAD: %d files, 0 blamed\n' % (
+        (shape.files, ) * 2)
+
+
+def test_cover_mode_from_coverage_data(repository, shape, capsys,
+                                       monkeypatch):
+    coverage = pytest.importorskip('coverage')
+    with open(os.path.join(repository, 'calc.py'), 'w') as module:
+        module.write('def add(a, b):\n    return a + b\n\n\n'
+                     'def sub(a, b):\n    return a - b\n\n\n'
+                     'def half(a):\n    if a:\n        return a / 2\n'
+                     '    return 0\n')
+    subprocess.check_call(['git', 'add', 'calc.py'], cwd=repository)
+    subprocess.check_call(['git', '-c', 'user.name=Calc', '-c',
+                           'user.email=calc@example.com', 'commit', '-q',
+                           '-m', 'Add calc'], cwd=repository)
+    with open(os.path.join(repository, 'run_calc.py'), 'w') as script:
+        script.write('import calc\ncalc.add(1, 2)\ncalc.half(0)\n')
+    subprocess.check_call([sys.executable, '-m', 'coverage', 'run',
+                           '--include=calc.py', 'run_calc.py'],
+                          cwd=repository)
+    whodunit.main(['-s', 'cover', repository])
+    out, err = capsys.readouterr()
+    assert ' 6 Calc ' in out
+    assert ' 11 Calc ' in out
+    assert 'calc.py' in out and 'mod' not in out
+
+    monkeypatch.setitem(sys.modules, 'coverage', None)
+    whodunit.main(['-s', 'cover', '--coverage-data',
+                   os.path.join(repository, '.coverage'), repository])
+    without_api, err = capsys.readouterr()
+    assert without_api == out
+
+    # Lines with a branch not taken are found with the coverage.py API
+    monkeypatch.undo()
+    with open(os.path.join(repository, 'run_calc.py'), 'w') as script:
+        script.write('import calc\ncalc.half(1)\n')
+    subprocess.check_call([sys.executable, '-m', 'coverage', 'run',
+                           '--branch', '--include=calc.py', 'run_calc.py'],
+                          cwd=repository)
+    whodunit.main(['-s', 'cover', repository])
+    out, err = capsys.readouterr()
+    assert ' 12 Calc ' in out
+    if hasattr(coverage.Coverage, 'branch_stats'):
+        assert ' 10 Calc ' in out
+
+
+@pytest.fixture()
+def bare_repository(area):
+    """A bare clone of a small repository, with functions to blame."""
+    work = os.path.join(area, 'work')
+    os.makedirs(os.path.join(work, 'pkg'))
+    with open(os.path.join(work, 'pkg', 'shapes.py'), 'w') as source:
+        source.write("def square(x):\n"
+                     "    return x * x\n"
+                     "\n"
+                     "\n"
+                     "def cube(x):\n"
+                     "    return x * x * x\n")
+    git = ['git', '-c', 'user.name=Bare Author',
+           '-c', 'user.email=bare@example.com']
+    subprocess.check_call(['git', 'init', '-q', work])
+    subprocess.check_call(git + ['add', '.'], cwd=work)
+    subprocess.check_call(git + ['commit', '-q', '-m', 'Shapes'], cwd=work)
+    bare = os.path.join(area, 'bare.git')
+    subprocess.check_call(['git', 'clone', '-q', '--bare', work, bare])
+    return bare
+
+
+def test_symbols_in_bare_repository(bare_repository, capsys):
+    whodunit.main(['--symbols', '--rev', 'HEAD', '-s', 'size',
+                   bare_repository])
+    out, err = capsys.readouterr()
+    assert "    square (Bare Author)\n" in out
+    assert "    cube (Bare Author)\n" in out
+
+    subdirectory = os.path.join(os.path.dirname(bare_repository), 'work',
+                                'pkg')
+    whodunit.main(['--symbols', '--rev', 'HEAD', '-s', 'size', subdirectory])
+    out, err = capsys.readouterr()
+    assert "    square (Bare Author)\n" in out
+
+
+def test_windowed_blame_in_bare_repository(bare_repository, capsys):
+    options = ['--rev', 'HEAD', '-s', 'size', '-d', bare_repository]
+    whodunit.main(options)
+    expected, err = capsys.readouterr()
+    whodunit.main(['--window', '2'] + options)
+    out, err = capsys.readouterr()
+    assert out == expected
+
+    owners = whodunit.SizeOwners(bare_repository)
+    owners.revision, owners.window = 'HEAD', 2
+    owners.list_tree_files()
+    windows, at_once = owners.line_windows(
+        os.path.join(bare_repository, 'pkg', 'shapes.py'), [])
+    assert windows == [[(1, 2)], [(3, 4)], [(5, 6)]]
+
+
+def test_count_commits_of_unusual_names(area):
+    names = ['caf\xe9.py', 'tab\there.py', 'quote"d.py']
+    for name in names:
+        with io.open(os.path.join(area, name), 'w') as source:
+            source.write('x = 1\n')
+    git = ['git', '-c', 'user.name=A', '-c', 'user.email=a@example.com']
+    subprocess.check_call(['git', 'init', '-q', area])
+    subprocess.check_call(git + ['add', '.'], cwd=area)
+    subprocess.check_call(git + ['commit', '-q', '-m', 'Add'], cwd=area)
+    assert whodunit.count_file_commits(area) == dict(
+        (os.path.join(area, name), 1) for name in names)
+
+
+def test_ownership_table_with_history_cutoff(repository, shape, capsys):
+    numpy = pytest.importorskip('numpy')
+    table_file = os.path.join(repository, 'owners.npz')
+    whodunit.main(['-s', 'size', '--since', '2010-01-02 06:00', '--npz',
+                   table_file, repository])
+    capsys.readouterr()
+    data = numpy.load(table_file)
+    assert data['length'].sum() == shape.files * shape.lines
+    assert '<before-cutoff>' in list(data['authors'])
+
+
+def test_ownership_table_with_spawned_workers(repository, shape, capsys,
+                                              monkeypatch):
+    numpy = pytest.importorskip('numpy')
+    # Workers get a pickled copy of the owners, and its table
+    monkeypatch.setattr(whodunit.multiprocessing, 'Pool',
+                        whodunit.multiprocessing.get_context('spawn').Pool)
+    table_file = os.path.join(repository, 'owners.npz')
+    whodunit.main(['-s', 'size', '-p', '2', '--npz', table_file, repository])
+    capsys.readouterr()
+    data = numpy.load(table_file)
+    assert data['length'].sum() == shape.files * shape.lines
+
+
+def test_targets_in_bare_repository(bare_repository, capsys, monkeypatch):
+    monkeypatch.chdir(bare_repository)
+    whodunit.main(['--rev', 'HEAD', '-s', 'size', 'pkg'])
+    out, err = capsys.readouterr()
+    assert '%s/pkg/\n' % bare_repository in out
+    assert 'shapes.py (Bare Author)' in out
+    whodunit.main(['--rev', 'HEAD', '-s', 'size', '-d',
+                   os.path.join('pkg', 'shapes.py')])
+    out, err = capsys.readouterr()
+    assert 'shapes.py (Bare Author)' in out
+    whodunit.main(['--rev', 'HEAD', '-s', 'size', 'pkg/shapes.py::cube'])
+    out, err = capsys.readouterr()
+    assert 'cube (Bare Author)' in out
+    with pytest.raises(SystemExit):
+        whodunit.main(['--rev', 'HEAD', 'pkg/missing.py'])
+    out, err = capsys.readouterr()
+    assert 'No file or directory' in err
+
+
+def test_target_only_in_revision(bare_repository, capsys):
+    work = os.path.join(os.path.dirname(bare_repository), 'work')
+    subprocess.check_call(['git', 'rm', '-q', os.path.join('pkg',
+                                                           'shapes.py')],
+                          cwd=work)
+    assert not os.path.exists(os.path.join(work, 'pkg'))
+    whodunit.main(['--rev', 'HEAD', '-s', 'date',
+                   os.path.join(work, 'pkg', 'shapes.py')])
+    out, err = capsys.readouterr()
+    assert 'shapes.py (Bare Author)' in out
+
+
+
+def test_history_maps_identities(area, capsys):
+    subprocess.check_call(['git', 'init', '-q', area])
+    for name, email, line in (('Pat H', 'pat@home', 'a = 1\n'),
+                              ('Pat', 'pat@work', 'b = 2\n')):
+        with open(os.path.join(area, 'f.py'), 'a') as source:
+            source.write(line)
+        subprocess.check_call(['git', 'add', 'f.py'], cwd=area)
+        subprocess.check_call(['git', '-c', 'user.name=' + name, '-c',
+                               'user.email=' + email, 'commit', '-q', '-m',
+                               'Change'], cwd=area)
+    with open(os.path.join(area, '.mailmap'), 'w') as mailmap:
+        mailmap.write('Pat <pat@work> <pat@home>\n')
+    for sort_by in ('size', 'history'):
+        whodunit.main(['-s', sort_by, area])
+        out, err = capsys.readouterr()
+        assert 'f.py (Pat)\n' in out
+    whodunit.main(['-s', 'history', '--no-mailmap', area])
+    out, err = capsys.readouterr()
+    assert 'f.py (Pat, Pat H)\n' in out or 'f.py (Pat H, Pat)\n' in out
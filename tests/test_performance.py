@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from benchmarks import micro
+
+
+# Running all of the benchmarks takes a while, so this allows skipping them
+pytestmark = pytest.mark.skipif(os.environ.get('WHODUNIT_SKIP_PERF'),
+                                reason='WHODUNIT_SKIP_PERF is set')
+
+# Shorter batches than the benchmark command uses, to keep tests quick
+MIN_BATCH = 0.02
+ATTEMPTS = 3
+
+
+@pytest.fixture(scope='module')
+def baseline():
+    version, results = micro.load_baseline()
+    if version != micro.python_version():
+        pytest.skip("Baseline was recorded with Python %s" % version)
+    return results
+
+
+def benchmark_names():
+    return [name for name, setup, run in micro.benchmarks()]
+
+
+@pytest.mark.parametrize('name', benchmark_names())
+def test_no_performance_regression(baseline, name):
+    """Check against the baseline, re-measuring before declaring failure."""
+    assert name in baseline, "Missing from baseline, use --update-baseline"
+    for attempt in range(ATTEMPTS):
+        results = micro.run_benchmarks(repeat=5, names=[name],
+                                       min_batch=MIN_BATCH)
+        regressions = micro.compare(results, baseline)
+        if not regressions:
+            break
+    assert not regressions, regressions[0]
+
+
+def test_regressions_are_reported():
+    baseline = {'a': {'time': 1.0, 'memory': 1000},
+                'b': {'time': 1.0, 'memory': 1000}}
+    results = {'a': {'time': 1.4, 'memory': 1200},
+               'b': {'time': 2.0, 'memory': 1300},
+               'new': {'time': 9.0, 'memory': 9000}}
+    assert micro.compare(results, baseline) == [
+        'b: time is 2.00x the baseline', 'b: memory is 1.30x the baseline']
@@ -1,8 +1,12 @@
+import argparse
 import copy
+import io
+import json
 import mock
 import os
 import pytest
 import shutil
+import sqlite3
 import subprocess
 import sys
 import tempfile
@@ -302,6 +306,23 @@ def test_parse_not_aggregating_two_records_same_commit():
     assert record.author_mail == "<carolb@example.com>"
 
 
+def test_parse_aggregates_interleaved_commits():
+    blame_output = line_one + line_two + line_three
+    owners = whodunit.Owners(".")
+    commits = owners.parse_info_records(blame_output)
+    assert len(commits) == 2
+    assert commits[0].line_count == 2
+    assert commits[1].line_count == 1
+
+
+def test_parse_blame_output_as_bytes():
+    blame_output = (line_one + line_two).encode('utf-8')
+    owners = whodunit.Owners(".")
+    commits = owners.parse_info_records(blame_output)
+    assert len(commits) == 2
+    assert commits[1].author == "Rich Rocket"
+
+
 def create_commit(info):
     """Helper to create a dummy commit record."""
     commit = whodunit.BlameRecord(info['uuid'], 5)
@@ -325,6 +346,55 @@ def create_commit(info):
     return commit
 
 
+boundary_line = """25088fc1e98735e811e6bac8c9930d44639130b9 7 7 1
+author Old Timer
+author-mail <old@example.com>
+author-time 1262304000
+author-tz +0000
+committer Old Timer
+committer-mail <old@example.com>
+committer-time 1262304000
+committer-tz +0000
+summary Initial commit
+boundary
+filename a.py
+\told code
+"""
+
+
+def test_lines_before_cutoff_go_in_bucket():
+    owners = whodunit.SizeOwners(".", details=True)
+    commits = owners.parse_info_records(boundary_line + line_two +
+                                        boundary_line)
+    bucket = commits[0]
+    assert bucket.boundary
+    assert bucket.uuid.startswith('^25088fc1e9')
+    assert bucket.author == 'Before cutoff'
+    assert bucket.line_count == 2
+    assert not commits[1].boundary
+
+
+def test_incomplete_boundary_record_is_accepted():
+    owners = whodunit.DateOwners(".")
+    partial = '\n'.join(line for line in boundary_line.split('\n')
+                         if not line.startswith('committer'))
+    bucket, = owners.parse_info_records(partial)
+    assert bucket.committer_time == 0
+    assert bucket.committer_mail == '<before-cutoff>'
+
+
+@pytest.mark.parametrize('owner_class', [whodunit.DateOwners,
+                                         whodunit.SizeOwners])
+def test_bucket_is_ranked_last(owner_class):
+    owners = owner_class(".", details=True)
+    # The bucket has the most lines, and the most recent date
+    newer = boundary_line.replace('1262304000', '1999999999')
+    owners.parse_info_records(newer + newer + line_two)
+    commits = owners.sort()
+    assert [c.boundary for c in commits] == [False, True]
+    assert owners.unique_authors(0) == ['Rich Rocket']
+
+
 def test_merge_only_one_commit():
     commit1 = create_commit({'uuid': 'uuid-1'})
     commit = whodunit.SizeOwners.merge_user_commits([commit1])
@@ -506,6 +576,22 @@ def test_parsing_size_with_verbose_details_and_limit():
     assert args.max == 5
 
 
+def test_parsing_include_and_exclude_options():
+    parser = whodunit.setup_parser()
+    args = parser.parse_args(['--include', 'src/**', '--exclude', 'tests',
+                              '--exclude', '*.txt', 'dummy-file'])
+    assert args.include == ['src/**']
+    assert args.exclude == ['tests', '*.txt']
+
+
+def test_fail_include_with_cover_mode(fake_cover_project):
+    parser = whodunit.setup_parser()
+    with pytest.raises(SystemExit) as excinfo:
+        whodunit.validate(parser, ['-s', 'cover', '--include', '*.py',
+                                   fake_cover_project])
+    assert str(excinfo.value) == '2'
+
+
 def test_parsing_coverage_options():
     parser = whodunit.setup_parser()
     args = parser.parse_args(['-s', 'cover', 'dummy-file'])
@@ -522,6 +608,20 @@ def test_validate_cover(fake_cover_project):
     assert args.sort_by == 'cover'
 
 
+def test_validate_cover_with_coverage_data(fake_project):
+    parser = whodunit.setup_parser()
+    data_file = os.path.join(fake_project, '.coverage')
+    open(data_file, 'w').close()
+    args = whodunit.validate(parser, ['-s', 'cover', fake_project])
+    assert args.coverage_data == data_file
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['-s', 'cover', '--coverage-data',
+                                   data_file + '.missing', fake_project])
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['-s', 'size', '--coverage-data',
+                                   data_file, fake_project])
+
+
 def test_validate_with_directory():
     parser = whodunit.setup_parser()
     args = whodunit.validate(parser, ['-s', 'date', '.'])
@@ -578,6 +678,17 @@ def test_fail_validate_cover_with_max():
     assert str(excinfo.value) == '2'
 
 
+def test_validate_several_repositories(dummy_file):
+    parser = whodunit.setup_parser()
+    args = whodunit.validate(parser, ['.', 'tests'])
+    assert args.other_roots == ['tests']
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['.', dummy_file])
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['-s', 'history', '--recurse-submodules',
+                                   '.'])
+
+
 def test_fail_validate_not_dir_or_file():
     parser = whodunit.setup_parser()
     with pytest.raises(SystemExit) as excinfo:
@@ -599,6 +710,14 @@ def test_build_size_owner(dummy_file):
     assert isinstance(owner, whodunit.SizeOwners)
 
 
+def test_build_history_owner():
+    parser = whodunit.setup_parser()
+    args = whodunit.validate(parser, ['-s', 'history', '--exclude', 'x', '.'])
+    owner = whodunit.build_owner(args)
+    assert isinstance(owner, whodunit.HistoryOwners)
+    assert owner.matcher.excludes == ['x']
+
+
 def test_build_coverage_owner(fake_cover_project):
     parser = whodunit.setup_parser()
     args = whodunit.validate(parser, ['-s', 'cover', fake_cover_project])
@@ -777,118 +896,283 @@ def test_last_commit_part_of_contiguous_region():
     assert actual_commits[0].lines == '1-3'
 
 
-def test_is_git_file():
-    with mock.patch.object(subprocess, 'Popen', create=True) as popen:
-        popen.return_value.returncode = 0
-        assert whodunit.Owners.is_git_file('.', 'foo.py')
-    expected = [mock.call(['git', 'ls-files', '--error-unmatch', 'foo.py'],
-                          stderr=-1, stdout=-1)]
-    assert popen.call_count == 1
-    popen.assert_has_calls(expected)
-
-
-def test_is_not_git_file():
-    with mock.patch.object(subprocess, 'Popen', create=True) as popen:
-        popen.return_value.returncode = 1
-        assert not whodunit.Owners.is_git_file('.', 'foo.py')
-    expected = [mock.call(['git', 'ls-files', '--error-unmatch', 'foo.py'],
-                          stderr=-1, stdout=-1)]
-    assert popen.call_count == 1
-    popen.assert_has_calls(expected)
-
-
 def test_collecting_modules(monkeypatch):
     owners = whodunit.Owners('/some/path')
+    monkeypatch.setattr(os.path, 'isfile', lambda path: True)
 
-    with mock.patch('os.walk') as walker:
-        walker.return_value = [('/some/path', (), ('foo.py', 'bar.py')), ]
-
-        def is_git(cls, path, name):
-            return True
-        monkeypatch.setattr(whodunit.Owners, 'is_git_file', is_git)
-
+    with mock.patch.object(owners, 'list_tracked_files') as tracked:
+        tracked.return_value = ['foo.py', 'sub/baz.py', 'bar.py']
         modules = owners.collect_modules()
-        expected = [('/some/path/foo.py', []), ('/some/path/bar.py', [])]
+        expected = [('/some/path/bar.py', []), ('/some/path/foo.py', []),
+                    ('/some/path/sub/baz.py', [])]
         assert list(modules) == expected
+    tracked.assert_called_once_with(['.'])
 
 
 def tests_filtering_modules(monkeypatch):
     owners = whodunit.Owners('/some/path', filter="*.py")
+    monkeypatch.setattr(os.path, 'isfile',
+                        lambda path: path != '/some/path/c.py')
 
-    with mock.patch('os.walk') as walker:
-        walker.return_value = [('/some/path', (), ('a.py', 'skip', 'b.py')), ]
-
-        def is_git(cls, path, name):
-            return True
-        monkeypatch.setattr(whodunit.Owners, 'is_git_file', is_git)
-
+    with mock.patch.object(owners, 'list_tracked_files') as tracked:
+        tracked.return_value = ['a.py', 'skip', 'b.py', 'c.py']
         modules = owners.collect_modules()
         expected = [('/some/path/a.py', []), ('/some/path/b.py', [])]
         assert list(modules) == expected
 
 
-def test_collecting_blame_info(monkeypatch, capsys):
-    matches = [('path/a.py', [(1, 1)]),
-               ('b.py', [(5, 5), (10, 10)])]
-
-    def dummy_chdir(path):
-        pass
-    monkeypatch.setattr(os, 'chdir', dummy_chdir)
-
-    with mock.patch.object(subprocess, 'Popen', create=True) as popen:
-        popen.return_value.communicate.side_effect = [('blame1', ''),
-                                                      ('blame5+10', '')]
-        blame_info = whodunit.Owners.collect_blame_info(matches)
-
-        assert list(blame_info) == ['blame1', 'blame5+10']
-    assert popen.call_count == 2
-    expected = [
-        mock.call(['git', 'blame', '--line-porcelain',
-                   '-L 1,1', 'a.py'],
-                  stderr=-1, stdout=-1),
-        mock.call().communicate(),
-        mock.call(['git', 'blame', '--line-porcelain',
-                   '-L 5,5', '-L 10,10', 'b.py'],
-                  stderr=-1, stdout=-1),
-        mock.call().communicate()
-    ]
-    popen.assert_has_calls(expected)
-    out, err = capsys.readouterr()
-    expected = """
-
-path/
-
-a.py 
-
-./
+def test_including_and_excluding_modules(monkeypatch):
+    owners = whodunit.Owners('/repo', includes=['src/**/*.py'],
+                             excludes=['tests', 'src/**/migrations/'])
+    monkeypatch.setattr(os.path, 'isfile', lambda path: True)
 
-b.py """
-    assert out == expected
+    with mock.patch.object(owners, 'list_tracked_files') as tracked:
+        tracked.return_value = ['src/a.py', 'src/tests/t.py', 'src/b.txt',
+                                'src/m/migrations/0001.py', 'src/m/c.py']
+        modules = owners.collect_modules()
+        expected = [('/repo/src/a.py', []), ('/repo/src/m/c.py', [])]
+        assert list(modules) == expected
+    tracked.assert_called_once_with([
+        ':(glob)src/**/*.py', ':(glob)src/**/*.py/**',
+        ':(exclude,glob)**/tests', ':(exclude,glob)**/tests/**',
+        ':(exclude,glob)src/**/migrations',
+        ':(exclude,glob)src/**/migrations/**'])
 
 
-def test_fail_collecting_blame_info(monkeypatch, capsys):
-    matches = [('path/a.py', [(1, 1)]), ]
+def test_list_tracked_files():
+    owners = whodunit.Owners('/repo')
+    with mock.patch.object(subprocess, 'Popen', create=True) as popen:
+        popen.return_value.communicate.return_value = (b'a.py\0sub/b c.py\0',
+                                                       b'')
+        assert owners.list_tracked_files(['.']) == ['a.py', 'sub/b c.py']
+    popen.assert_called_once_with(['git', 'ls-files', '-z', '--', '.'],
+                                  stdout=-1, stderr=-1, cwd='/repo')
+
+
+def test_collecting_modules_from_revision():
+    owners = whodunit.Owners('/repo.git', filter='*.py')
+    owners.revision = 'v1'
+    listing = (b'100644 blob 1111 12\tsrc/a.py\0'
+               b'160000 commit 2222 -\tlib\0'
+               b'100644 blob 3333 7\tREADME\0'
+               b'100644 blob 4444 30\tb c.py\0')
+    with mock.patch.object(subprocess, 'Popen', create=True) as popen:
+        popen.return_value.stdout = io.BytesIO(listing)
+        modules = list(owners.collect_modules())
+    # No need for the files to be checked out
+    assert modules == [('/repo.git/b c.py', []), ('/repo.git/src/a.py', [])]
+    popen.assert_called_once_with(['git', 'ls-tree', '-r', '-z', '-l', 'v1'],
+                                  stdout=-1, stderr=-1, cwd='/repo.git')
+    assert owners.file_size('/repo.git/src/a.py') == 12
+    assert owners.file_size('/repo.git/lib') == 0
+    assert owners.unblameable_reason('/repo.git/b c.py', {}, 20) == 'too large'
+    assert owners.unblameable_reason('/repo.git/src/a.py', {}, 20) is None
+
+
+@pytest.mark.parametrize('pattern,path,expected', [
+    ('*.py', 'a.py', True),
+    ('*.py', 'deep/down/a.py', True),
+    ('*.py', 'a.pyc', False),
+    ('src/*.py', 'src/a.py', True),
+    ('src/*.py', 'src/sub/a.py', False),
+    ('src/**/*.py', 'src/a.py', True),
+    ('src/**/*.py', 'src/sub/a.py', True),
+    ('src/**', 'src/sub/a.py', True),
+    ('src', 'src/sub/a.py', True),
+    ('src/', 'lib/src/a.py', True),
+    ('lib/src', 'src/a.py', False),
+    ('a?.py', 'ab.py', True),
+    ('a?.py', 'a/.py', False),
+    ('[!a]*.py', 'a.py', False),
+    ('[!a]*.py', 'b.py', True),
+    ('a+b.py', 'a+b.py', True),
+])
+def test_path_matching(pattern, path, expected):
+    assert whodunit.PathMatcher(includes=[pattern]).match(path) == expected
+    assert whodunit.PathMatcher(excludes=[pattern]).match(path) != expected
+
+
+def test_path_matcher_pathspecs():
+    assert whodunit.PathMatcher().pathspecs() == ['.']
+    matcher = whodunit.PathMatcher(includes=['*.py', 'doc/**'])
+    assert matcher.pathspecs() == [':(glob)**/*.py', ':(glob)**/*.py/**',
+                                   ':(glob)doc/**']
+
+
+def test_blaming_with_history_bounds():
+    with mock.patch.object(subprocess, 'Popen', create=True) as popen:
+        popen.return_value.communicate.return_value = ('blame', '')
+        owners = whodunit.Owners('.')
+        owners.history_bounds = ['--since=2015-01-01']
+        owners.timed_blame(('path/a.py', [(1, 2)]))
+    popen.assert_called_once_with(
+        ['git', 'blame', '--line-porcelain', '--root', '-L 1,2',
+         '--since=2015-01-01', 'a.py'], stderr=-1, stdout=-1, cwd='path')
 
-    def dummy_chdir(path):
-        pass
-    monkeypatch.setattr(os, 'chdir', dummy_chdir)
 
+def test_blaming_a_revision():
     with mock.patch.object(subprocess, 'Popen', create=True) as popen:
-        popen.return_value.communicate.return_value = ('', 'blame fail')
-        blame_info = whodunit.Owners.collect_blame_info(matches)
-
-        assert list(blame_info) == []
-    assert popen.call_count == 1
-    expected = [
-        mock.call(['git', 'blame', '--line-porcelain',
-                   '-L 1,1', 'a.py'],
-                  stderr=-1, stdout=-1),
-        mock.call().communicate()
-    ]
-    popen.assert_has_calls(expected)
+        popen.return_value.communicate.return_value = ('blame', '')
+        owners = whodunit.Owners('/repo.git')
+        owners.revision = 'v2'
+        owners.history_bounds = ['v1..v2']
+        owners.timed_blame(('/repo.git/path/a.py', []))
+    popen.assert_called_once_with(
+        ['git', 'blame', '--line-porcelain', '--root', 'v1..v2', '--',
+         'path/a.py'], stderr=-1, stdout=-1, cwd='/repo.git')
+
+
+def test_find_symbols():
+    source = (b'import os\n'
+              b'@decorate\n'
+              b'class Thing(object):\n'
+              b'    def method(self):\n'
+              b'        def inner():\n'
+              b'            pass\n'
+              b'\n'
+              b'async def fetch():\n'
+              b'    pass\n')
+    assert whodunit.find_symbols(source) == {
+        'Thing': (2, 6), 'Thing.method': (4, 6),
+        'Thing.method.inner': (5, 6), 'fetch': (8, 9)}
+
+
+def test_find_statements():
+    source = (b'"""Docstring."""\n'
+              b'import os\n'
+              b'@decorate\n'
+              b'def run(a,\n'
+              b'        b):\n'
+              b'    global c\n'
+              b'    total = (a +\n'
+              b'             b)\n'
+              b'    try:\n'
+              b'        return total\n'
+              b'    except ValueError:  # pragma: no cover\n'
+              b'        pass\n'
+              b'    if a: return b\n')
+    assert whodunit.find_statements(source) == {
+        2: 2, 3: 5, 7: 8, 9: 9, 10: 10, 13: 13}
+
+
+def test_numbits_to_lines():
+    assert whodunit.numbits_to_lines(b'\x06\x00\x81') == [1, 2, 16, 23]
+
+
+def test_collecting_from_coverage_data(fake_project, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'coverage', None)
+    source = os.path.join(fake_project, 'a.py')
+    with open(source, 'w') as module:
+        module.write('import os\n\n\ndef f(x):\n    if x:\n'
+                     '        return 1\n    return 2\n\n\nx = 1\n')
+    data_file = os.path.join(fake_project, '.coverage')
+    connection = sqlite3.connect(data_file)
+    connection.executescript(
+        "create table file (id integer primary key, path text);"
+        "create table line_bits (file_id integer, context_id integer, "
+        "numbits blob);"
+        "create table arc (file_id integer, context_id integer, "
+        "fromno integer, tono integer);")
+    connection.executemany("insert into file values (?, ?)",
+                           [(1, source), (2, '/elsewhere/b.py')])
+    connection.execute("insert into line_bits values (1, 1, ?)",
+                       (b'\x12\x04', ))  # Lines 1, 4 and 10
+    connection.commit()
+    connection.close()
+    owners = whodunit.CoverageOwners(fake_project, data_file=data_file)
+    assert list(owners.collect_modules()) == [(source, [(5, 7)])]
+
+
+def test_blaming_a_symbol(fake_project):
+    filename = os.path.join(fake_project, 'a.py')
+    with open(filename, 'w') as source:
+        source.write('class A(object):\n    def m(self):\n        pass\n')
+    owners = whodunit.Owners(fake_project)
+    with mock.patch.object(subprocess, 'Popen', create=True) as popen:
+        popen.return_value.communicate.return_value = ('blame', '')
+        blame = owners.timed_blame((filename + '::A.m', []))
+        assert blame.filename == filename + '::A.m'
+        blame = owners.timed_blame((filename + '::B', []))
+        assert blame.error == "No symbol B in the file"
+    popen.assert_called_once_with(
+        ['git', 'blame', '--line-porcelain', '--root', '-L 2,3', 'a.py'],
+        stderr=-1, stdout=-1, cwd=fake_project)
+    assert len(owners.symbol_cache) == 1
+
+
+def test_ranking_by_symbol(fake_project, capsys):
+    filename = os.path.join(fake_project, 'a.py')
+    with open(filename, 'w') as source:
+        source.write('def a():\n    pass\ndef b(): pass\n')
+    output = (line_three.replace(' 28 28', ' 28 1') +
+              line_two.replace(' 790 1795', ' 790 2') +
+              line_one.replace(' 1794 1794', ' 3 1'))
+    owners = whodunit.DateOwners(fake_project, details=True)
+    owners.by_symbol = True
+    result = owners.rank_blame(whodunit.BlameOutput(filename, output, '', 1))
+    assert result.summary[0] == ['Carol Coverage', 'Rich Rocket']
+    assert [(symbol, authors, [r.line_count for r in records])
+            for symbol, (authors, records) in result.symbols] == [
+        ('a', ['Carol Coverage', 'Rich Rocket'], [1, 1]),
+        ('b', ['Carol Coverage'], [1])]
+
+    whodunit.Report(owners).add(result)
     out, err = capsys.readouterr()
-    assert out == ("\n\npath/\n\na.py  <<<<<<<<<< Unable to collect 'git "
-                   "blame' info: blame fail\n")
+    assert out.endswith("a.py (Carol Coverage, Rich Rocket)\n"
+                        "    6e3b3aec     2 Carol Coverage            "
+                        "2016-02-01\n"
+                        "    65491efb     1 Rich Rocket               "
+                        "2015-03-27\n"
+                        "    a (Carol Coverage, Rich Rocket)\n"
+                        "        6e3b3aec     1 Carol Coverage            "
+                        "2016-02-01\n"
+                        "        65491efb     1 Rich Rocket               "
+                        "2015-03-27\n"
+                        "    b (Carol Coverage)\n"
+                        "        6e3b3aec     1 Carol Coverage            "
+                        "2016-02-01\n")
+
+
+def test_fail_symbols_unless_blamed(dummy_file):
+    parser = whodunit.setup_parser()
+    args = whodunit.validate(parser, [dummy_file + '::A.m'])
+    assert (args.root, args.symbol) == (dummy_file, 'A.m')
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['-s', 'history', dummy_file + '::A'])
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['--symbols', '-s', 'cover', '.'])
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['.::A'])
+
+
+def test_history_bound_options(monkeypatch):
+    parser = whodunit.setup_parser()
+    args = whodunit.validate(parser, ['--since', '1 year ago', '.'])
+    assert whodunit.history_bounds(args) == ['--since=1 year ago']
+    args = whodunit.validate(parser, ['--since-rev', 'v2.0', '.'])
+    assert whodunit.history_bounds(args) == ['v2.0..']
+    monkeypatch.setattr(whodunit, 'git_output', lambda root, *args: 'tree')
+    args = whodunit.validate(parser, ['--since-rev', 'v2.0', '--rev', 'v3.0',
+                                      '.'])
+    assert whodunit.history_bounds(args) == ['v2.0..v3.0']
+    args = whodunit.validate(parser, ['--since', '1 year ago', '--rev', 'v3.0',
+                                      '.'])
+    assert whodunit.history_bounds(args) == ['--since=1 year ago', 'v3.0']
+    args = whodunit.validate(parser, ['.'])
+    assert whodunit.history_bounds(args) == []
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['--since', 'x', '--since-rev', 'y', '.'])
+
+
+def test_fail_validate_revision(monkeypatch):
+    parser = whodunit.setup_parser()
+    monkeypatch.setattr(whodunit, 'git_output', lambda root, *args: None)
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['--rev', 'no-such-rev', '.'])
+    monkeypatch.setattr(whodunit, 'git_output', lambda root, *args: 'tree')
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['-s', 'size', '--sample', '100', '--rev',
+                                   'v1', '.'])
 
 
 def test_collecting_coverage_modules(monkeypatch):
@@ -1005,3 +1289,953 @@ def test_showing_details_of_coverage_commits(capsys):
     33333333          10 Joe Dirt                  2016-02-01
 """
     assert out == expected
+
+
+def test_summarize_without_details():
+    owners = whodunit.SizeOwners(".")
+    owners.parse_info_records(line_one + line_two + line_three)
+    owners.sort()
+    assert owners.summarize(0) == (['Carol Coverage', 'Rich Rocket'], [])
+
+
+def test_summarize_with_details():
+    owners = whodunit.SizeOwners(".", details=True)
+    owners.parse_info_records(line_one + line_two + line_three)
+    owners.sort()
+    authors, records = owners.summarize(1)
+    assert authors == ['Carol Coverage']
+    assert records == [
+        whodunit.SummaryRecord('6e3b3aec8a73da4129e83554ad5ac2f43d4ec775', 2,
+                               None, 'Carol Coverage', '<carolb@example.com>',
+                               'Carol Coverage', '<carolb@example.com>',
+                               1454335722, '-0500')]
+    expected = "    6e3b3aec     2 Carol Coverage            2016-02-01"
+    assert owners.show(records[0]) == expected
+
+
+def test_rank_failed_blame():
+    owners = whodunit.DateOwners(".")
+    blame = whodunit.BlameOutput('path/a.py', '', b'fatal: no such path', 2)
+    result = owners.rank_blame(blame)
+    assert result == ('path/a.py', 'fatal: no such path', None, 2, None,
+                      None, None)
+
+
+def test_rank_blame_measures_work():
+    owners = whodunit.DateOwners(".")
+    output = (line_one + line_two).encode('utf-8')
+    result = owners.rank_blame(whodunit.BlameOutput('a.py', output, '', 1))
+    assert result.stats['records'] == 2
+    assert result.stats['bytes'] == len(output)
+    assert len(result.stats['parse']) == 3
+    assert len(result.stats['sort']) == 3
+
+
+@pytest.mark.parametrize('processes,jobs', [(0, 1), (2, 1), (0, 3), (2, 3)])
+def test_collecting_ownership(monkeypatch, processes, jobs):
+    outputs = {'a.py': (line_one + line_three, ''),
+               'b.py': (line_two, ''),
+               'c.py': ('', 'blame fail')}
+
+    def blame_file(cls, filename, ranges, timeout=None, bounds=(),
+                   root=None):
+        return outputs[filename]
+    monkeypatch.setattr(whodunit.Owners, 'blame_file',
+                        classmethod(blame_file))
+    monkeypatch.setattr(whodunit, 'count_file_commits',
+                        lambda root, revisions=(): {})
+
+    owners = whodunit.DateOwners(".", details=True)
+    matches = [('a.py', []), ('b.py', []), ('c.py', [])]
+    results = list(owners.collect_ownership(matches, processes, jobs))
+    assert [r.filename for r in results] == ['a.py', 'b.py', 'c.py']
+    assert results[0].summary[0] == ['Carol Coverage']
+    assert results[0].summary[1][0].line_count == 2
+    assert results[1].summary[0] == ['Rich Rocket']
+    assert results[2].error == 'blame fail'
+    assert results[2].summary is None
+
+
+def test_collecting_ownership_stats(monkeypatch):
+    outputs = {'a.py': (line_one + line_three, ''), 'c.py': ('', 'fail')}
+
+    def blame_file(cls, filename, ranges, timeout=None, bounds=(),
+                   root=None):
+        return outputs[filename]
+    monkeypatch.setattr(whodunit.Owners, 'blame_file',
+                        classmethod(blame_file))
+
+    stats = whodunit.Stats()
+    owners = whodunit.DateOwners(".")
+    matches = stats.timed('enumerate', [('a.py', []), ('c.py', [])],
+                          'files_scanned')
+    list(owners.collect_ownership(matches, stats=stats))
+    assert stats.counters['files_scanned'] == 2
+    assert stats.counters['files_blamed'] == 2
+    assert stats.counters['blame_errors'] == 1
+    assert stats.counters['records_parsed'] == 2
+    assert stats.counters['porcelain_bytes'] == len(line_one + line_three)
+    assert list(stats.stages) == ['enumerate', 'blame', 'parse', 'sort']
+
+
+def test_count_lines(fake_project):
+    name = os.path.join(fake_project, 'a.py')
+    for content, expected in ((b'', 0), (b'one\n', 1), (b'one\ntwo', 2)):
+        with open(name, 'wb') as source:
+            source.write(content)
+        assert whodunit.count_lines(name) == expected
+
+
+def test_sampled_runs():
+    owners = whodunit.SampledOwners('/repo', sample_lines=7)
+    runs, wanted = owners.sample_runs('/repo/a.py', 23)
+    assert sorted(runs) == [(1, 5), (6, 10), (11, 15), (16, 20), (21, 23)]
+    assert wanted == 2
+    assert owners.sample_runs('/repo/a.py', 23) == (runs, wanted)
+    assert owners.sample_runs('/repo/a.py', 8)[1] == 2  # Whole file
+    assert whodunit.SampledOwners.join_runs([(11, 15), (1, 5), (6, 10),
+                                             (21, 23)]) == [(1, 15),
+                                                            (21, 23)]
+
+
+def test_sampling_files_per_directory(monkeypatch):
+    monkeypatch.setattr(whodunit, 'count_lines', lambda name: 100)
+    owners = whodunit.SampledOwners('/repo', sample_lines=10,
+                                    sample_files=2)
+    matches = [('/repo/a.py', []), ('/repo/b.py', []), ('/repo/c.py', []),
+               ('/repo/sub/d.py', [])]
+    sampled = list(owners.sample_matches(matches))
+    assert len(sampled) == 3
+    assert sampled[-1][0] == '/repo/sub/d.py'
+    assert [r for f, r in owners.skipped] == ['not sampled']
+    for filename, ranges in sampled:
+        assert sum(last - first + 1 for first, last in ranges) == 10
+
+
+def test_share_interval():
+    share, low, high = whodunit.SampledOwners.share_interval(30, 50, 1000)
+    assert share == 0.6
+    assert 0.45 < low < share < high < 0.75
+    assert whodunit.SampledOwners.share_interval(30, 50, 50) == (0.6, 0.6,
+                                                                 0.6)
+    # Treating runs of lines as the samples widens the interval
+    wider = whodunit.SampledOwners.share_interval(30, 50, 1000, 5)
+    assert wider[1] < low and wider[2] > high
+
+
+@pytest.mark.parametrize('count, sampled, num_lines, run_length', [
+    (5, 5, 8, 5), (100, 100, 150, 5), (0, 100, 200, 5), (0, 50, 1000, 1),
+    (50, 50, 1000, 1), (199, 200, 201, 1), (1, 200, 201, 1)])
+def test_share_interval_contains_share(count, sampled, num_lines,
+                                       run_length):
+    share, low, high = whodunit.SampledOwners.share_interval(
+        count, sampled, num_lines, run_length)
+    assert 0.0 <= low <= share <= high <= 1.0
+
+
+def test_share_interval_narrows_near_whole_file():
+    share, low, high = whodunit.SampledOwners.share_interval(100, 200, 201)
+    wide = whodunit.SampledOwners.share_interval(100, 200, 100000)
+    assert high - low < (wide[2] - wide[1]) / 10
+    assert whodunit.SampledOwners.share_interval(0, 100, 200, 5)[1] == 0.0
+    assert whodunit.SampledOwners.share_interval(100, 100, 150, 5)[2] == 1.0
+
+
+def porcelain_lines(uuid, author, count):
+    return ''.join(
+        '%s 1 %d 1\nauthor %s\nauthor-mail <%s@example.com>\n'
+        'author-time 1454335722\nauthor-tz -0500\ncommitter %s\n'
+        'committer-mail <%s@example.com>\ncommitter-time 1454335722\n'
+        'committer-tz -0500\n\tcode\n' % (uuid * 40, i + 1, author,
+                                            author, author, author)
+        for i in range(count))
+
+
+def test_sampling_blames_more_when_too_close(monkeypatch):
+    blamed = []
+
+    def blame_file(cls, filename, ranges, timeout=None, bounds=(),
+                   root=None):
+        blamed.append(ranges)
+        lines = sum(last - first + 1 for first, last in ranges)
+        return (porcelain_lines('a', 'amy', lines // 2) +
+                porcelain_lines('b', 'bob', lines - lines // 2), '')
+    monkeypatch.setattr(whodunit.Owners, 'blame_file',
+                        classmethod(blame_file))
+    monkeypatch.setattr(whodunit, 'count_lines', lambda name: 100)
+
+    owners = whodunit.SampledOwners('/repo', details=True, sample_lines=20)
+    result, = owners.collect_ownership([('/repo/a.py', [])])
+    # An even split is never decided, so the whole file ends up blamed
+    lines = [sum(last - first + 1 for first, last in ranges)
+             for ranges in blamed]
+    assert lines == [20, 20, 40, 20]
+    authors, records = result.summary
+    assert [r.line_count for r in records] == [50, 50]
+    assert [r.lines for r in records] == ['50%', '50%']
+
+
+def test_sampling_stops_when_decided(monkeypatch):
+    blamed = []
+
+    def blame_file(cls, filename, ranges, timeout=None, bounds=(),
+                   root=None):
+        blamed.append(ranges)
+        lines = sum(last - first + 1 for first, last in ranges)
+        return (porcelain_lines('a', 'amy', lines - 1) +
+                porcelain_lines('b', 'bob', 1), '')
+    monkeypatch.setattr(whodunit.Owners, 'blame_file',
+                        classmethod(blame_file))
+    monkeypatch.setattr(whodunit, 'count_lines', lambda name: 1000)
+
+    owners = whodunit.SampledOwners('/repo', details=True, sample_lines=100)
+    result, = owners.collect_ownership([('/repo/a.py', [])])
+    assert len(blamed) == 1
+    authors, records = result.summary
+    assert authors == ['amy', 'bob']
+    assert records[0].line_count == 990
+    assert records[0].lines.startswith('99% (')
+    assert owners.show(records[0]).endswith(records[0].lines)
+
+
+def test_fail_sampling_unless_by_size():
+    parser = whodunit.setup_parser()
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['--sample', '100', '.'])
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['-s', 'size', '--sample', '-1', '.'])
+    args = whodunit.validate(parser, ['-s', 'size', '--sample-files', '3',
+                                      '.'])
+    owners = whodunit.build_owner(args)
+    assert isinstance(owners, whodunit.SampledOwners)
+    assert owners.sample_files == 3
+
+
+def test_directory_ownership():
+    files = {'a.py': {'Ann': 3}, 'src/b.py': {'Ann': 1, 'Bob': 2},
+             'src/lib/c.py': {'Bob': 5}}
+    assert whodunit.directory_ownership(files) == {
+        '.': {'Ann': 4, 'Bob': 7}, 'src': {'Ann': 1, 'Bob': 7},
+        'src/lib': {'Bob': 5}}
+
+
+def make_ownership_table():
+    table = whodunit.OwnershipTable('/repo')
+    owners = whodunit.SizeOwners('/repo')
+    owners.table = table
+    for filename, output in (
+            ('/repo/a.py', line_three.replace(' 28 28', ' 28 1') +
+             line_two.replace(' 790 1795', ' 790 2') +
+             line_one.replace(' 1794 1794', ' 3 1')),
+            ('/repo/sub/b.py', line_one.replace(' 1794 1794', ' 1 2') +
+             line_one.replace(' 1794 1794', ' 2'))):
+        commits = owners.parse_info_records(output)
+        table.add_records(filename, commits, owners.blamed_lines)
+    return table
+
+
+def test_ownership_table():
+    numpy = pytest.importorskip('numpy')
+    table = make_ownership_table()
+    assert table.files == ['a.py', 'sub/b.py']
+    assert table.authors == ['<carolb@example.com>', '<richard@cover.net>']
+    assert table.author_names == ['Carol Coverage', 'Rich Rocket']
+    data = table.arrays()
+    assert [list(data[column]) for column in table.columns] == [
+        [0, 0, 0, 1], [1, 2, 3, 1], [1, 1, 1, 2], [0, 1, 0, 0],
+        [0, 1, 0, 0], [1454335722, 1427468897, 1454335722, 1454335722]]
+    assert numpy.issubdtype(data['length'].dtype, numpy.integer)
+
+
+def test_ownership_table_rankings():
+    pytest.importorskip('numpy')
+    table = make_ownership_table()
+    assert [list(column) for column in table.size_ranking()] == [
+        [0, 0, 1], [0, 1, 0], [2, 1, 2]]
+    assert [list(column) for column in table.date_ranking()] == [
+        [0, 0, 1], [0, 1, 0], [2, 1, 2],
+        [1454335722, 1427468897, 1454335722]]
+    directories, directory_id, author_id, lines = table.directory_rollup()
+    assert directories == ['.', 'sub']
+    assert [list(directory_id), list(author_id), list(lines)] == [
+        [0, 0, 1], [0, 1, 0], [4, 1, 2]]
+
+
+def test_saving_ownership_table(tmpdir):
+    numpy = pytest.importorskip('numpy')
+    filename = str(tmpdir.join('owners.npz'))
+    make_ownership_table().save(filename)
+    data = numpy.load(filename)
+    assert list(data['files']) == ['a.py', 'sub/b.py']
+    assert list(data['author_names']) == ['Carol Coverage', 'Rich Rocket']
+    assert list(data['length']) == [1, 1, 1, 2]
+    empty = str(tmpdir.join('empty.npz'))
+    whodunit.OwnershipTable('/repo').save(empty)
+    assert len(numpy.load(empty)['file_id']) == 0
+
+
+def test_codeowners_entries():
+    directories = {'.': {'ann': 60, 'bob': 30, 'cat': 10},
+                   'src': {'ann': 50, 'bob': 30},
+                   'src/lib': {'bob': 30},
+                   'src/lib/deep': {'bob': 10},
+                   'src/ui': {'ann': 50},
+                   'docs': {'cat': 10, 'ann': 10},
+                   'empty': {}}
+    assert whodunit.codeowners_entries(directories) == [
+        ('*', ['ann', 'bob']), ('/docs/', ['ann', 'cat']),
+        ('/src/lib/', ['bob']), ('/src/ui/', ['ann'])]
+    assert whodunit.codeowners_entries(directories, threshold=0.5,
+                                       max_owners=1) == [
+        ('*', ['ann']), ('/src/lib/', ['bob'])]
+    assert whodunit.codeowners_entries(directories, threshold=0.5,
+                                       max_owners=1, prefix='pkg/') == [
+        ('/pkg/', ['ann']), ('/pkg/src/lib/', ['bob'])]
+
+
+def test_ownership_cache(tmpdir):
+    filename = str(tmpdir.join('cache.json'))
+    assert whodunit.read_ownership_cache(filename) == {}
+    known = {('a.py', '1111'): {'<ann>': 3}, ('a.py', '2222'): {'<bob>': 4},
+             ('b.py', '3333'): {'<ann>': 1}}
+    whodunit.write_ownership_cache(filename, known, {'a.py': '2222'})
+    assert whodunit.read_ownership_cache(filename) == {
+        ('a.py', '2222'): {'<bob>': 4}, ('b.py', '3333'): {'<ann>': 1}}
+    tmpdir.join('cache.json').write('{"version": 0}')
+    assert whodunit.read_ownership_cache(filename) == {}
+
+
+def test_ownership_cache_keeps_earlier_revisions(tmpdir):
+    filename = str(tmpdir.join('cache.json'))
+    known = {('a.py', '1111'): {'<ann>': 3}, ('a.py', '2222'): {'<bob>': 4},
+             ('a.py', '3333'): {'<cat>': 1}}
+    whodunit.write_ownership_cache(filename, known, {'a.py': '2222'},
+                                   keep=set([('a.py', '1111')]))
+    assert sorted(whodunit.read_ownership_cache(filename)) == [
+        ('a.py', '1111'), ('a.py', '2222')]
+
+
+def test_primary_owner():
+    assert whodunit.primary_owner({'<bob>': 3, '<ann>': 3, '<cat>': 2}) == (
+        '<ann>', 0.375)
+    assert whodunit.primary_owner({}) == (None, 0.0)
+
+
+def test_owner_and_share_changes():
+    old = {'a.py': {'<ann>': 6, '<bob>': 4}, 'b.py': {'<ann>': 1},
+           'gone.py': {'<bob>': 1}}
+    new = {'a.py': {'<ann>': 4, '<bob>': 6},
+           'b.py': {'<ann>': 2, '<bob>': 1, '<cat>': 1}}
+    assert whodunit.owner_changes(old, new) == [
+        ('a.py', '<ann>', 0.6, '<bob>', 0.6)]
+    changes = whodunit.share_changes(old, new, min_change=0.1)
+    assert sorted(changes) == ['a.py', 'b.py']
+    assert [author for author, change in changes['a.py']] == ['<ann>',
+                                                              '<bob>']
+    assert changes['b.py'] == [('<ann>', -0.5), ('<bob>', 0.25),
+                               ('<cat>', 0.25)]
+
+
+def test_split_stream():
+    stream = io.BytesIO(b'one\0two\0\0three')
+    fields = list(whodunit.split_stream(stream, chunk_size=2))
+    assert fields == [b'one', b'two', b'', b'three']
+
+
+def history_commit(uuid, name, when, *changes):
+    header = '\x1e%s\x1f%s\x1f%s@example.com\x1fCommitter\x1f' \
+             'c@example.com\x1f%d\x1f2016-02-01 10:00:00 -0500\0' % (
+                 uuid * 40, name, name.lower(), when)
+    return header + '\n' + ''.join('%s\t0\t%s\0' % change
+                                    for change in changes)
+
+
+def test_reading_queries():
+    owners = whodunit.Owners('/repo')
+    stream = io.BytesIO(b'a.py\nsub/b.py:10-20,31\r\n\n/repo/c.py:7\n'
+                        b'd.py:20-12\ne:f.py\ng.py:x')
+    assert list(owners.read_queries(stream)) == [
+        ('/repo/a.py', []), ('/repo/sub/b.py', [(10, 20), (31, 31)]),
+        ('/repo/c.py', [(7, 7)]), ('/repo/d.py', [(12, 20)]),
+        ('/repo/e:f.py', []), ('/repo/g.py:x', [])]
+    stream = io.BytesIO(b'./a b.py:1-2\0c\nd.py\0')
+    assert list(owners.read_queries(stream, b'\0')) == [
+        ('/repo/a b.py', [(1, 2)]), ('/repo/c\nd.py', [])]
+
+
+def test_fail_reading_queries(dummy_file):
+    parser = whodunit.setup_parser()
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['--stdin', dummy_file])
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['--stdin', '-s', 'size', '--sample', '10',
+                                   '.'])
+
+
+def test_approximate_ownership_from_history():
+    year = 365 * 24 * 3600
+    log = (history_commit('c', 'Bob', 3 * year, ('60', 'a.py')) +
+           history_commit('b', 'Amy', 2 * year, ('10', 'a.py'),
+                          ('-', 'logo.png')) +
+           history_commit('a', 'Amy', year, ('100', 'a.py'), ('5', 'b.py')))
+    owners = whodunit.HistoryOwners('/repo', details=True)
+    owners.history_bounds = ['v1..']
+    with mock.patch.object(subprocess, 'Popen') as popen:
+        popen.return_value.stdout = io.BytesIO(log.encode('utf-8'))
+        popen.return_value.communicate.return_value = (b'', b'')
+        results = list(owners.collect_ownership(
+            [('/repo/a.py', []), ('/repo/new.py', []), ('/repo/b.py', [])]))
+    assert popen.call_args[1]['cwd'] == '/repo'
+    assert popen.call_args[0][0][-3:] == ['v1..', '--', '.']
+    assert [r.filename for r in results] == ['/repo/a.py', '/repo/new.py',
+                                             '/repo/b.py']
+    # Bob's 60 recent lines outweigh Amy's 110 older ones
+    authors, records = results[0].summary
+    assert authors == ['Bob', 'Amy']
+    assert [(r.uuid[0], r.line_count) for r in records] == [('c', 60),
+                                                            ('b', 110)]
+    assert records[1].author_mail == '<amy@example.com>'
+    assert records[1].committer_tz == '-0500'
+    assert results[1].summary == ([], [])
+    assert results[2].summary[0] == ['Amy']
+
+
+def test_report_describes_approximate_owners(capsys):
+    owners = whodunit.HistoryOwners('.')
+    report = whodunit.Report(owners)
+    report.add(whodunit.FileOwnership('a.py', None, (['Amy'], []), 0.0))
+    report.finish()
+    out, err = capsys.readouterr()
+    assert out.endswith("\n\n%s\n" % whodunit.HistoryOwners.description)
+
+
+def test_progress_status(monkeypatch):
+    sizes = {'/repo/a.py': 100, '/repo/b.py': 300, '/repo/c.py': 0}
+    monkeypatch.setattr(os.path, 'getsize', lambda name: sizes[name])
+    progress = whodunit.Progress([(name, []) for name in sorted(sizes)],
+                                 '/repo')
+    progress.start_time = 1000
+    assert progress.status(now=1000) == '0/3 files (0%), 0 lines/s'
+
+    progress.started('/repo/a.py')
+    progress.blamed('/repo/a.py')
+    progress.finished(whodunit.FileOwnership(
+        '/repo/a.py', None, ([], []), 1, {'records': 50}))
+    with mock.patch.object(whodunit.time, 'time', return_value=1001):
+        progress.started('/repo/b.py')
+    assert progress.status(now=1010) == (
+        '1/3 files (33%), 5 lines/s, ETA 0:00:30, slowest: b.py (9s)')
+
+
+def test_progress_with_collecting_ownership(monkeypatch):
+    monkeypatch.setattr(whodunit.Owners, 'blame_file',
+                        classmethod(lambda cls, f, r, t=None, b=(), root=None:
+                                    (line_one, '')))
+    monkeypatch.setattr(whodunit, 'count_file_commits',
+                        lambda root, revisions=(): {})
+    monkeypatch.setattr(os.path, 'getsize', lambda name: 10)
+    matches = [('/repo/a.py', []), ('/repo/b.py', [])]
+    stream = io.StringIO()
+    for jobs in (1, 2):
+        progress = whodunit.Progress(matches, '/repo', stream)
+        progress.begin()
+        owners = whodunit.DateOwners('/repo')
+        list(owners.collect_ownership(matches, jobs=jobs, progress=progress))
+        progress.end()
+        assert progress.in_flight == {}
+        assert progress.status().startswith('2/2 files (100%), ')
+    assert stream.getvalue().count('2/2 files (100%)') == 2
+    assert '\r' not in stream.getvalue()
+
+
+def test_stats_exclude_nested_stages(monkeypatch):
+    times = iter([(0, 0, 0), (1, 1, 0), (3, 1, 2), (10, 4, 2)])
+    monkeypatch.setattr(whodunit, 'clock', lambda: next(times))
+    stats = whodunit.Stats()
+    with stats.stage('outer'):
+        with stats.stage('inner'):
+            pass
+    assert stats.stages['inner'] == [2, 0, 2]
+    assert stats.stages['outer'] == [8, 4, 0]
+
+
+def test_commit_graph_problems():
+    state = whodunit.CommitGraphState
+    assert whodunit.commit_graph_problems(None) == []
+    assert whodunit.commit_graph_problems(state([], 0, False, False)) == [
+        'no commit-graph']
+    assert whodunit.commit_graph_problems(state(['a'], 5, False, False)) == [
+        'no changed-path Bloom filters', 'commit-graph is out of date']
+    assert whodunit.commit_graph_problems(state(['a'], 5, True, True)) == []
+
+
+def test_stats_formats(tmpdir):
+    stats = whodunit.Stats()
+    stats.add_time('blame', [1.5, 0.25, 1.0])
+    stats.count('files_blamed', 3)
+    stats.set('commit_graph_prepared', 0)
+    data = stats.as_dict()
+    assert data['stages'] == {'blame': {'wall_seconds': 1.5,
+                                        'cpu_seconds': 0.25,
+                                        'child_cpu_seconds': 1.0}}
+    assert data['counters']['files_blamed'] == 3
+    assert data['counters']['cache_hits'] == 0
+    assert data['gauges'] == {'commit_graph_prepared': 0}
+    assert set(data['total']) == set(stats.time_names)
+
+    lines = stats.as_openmetrics().splitlines()
+    assert 'whodunit_stage_wall_seconds{stage="blame"} 1.500000' in lines
+    assert '# TYPE whodunit_files_blamed counter' in lines
+    assert 'whodunit_files_blamed_total 3' in lines
+    assert 'whodunit_commit_graph_prepared 0' in lines
+    assert lines[-1] == '# EOF'
+
+    filename = str(tmpdir.join('stats.json'))
+    stats.write(filename)
+    with open(filename) as stats_file:
+        assert json.load(stats_file)['counters']['files_blamed'] == 3
+
+
+def test_concurrent_blame_is_most_costly_first(monkeypatch):
+    started = []
+
+    def blame_file(cls, filename, ranges, timeout=None, bounds=(),
+                   root=None):
+        started.append(filename)
+        return (line_two, '')
+    monkeypatch.setattr(whodunit.Owners, 'blame_file',
+                        classmethod(blame_file))
+    monkeypatch.setattr(whodunit.Owners, 'estimate_blame_costs',
+                        lambda self, matches: [10, 300, 20, 5])
+
+    owners = whodunit.SizeOwners(".")
+    matches = [('a.py', []), ('b.py', []), ('c.py', []), ('d.py', [])]
+    results = list(owners.collect_ownership(matches, jobs=2))
+    assert [r.filename for r in results] == ['a.py', 'b.py', 'c.py', 'd.py']
+    assert set(started[:2]) == set(['b.py', 'c.py'])
+    assert set(started[2:]) == set(['a.py', 'd.py'])
+
+
+@pytest.mark.parametrize('processes, jobs', [(0, 2), (1, 1), (1, 3)])
+def test_streaming_provides_results_as_queries_arrive(monkeypatch, processes,
+                                                      jobs):
+    def blame_file(cls, filename, ranges, timeout=None, bounds=(),
+                   root=None):
+        return (line_two, '')
+    monkeypatch.setattr(whodunit.Owners, 'blame_file',
+                        classmethod(blame_file))
+    answered = whodunit.threading.Event()
+
+    def queries():
+        yield ('a.py', [])
+        # Like a caller waiting for the answer, before asking more
+        assert answered.wait(5)
+        yield ('b.py', [])
+
+    owners = whodunit.SizeOwners(".")
+    owners.streaming = True
+    results = owners.collect_ownership(queries(), processes, jobs)
+    assert next(results).filename == 'a.py'
+    answered.set()
+    assert [r.filename for r in results] == ['b.py']
+
+
+def test_fail_progress_when_reading_queries(fake_project):
+    parser = whodunit.setup_parser()
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['--stdin', '--progress', fake_project])
+
+
+def test_estimate_blame_costs(monkeypatch):
+    monkeypatch.setattr(whodunit, 'count_file_commits',
+                        lambda root, revisions: {'/repo/a.py': 4})
+    monkeypatch.setattr(os.path, 'getsize', lambda name: 100)
+    owners = whodunit.SizeOwners("/repo")
+    costs = owners.estimate_blame_costs([('/repo/a.py', []),
+                                         ('/repo/b.py', [])])
+    assert costs == [500, 100]
+
+
+def test_plan_ownership(fake_project, monkeypatch):
+    big, small = [os.path.join(fake_project, 'pkg', name)
+                  for name in ('big.py', 'small.py')]
+    os.mkdir(os.path.dirname(big))
+    for name, lines in ((big, 1000), (small, 10)):
+        with open(name, 'w') as source:
+            source.write('x = 1\n' * lines)
+    monkeypatch.setattr(whodunit, 'count_file_commits',
+                        lambda root, revisions: {big: 3, small: 1})
+    owners = whodunit.SizeOwners(fake_project)
+    args = argparse.Namespace(sample=None, sample_files=None, slowest=1,
+                              jobs=2)
+    plan = io.StringIO()
+    whodunit.plan_ownership(owners, [(big, [(1, 100)]), (small, [])], args,
+                            ['no commit-graph'], plan)
+    lines = plan.getvalue().splitlines()
+    assert lines[2] == '    Files to blame:        2 (0 skipped)'
+    assert lines[3] == '    Lines to blame:        110 of 1010'
+    assert lines[5] == '    Commits per file:      median 3, most 3'
+    assert ', with 2 jobs ' in lines[6]
+    assert 'no commit-graph' in lines[7]
+    assert lines[-1].endswith(' 100 lines      3 commits pkg/big.py')
+    assert lines[-5].endswith('100% pkg')
+    args.jobs = 1
+    plan = io.StringIO()
+    whodunit.plan_ownership(owners, [(big, [(1, 100)])], args, [], plan)
+    assert ', with 1 job ' in plan.getvalue()
+
+
+def test_split_ranges():
+    assert whodunit.split_ranges([(1, 10)], 4) == [[(1, 4)], [(5, 8)],
+                                                   [(9, 10)]]
+    assert whodunit.split_ranges([(2, 3), (7, 9), (12, 12)], 3) == [
+        [(2, 3), (7, 7)], [(8, 9), (12, 12)]]
+
+
+def test_compact_porcelain():
+    output = (line_one + line_three).encode()
+    seen = set()
+    compacted = whodunit.compact_porcelain(output, seen)
+    assert compacted.decode() == '\n'.join(
+        line_one.splitlines()[:-1] + ['\t', line_three.splitlines()[0], ''])
+    assert seen == set([b'6e3b3aec8a73da4129e83554ad5ac2f43d4ec775'])
+    assert whodunit.compact_porcelain(line_three.encode(), seen) == (
+        line_three.splitlines()[0] + '\n').encode()
+    full = whodunit.compact_porcelain(output, set(), full_records=True)
+    assert full.count(b'author-mail') == 2
+
+    owners = whodunit.SizeOwners('.')
+    commits = owners.parse_info_records(compacted)
+    assert [(c.author, c.line_count) for c in commits] == [
+        ('Carol Coverage', 2)]
+
+
+def test_windows_within_memory_cap(fake_project):
+    name = os.path.join(fake_project, 'big.py')
+    with open(name, 'w') as source:
+        source.write('x = 1\n' * 1000)
+    owners = whodunit.SizeOwners(fake_project)
+    assert owners.line_windows(name, []) is None
+    owners.window = 1000
+    assert owners.line_windows(name, []) is None
+    owners.window, owners.window_jobs = 300, 2
+    windows, at_once = owners.line_windows(name, [])
+    assert windows == [[(1, 300)], [(301, 600)], [(601, 900)], [(901, 1000)]]
+    assert at_once == 2
+    assert owners.line_windows(name, [(1, 10), (500, 520)]) is None
+    owners.window_memory = 200 * (whodunit.porcelain_line_bytes + 6)
+    windows, at_once = owners.line_windows(name, [])
+    assert len(windows) == 5 and at_once == 1
+
+
+def test_fail_negative_window():
+    parser = whodunit.setup_parser()
+    with pytest.raises(SystemExit):
+        whodunit.validate(parser, ['--window', '-5', '.'])
+    args = whodunit.validate(parser, ['--window', '0', '.'])
+    assert args.window == 0
+
+
+def test_blaming_in_windows(monkeypatch):
+    blamed = []
+
+    def blame_file(cls, filename, ranges, timeout=None, bounds=(),
+                   root=None):
+        blamed.append(ranges)
+        if ranges[0][0] == 1:
+            return (line_one.encode(), '')
+        return (line_three.encode(), '')
+    monkeypatch.setattr(whodunit.Owners, 'blame_file',
+                        classmethod(blame_file))
+    owners = whodunit.SizeOwners('.')
+    out, err = owners.blame_in_windows('a.py', [[(1, 1)], [(2, 2)]], 2)
+    assert sorted(blamed) == [[(1, 1)], [(2, 2)]]
+    assert out.count(b'author-mail') == 1
+    assert [c.line_count for c in owners.parse_info_records(out)] == [2]
+
+
+def test_mailmap_resolves_each_identity_once():
+    mailmap = whodunit.Mailmap('/repo')
+    mailmap.batch_size = 2
+    process = mock.MagicMock()
+    process.stdout = io.BytesIO(b'Carol <carol@work.com>\n'
+                                b'Carol <carol@work.com>\n'
+                                b'Rich <richard@cover.net>\n')
+    with mock.patch.object(subprocess, 'Popen',
+                           return_value=process) as popen:
+        mailmap.resolve([('Carol', '<carol@home.org>'),
+                         ('Carol C', '<carol@work.com>'),
+                         ('Rich', '<richard@cover.net>'),
+                         ('Carol', '<carol@home.org>')])
+        mailmap.resolve([('Rich', '<richard@cover.net>')])
+    assert popen.call_count == 1
+    assert popen.call_args[0][0] == ['git', 'check-mailmap', '--stdin']
+    assert [c[0][0] for c in process.stdin.write.call_args_list] == [
+        b'Carol <carol@home.org>\nCarol C <carol@work.com>\n',
+        b'Rich <richard@cover.net>\n']
+    assert mailmap.identities[('Carol', '<carol@home.org>')] == (
+        'Carol', '<carol@work.com>')
+
+
+def test_mailmap_leaves_identities_if_git_fails():
+    mailmap = whodunit.Mailmap('/repo')
+    process = mock.MagicMock()
+    process.stdout = io.BytesIO(b'')
+    with mock.patch.object(subprocess, 'Popen', return_value=process):
+        mailmap.resolve([('Carol', '<carol@home.org>'), ('Rich', 'bad')])
+    assert mailmap.identities == {('Carol', '<carol@home.org>'):
+                                  ('Carol', '<carol@home.org>'),
+                                  ('Rich', 'bad'): ('Rich', 'bad')}
+    assert mailmap.process is False
+
+
+def test_rank_merges_mapped_authors():
+    owners = whodunit.SizeOwners('/repo')
+    owners.details = True
+    owners.mailmap = whodunit.Mailmap('/repo')
+    owners.mailmap.identities = {
+        ('Carol Coverage', '<carolb@example.com>'):
+        ('Carol Coverage', '<carolb@example.com>'),
+        ('Rich Rocket', '<richard@cover.net>'):
+        ('Carol Coverage', '<carolb@example.com>')}
+    blame = whodunit.BlameOutput('/repo/a.py', line_one + line_two, '', 1)
+    result = owners.rank_blame(blame)
+    assert [(r.author_mail, r.line_count) for r in result.summary[1]] == [
+        ('<carolb@example.com>', 2)]
+
+    # Files of other repositories are mapped with their own mailmap
+    owners.other_roots = ['/repo/sub', '/other']
+    owners.other_mailmaps = {'/other': whodunit.Mailmap('/other')}
+    assert owners.mailmap_for('/repo/b.py') is owners.mailmap
+    assert owners.mailmap_for('/repo/sub/b.py') is None
+    assert owners.mailmap_for('/other/b.py') is owners.other_mailmaps[
+        '/other']
+    result = owners.rank_blame(blame._replace(filename='/repo/sub/a.py'))
+    assert len(result.summary[1]) == 2
+
+
+def test_ownership_cache_keeps_identities(fake_project, monkeypatch):
+    monkeypatch.setattr(whodunit.Mailmap, 'fingerprint', lambda self: 'f1')
+    mailmap = whodunit.Mailmap(fake_project)
+    mailmap.identities = {('A', '<a@home>'): ('A', '<a@work>')}
+    cache_file = os.path.join(fake_project, 'cache.json')
+    known = {('a.py', 'b1'): {'<a@work>': 3}}
+    whodunit.write_ownership_cache(cache_file, known, {}, mailmap)
+    mailmap = whodunit.Mailmap(fake_project)
+    assert whodunit.read_ownership_cache(cache_file, mailmap) == known
+    assert mailmap.identities == {('A', '<a@home>'): ('A', '<a@work>')}
+    monkeypatch.setattr(whodunit.Mailmap, 'fingerprint', lambda self: 'f2')
+    assert whodunit.read_ownership_cache(cache_file, mailmap) == {}
+
+
+def test_count_file_commits():
+    log = mock.MagicMock()
+    log.stdout = io.BytesIO(b'a.py\0sub/b.py\0\0a.py\0'
+                            b'sub/caf\xc3\xa9 \\ \t.py\0')
+    with mock.patch.object(subprocess, 'Popen', return_value=log) as popen:
+        counts = whodunit.count_file_commits('/repo')
+    assert counts == {'/repo/a.py': 2, '/repo/sub/b.py': 1,
+                      '/repo/sub/caf\xe9 \\ \t.py': 1}
+    assert popen.call_args[1]['cwd'] == '/repo'
+    assert '-z' in popen.call_args[0][0]
+
+
+def test_blame_timeout_skips_file():
+    with mock.patch.object(subprocess, 'Popen', create=True) as popen:
+        def hang():
+            killed.wait(5)
+            return ('partial', '')
+        killed = whodunit.threading.Event()
+        popen.return_value.communicate.side_effect = hang
+        popen.return_value.kill.side_effect = killed.set
+        out, err = whodunit.Owners.blame_file('a.py', [], timeout=0.01)
+    assert out == ''
+    assert err == 'timed out after 0.01 seconds, skipped'
+
+
+def test_report(capsys):
+    owners = whodunit.DateOwners(".", details=True)
+    record = create_commit({'uuid': '11111111'}).as_summary()
+    report = whodunit.Report(owners, slowest=2)
+    report.add(whodunit.FileOwnership('path/a.py', None,
+                                      (['Joe Dirt'], [record]), 0.5))
+    report.add(whodunit.FileOwnership('path/b.py', "blame fail", None, 3))
+    report.add(whodunit.FileOwnership('c.py', None, (['Patty Python'], []),
+                                      1.25))
+    report.finish()
+    out, err = capsys.readouterr()
+    expected = """
+
+path/
+
+a.py (Joe Dirt)
+    11111111    10 Joe Dirt                  2016-02-01
+b.py  <<<<<<<<<< Unable to collect 'git blame' info: blame fail
+
+
+./
+
+c.py (Patty Python)
+
+
+All authors: Joe Dirt, Patty Python
+
+
+Slowest files:
+
+        3.00s path/b.py
+        1.25s c.py
+"""
+    assert out == expected
+
+
+def test_check_attributes():
+    output = ('a.png\0binary\0set\0a.png\0linguist-generated\0unspecified\0'
+              'a.png\0linguist-vendored\0unspecified\0'
+              'lib/b.js\0binary\0unspecified\0'
+              'lib/b.js\0linguist-generated\0true\0'
+              'lib/b.js\0linguist-vendored\0unspecified\0')
+    owners = whodunit.Owners('/repo')
+    with mock.patch.object(subprocess, 'Popen', create=True) as popen:
+        popen.return_value.communicate.return_value = (output.encode(), b'')
+        popen.return_value.returncode = 0
+        attributes = owners.check_attributes(['/repo/a.png',
+                                              '/repo/lib/b.js'])
+    assert attributes == [
+        {'binary': 'set', 'linguist-generated': 'unspecified',
+         'linguist-vendored': 'unspecified'},
+        {'binary': 'unspecified', 'linguist-generated': 'true',
+         'linguist-vendored': 'unspecified'}]
+    assert popen.call_count == 1
+    popen.return_value.communicate.assert_called_once_with(
+        b'a.png\0lib/b.js\0')
+
+
+def test_unblameable_files(fake_project):
+    def make_file(name, content):
+        path = os.path.join(fake_project, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    owners = whodunit.Owners(fake_project)
+    source = make_file('a.py', b'import os\n' * 100)
+    assert owners.unblameable_reason(source, {}) is None
+    assert owners.unblameable_reason(source, {}, max_size=100) == 'too large'
+    assert owners.unblameable_reason(
+        source, {'linguist-vendored': 'set'}) == 'vendored'
+    image = make_file('a.png', b'\x89PNG\r\n\x1a\n\0\0\0\rIHDR')
+    assert owners.unblameable_reason(image, {}) == 'binary'
+    minified = make_file('app.js', b'var a=1;' * 1000)
+    assert owners.unblameable_reason(minified, {}) == 'minified'
+    lock = make_file('yarn.lock', b'# yarn lockfile v1\n')
+    assert owners.unblameable_reason(lock, {}) == 'generated'
+
+
+def test_excluding_unblameable(monkeypatch, capsys):
+    owners = whodunit.SizeOwners('/repo')
+    monkeypatch.setattr(owners, 'check_attributes',
+                        lambda names: [{}, {'binary': 'set'}, {}])
+    monkeypatch.setattr(owners, 'unblameable_reason',
+                        lambda name, attrs, max_size: attrs.get('binary'))
+    matches = [('/repo/a.py', []), ('/repo/b.png', []), ('/repo/c.py', [])]
+    kept = list(owners.exclude_unblameable(matches))
+    assert kept == [('/repo/a.py', []), ('/repo/c.py', [])]
+    assert owners.skipped == [('/repo/b.png', 'set')]
+
+    whodunit.Report(owners).finish()
+    out, err = capsys.readouterr()
+    assert out.endswith("\n\nSkipped 1 files: set (1)\n")
+
+
+def test_shards_partition_files():
+    owners = whodunit.Owners('/repo')
+    matches = [('/repo/dir%d/file%d.py' % (i % 7, i), []) for i in range(300)]
+    shards = [list(owners.select_shard(matches, (i, 3))) for i in (1, 2, 3)]
+    assert sorted(sum(shards, [])) == sorted(matches)
+    assert all(70 < len(shard) < 130 for shard in shards)
+    # Assignment only depends on the path relative to the root
+    other = whodunit.Owners('/elsewhere/repo')
+    moved = [('/elsewhere' + f, r) for f, r in shards[1]]
+    assert list(other.select_shard(moved, (2, 3))) == moved
+
+
+def test_parsing_shard_option():
+    parser = whodunit.setup_parser()
+    args = parser.parse_args(['--shard', '2/4', 'dummy-file'])
+    assert args.shard == (2, 4)
+    for bad_shard in ('0/4', '5/4', '2', 'a/b'):
+        with pytest.raises(SystemExit):
+            parser.parse_args(['--shard', bad_shard, 'dummy-file'])
+
+
+def test_saving_and_merging_results(fake_project, capsys):
+    owners = whodunit.SizeOwners('/repo', details=True, max_match=1)
+    owners.keep_records = True
+    owners.skipped = [('/repo/logo.png', 'binary')]
+    carl = create_commit({'uuid': '22222222', 'author': 'Carl Coder'})
+    joe = create_commit({'uuid': '11111111'})
+    args = whodunit.setup_parser().parse_args(
+        ['-s', 'size', '--shard', '1/2', '/repo'])
+    shard1 = os.path.join(fake_project, 'shard1.json')
+    whodunit.write_results(shard1, owners, args, [
+        whodunit.FileOwnership('/repo/sub/b.py', None,
+                               (['Carl Coder'], [carl.as_summary(),
+                                                 joe.as_summary()]), 1.5)])
+    owners.skipped = []
+    shard2 = os.path.join(fake_project, 'shard2.json')
+    whodunit.write_results(shard2, owners, args, [
+        whodunit.FileOwnership('/repo/a.py', None,
+                               (['Joe Dirt'], [joe.as_summary()]), 0.5),
+        whodunit.FileOwnership('/repo/sub/c.py', 'blame fail', None, 0.1)])
+
+    results = whodunit.read_results(shard1)
+    assert results['sort_by'] == 'size'
+    assert results['shard'] == [1, 2]
+    assert results['files'][0].summary[1][1] == joe.as_summary()
+
+    whodunit.main(['merge', shard1, shard2])
+    out, err = capsys.readouterr()
+    expected = """
+
+/repo/
+
+a.py (Joe Dirt)
+    11111111    10 Joe Dirt                  2016-02-01
+
+
+/repo/sub/
+
+b.py (Carl Coder)
+    22222222    10 Carl Coder                2016-02-01
+c.py  <<<<<<<<<< Unable to collect 'git blame' info: blame fail
+
+
+All authors: Carl Coder, Joe Dirt
+
+
+Skipped 1 files: binary (1)
+"""
+    assert out == expected
+
+
+def test_fail_merging_different_sorts(fake_project):
+    args = whodunit.setup_parser().parse_args(['/repo'])
+    names = []
+    for sort_by in ('date', 'size'):
+        args.sort_by = sort_by
+        names.append(os.path.join(fake_project, sort_by + '.json'))
+        whodunit.write_results(names[-1], whodunit.Owners('/repo'), args, [])
+    with pytest.raises(SystemExit) as excinfo:
+        whodunit.main(['merge'] + names)
+    assert str(excinfo.value) == '2'
+
+
+def test_optional_modules_imported_when_needed():
+    check = ("import sys, whodunit; "
+             "print('numpy' in sys.modules, 'coverage' in sys.modules)")
+    out = subprocess.check_output([sys.executable, '-c', check],
+                                  cwd=os.path.dirname(os.path.dirname(
+                                      os.path.abspath(__file__))))
+    assert out.split() == [b'False', b'False']
+    assert whodunit.optional_module('no_such_module_here') is None
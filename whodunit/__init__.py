@@ -23,7 +23,8 @@
 # of lines for a commiter, per commit.
 #
 # Usage:
-#    whodunit.py [-h] [-d] [-v] [-m] [-f] [-s {date,size,cover}] file-or-dir
+#    whodunit.py [-h] [-d] [-v] [-m] [-f] [-s {date,size,history,cover}]
+#                file-or-dir
 # Where:
 # -h, --help            show this help message and exit.
 # -d, --details         Show individual commit/user details.
@@ -31,8 +32,87 @@
 # -m, --max             Maximum number of users/commits to show. Default=0
 #                       (show all).
 # -f, --filter          Filter regex for filename. Default='*'
-# -s {date,size,cover}, --sort {date,size,cover} Sort order for report.
-#                       Default='date'.
+# -s {date,size,history,cover}, --sort {date,size,history,cover} Sort order
+#                       for report. Default='date'.
+# --include, --exclude  Glob for paths (relative to the directory) to process
+#                       or skip. Can be repeated. '**' matches directories.
+# -p, --processes       Number of worker processes used to parse and rank
+#                       blame output. Default=0 (done in-process).
+# -j, --jobs            Number of git blame commands to run concurrently.
+#                       Default=1.
+# --timeout             Skip any file, where git blame takes longer than this
+#                       many seconds.
+# --slowest             Show the N slowest files at the end. Default=0.
+# --sample              Estimate ownership by size, from blaming a random
+#                       sample of about this many lines of each file.
+# --sample-files        Only blame this many files (at random) in each
+#                       directory, when sorting by size.
+# --shard i/N           Only process the i-th of N (stable) shards of files.
+# --results             Save results in JSON to a file, for merging.
+# --npz                 Save the ownership of every blamed line, as columns of
+#                       NumPy arrays (runs of lines, with their file, commit,
+#                       author, and date), to a .npz file.
+# --symbols             Also show owners of each top-level class and function
+#                       in Python files, from the same git blame.
+# --stdin, -z           Read paths, with optional line ranges (path:10-20,31)
+#                       or a symbol (path::Class.method), from stdin (NUL
+#                       separated with -z). Results are shown as each query is
+#                       done.
+# --no-mailmap          Don't map authors with several identities to one,
+#                       using the repository's .mailmap.
+# --plan                Show the estimated cost of a run, and the most costly
+#                       files and directories, without running git blame.
+# --progress            Show progress and an estimated time remaining on
+#                       stderr.
+# --stats               Save the time taken by each stage (enumerate, classify,
+#                       blame, parse, sort, report), and counts of files and
+#                       records, to a file.
+# --stats-format        Format of the stats file, json or openmetrics.
+#                       Default='json'.
+# --profile             Save cProfile data for the run to a file.
+# --since, --since-rev Only look at history since a date, or after a revision.
+#                       Older lines are grouped as from before the cutoff.
+# --rev                 Report on the files in a revision, from git's objects
+#                       alone (no working tree is needed).
+# --recurse-submodules  Also process files in checked out submodules.
+# --all-files           Don't skip binary, generated, and vendored files.
+# --coverage-data       coverage.py data file to use when sorting by cover,
+#                       instead of HTML reports in the cover directory.
+# --max-size            Skip files larger than this many bytes. Default=0
+#                       (no limit).
+# --window              Blame files with more lines than this in windows (of
+#                       this many lines), merging the results. Default=0.
+# --window-jobs         Number of windows of a file to blame at once.
+# --window-memory       Cap (in MB) on the blame output held at once, for the
+#                       windows of a file. Default=256.
+#
+# Saved results (e.g. from each shard) can be combined into one report with:
+#    whodunit.py merge [--slowest N] results-file [results-file ...]
+#
+# The share of lines owned by each author, at several revisions (e.g. release
+# tags), is shown by (only files that changed are blamed at each revision):
+#    whodunit.py timeline [--include GLOB] [--exclude GLOB] [-j N]
+#                         [--json FILE] dir rev [rev ...]
+#
+# A CODEOWNERS file, with the authors owning the most lines in each directory,
+# is written by (results for each file are cached, so that only files that
+# have changed are blamed the next time):
+#    whodunit.py codeowners [--rev REV] [--threshold SHARE] [--max-owners N]
+#                           [-o FILE] [dir]
+#
+# The files and directories with a new primary owner (the author with the
+# most lines), and the changes in each author's share of the lines in each
+# directory, between two revisions are shown by (sharing the cache with
+# codeowners, so only files without results are blamed):
+#    whodunit.py diff [--min-change SHARE] [--json FILE] dir old-rev new-rev
+#
+# Git blame is much faster, when the repository has a commit-graph with
+# changed-path Bloom filters. Runs will warn if it is missing or out of date,
+# and it can be written (or just checked) with:
+#    whodunit.py prepare [--check] [dir]
+#
+# Instead of a file, a class or function in a Python file can be given, as
+# path/to/mod.py::Class.method, and only its lines will be blamed.
 #
 # Output will have file path and name, and then committers, in priority order
 # as selected by the options (date/size).
@@ -46,13 +126,21 @@
 # most recent date will be shown first, along with the number of lines for
 # that commit.
 #
+# Sorting by history is a fast approximation, which doesn't run git blame.
+# It uses one git log for the tree, and ranks authors by the lines they have
+# added to each file, weighted towards recent commits. The line count shown
+# is the number of lines the author added.
+#
 # If the --verbose option is selected, then the author's email address,
 # commiter's name, and commiter's email are also shown. The time and time-
 # zone will be shown for the commit date.
 #
 # In the case of sorting by cover, you must specify a directory (at the root
 # of the project tree) with coverage HTML files to process. You cannot specify
-# the --max' option, and detailed output is assumed.
+# the --max' option, and detailed output is assumed. Instead of the HTML
+# files, coverage.py's data file can be read directly (with --coverage-data,
+# or .coverage at the root, if there is no cover directory), so there is no
+# need to run 'coverage html' first.
 #
 # The output will show the lines from  modules in the report that are flagged
 # as missing coverage or partial coverage. The commit ID, line number,
@@ -62,18 +150,47 @@
 from __future__ import print_function
 
 import argparse
+import ast
+import binascii
+import bisect
+import collections
+import contextlib
+import copy
+import cProfile
 import datetime
 import fnmatch
+import hashlib
 import itertools
+import heapq
+import importlib
+import json
+import math
+import multiprocessing
+import multiprocessing.pool
 import operator
 import os
+import posixpath
+import queue
+import random
 import re
+import sqlite3
+import struct
 import subprocess
+import sys
+import threading
+import time
+import zlib
 
+# NumPy (for ownership tables) is slow to import, so is only imported when
+# a table is made (see optional_module), as is coverage.py
+numpy = None
 
 uuid_line_re = re.compile(r'([a-f0-9]{40})\s+\d+\s+(\d+)')
+blamed_line_re = re.compile(r'^([a-f0-9]{40}) \d+ (\d+)', re.MULTILINE)
 code_line_re = re.compile(r'\s')
 attr_line_re = re.compile(r'(\S+)\s(.+)')
+line_ranges_re = re.compile(r'\d+(-\d+)?(,\d+(-\d+)?)*$')
+identity_re = re.compile(r'(.*?) ?(<[^<>\n]*>)$')
 
 title_re = re.compile(r'\s*<title>Coverage for ([^:]+):\s+(\d+)%<\/title>')
 source_re = re.compile(r'<p id="n(\d+)" class="stm (mis|par)')
@@ -81,6 +198,116 @@ end_re = re.compile(r'\s*<td class="text">')
 
 __version__ = "0.3"
 
+# Compact, picklable form of a sorted commit, which is all that is needed to
+# report on a file. Used to pass results back from worker processes.
+SummaryRecord = collections.namedtuple(
+    'SummaryRecord', ['uuid', 'line_count', 'lines', 'author', 'author_mail',
+                      'committer', 'committer_mail', 'committer_time',
+                      'committer_tz'])
+
+
+# Commit-graph files of a repository, the number of commits in them, and
+# whether they have changed-path Bloom filters and include HEAD.
+CommitGraphState = collections.namedtuple(
+    'CommitGraphState', ['files', 'commits', 'changed_paths', 'covers_head'])
+
+# Output of git blame for a file, and the time taken to get it.
+BlameOutput = collections.namedtuple(
+    'BlameOutput', ['filename', 'output', 'error', 'elapsed'])
+
+# Ranked ownership for a file (summary is None, if there is an error), the
+# cost of parsing and sorting the blame output (see Stats.add_result), and
+# the (symbol, summary) for each top-level symbol, if ranked by symbol. With
+# an ownership table, the parsed records to add to it are in table_rows.
+FileOwnership = collections.namedtuple(
+    'FileOwnership', ['filename', 'error', 'summary', 'elapsed', 'stats',
+                      'symbols', 'table_rows'])
+FileOwnership.__new__.__defaults__ = (None, None, None)
+
+# Separates a file from a symbol in it (e.g. 'a.py::Class.method')
+symbol_separator = '::'
+
+
+def glob_to_regex(pattern):
+    """Translate a path glob into a regular expression.
+
+    A '*' or '?' will not match a '/', but '**' will match across
+    directories. A pattern without a '/' can match at any depth.
+    """
+    if '/' not in pattern.rstrip('/'):
+        pattern = '**/' + pattern
+    pattern = pattern.rstrip('/')
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            parts.append('[%s]' % chars.replace('\\', '\\\\'))
+            i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(parts)
+
+
+class PathMatcher(object):
+    """Selects relative paths, using include and exclude globs.
+
+    A path is selected, if it (or a directory containing it) matches any of
+    the include patterns (all paths, if none), and does not match any of the
+    exclude patterns. All patterns are combined into one regex for each.
+    """
+
+    def __init__(self, includes=None, excludes=None):
+        self.includes = includes or []
+        self.excludes = excludes or []
+        self.include_re = self.compile(self.includes)
+        self.exclude_re = self.compile(self.excludes)
+
+    @classmethod
+    def compile(cls, patterns):
+        if not patterns:
+            return None
+        return re.compile(r'(?:%s)(?:/.*)?\Z' % '|'.join(
+            glob_to_regex(p) for p in patterns))
+
+    def match(self, path):
+        if self.include_re and not self.include_re.match(path):
+            return False
+        return not (self.exclude_re and self.exclude_re.match(path))
+
+    def pathspecs(self):
+        """Git pathspecs, which select (at least) all the matching files."""
+        specs = []
+        for magic, patterns in (('glob', self.includes),
+                                ('exclude,glob', self.excludes)):
+            for pattern in patterns:
+                if '/' not in pattern.rstrip('/'):
+                    pattern = '**/' + pattern
+                pattern = pattern.rstrip('/')
+                specs.append(':(%s)%s' % (magic, pattern))
+                if not pattern.endswith('**'):
+                    specs.append(':(%s)%s/**' % (magic, pattern))
+        if not self.includes:
+            specs.insert(0, '.')
+        return specs
+
+
 class BadRecordException(Exception):
     pass
 
@@ -89,6 +316,33 @@ class SourceNotFound(Exception):
     pass
 
 
+def to_text(data):
+    """Decode git output, which is bytes under Python 3."""
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data
+
+
+if hasattr(time, 'thread_time'):
+    thread_cpu_time = time.thread_time
+else:  # Older Python, so use the CPU time of the whole process
+    def thread_cpu_time():
+        return sum(os.times()[:2])
+
+
+def clock():
+    """Wall time, CPU time of this thread, and CPU time of child processes.
+
+    Child process CPU time only includes processes that have been waited on.
+    """
+    times = os.times()
+    return (time.time(), thread_cpu_time(), times[2] + times[3])
+
+
+def time_since(start):
+    return [now - then for then, now in zip(start, clock())]
+
+
 def date_to_str(time_stamp, time_zone, verbose=True):
     date_time = datetime.datetime.utcfromtimestamp(time_stamp)
     offset_hrs = int(time_zone)/100
@@ -103,6 +357,11 @@ def date_to_str(time_stamp, time_zone, verbose=True):
 
 class BlameRecord(object):
 
+    # Set for lines from the boundary commit, when history is limited
+    boundary = False
+    boundary_author = 'Before cutoff'
+    boundary_mail = '<before-cutoff>'
+
     def __init__(self, uuid, line_number):
         self.uuid = uuid
         self.line_number = line_number
@@ -135,7 +394,26 @@ class BlameRecord(object):
         """For test comparision."""
         return self.author_mail == other.author_mail
 
+    def make_boundary_bucket(self):
+        """Lines from before the history cutoff are not credited to anyone.
+
+        Git blames them on the commit it stopped at, which may not be the one
+        that last changed them, so they all go in one bucket, marked with a
+        '^' like git does. Git may not provide all the commit info for them.
+        """
+        self.uuid = '^' + self.uuid[:39]
+        self.author = self.committer = self.boundary_author
+        self.author_mail = self.committer_mail = self.boundary_mail
+        for attribute, default in (('author_time', 0), ('author_tz', '+0000'),
+                                   ('committer_time', 0),
+                                   ('committer_tz', '+0000')):
+            if not hasattr(self, attribute):
+                setattr(self, attribute, default)
+
     def validate(self):
+        if self.boundary:
+            self.make_boundary_bucket()
+            return
         if not hasattr(self, 'author_time') or not hasattr(self, 'author_tz'):
             raise BadRecordException("Missing author time information")
         if (not hasattr(self, 'committer_time') or
@@ -160,78 +438,675 @@ class BlameRecord(object):
                                        self.line_count, self.author,
                                        self.author_mail, self.line_number)
 
+    def as_summary(self):
+        return SummaryRecord(self.uuid, self.line_count,
+                             getattr(self, 'lines', None), self.author,
+                             self.author_mail, self.committer,
+                             self.committer_mail, self.committer_time,
+                             self.committer_tz)
+
 
 class Owners(object):
 
+    # Shown at the end of the report, to explain how owners were found
+    description = None
+    # Whether any of the parsed lines are from before the history cutoff
+    has_boundary = False
+
+    # Whether each blamed line needs the full details of its commit
+    full_records = False
+
+    # Attributes (from .gitattributes) marking files not worth blaming
+    skip_attributes = ['binary', 'linguist-generated', 'linguist-vendored']
+    # Files that are generated, but typically not marked as such
+    generated_patterns = ['*.min.js', '*.min.css', '*.map',
+                          'package-lock.json', 'yarn.lock', 'pnpm-lock.yaml',
+                          'Cargo.lock', 'Gemfile.lock', 'composer.lock',
+                          'poetry.lock', 'Pipfile.lock', 'go.sum']
+    sniff_size = 8000  # Same amount git checks, when looking for binary
+    minified_line_length = 500
+
     def __init__(self, root, filter="*", details=False,
-                 verbose=False, max_match=0):
+                 verbose=False, max_match=0, includes=None, excludes=None):
         self.root = os.path.abspath(root)
         self.filter = filter
+        self.matcher = PathMatcher(includes, excludes)
         self.details = details
         self.verbose = verbose
         self.max_match = max_match
-
-    @classmethod
-    def is_git_file(cls, path, name):
-        """Determine if file is known by git."""
-        os.chdir(path)
-        p = subprocess.Popen(['git', 'ls-files', '--error-unmatch', name],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.wait()
-        return p.returncode == 0
+        self.skipped = []
+        self.keep_records = False
+        self.history_bounds = []
+        self.revision = None  # Look at this commit, not the working tree
+        self.tree_dir = ''  # Directory of the revision's tree (from root)
+        self.tree_prefix = None  # Path of root in the tree, when needed
+        self.blob_sizes = None
+        self.blob_ids = None
+        self.by_symbol = False
+        self.symbol_cache = {}  # Symbols in Python source, by blob id
+        self.table = None  # OwnershipTable, to add all blamed lines to
+        self.other_roots = []  # Repositories processed along with this one
+        self.streaming = False  # Matches arrive over time (e.g. from stdin)
+        self.window = 0  # Blame more lines than this in windows of them
+        self.window_jobs = 1
+        self.window_memory = 256 * 1024 * 1024  # Blame output, in bytes
+        self.mailmap = None  # Mailmap of root, if it has one
+        self.use_mailmap = True  # Whether identities are to be mapped at all
+        self.other_mailmaps = {}  # Mailmap of each other root with one
+
+    def select_shard(self, matches, shard):
+        """Generator for the files that are part of the shard.
+
+        The shard is a (index, count) tuple, where the index is one based.
+        Files are assigned using a stable hash of their path relative to the
+        root, so that each run and machine will agree on the assignment.
+        """
+        index, count = shard
+        for filename, ranges in matches:
+            path = os.path.relpath(filename, self.root).encode('utf-8')
+            if (zlib.crc32(path) & 0xffffffff) % count == index - 1:
+                yield (filename, ranges)
+
+    def list_tracked_files(self, pathspecs):
+        """Paths, relative to root, of files under root known by git."""
+        command = ['git', 'ls-files', '-z', '--'] + pathspecs
+        p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, cwd=self.root)
+        out, err = p.communicate()
+        return [name for name in to_text(out).split('\0') if name]
+
+    def list_tree_files(self):
+        """Paths, relative to root, of files in the revision's tree.
+
+        Uses the tree object, so no working tree is needed (e.g. in a bare
+        repository). The size and blob id of each file are kept in
+        blob_sizes and blob_ids.
+        """
+        command = ['git', 'ls-tree', '-r', '-z', '-l', self.revision]
+        if self.tree_dir:
+            command += ['--', self.tree_dir]
+        p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, cwd=self.root)
+        self.blob_sizes = {}
+        self.blob_ids = {}
+        names = []
+        for entry in split_stream(p.stdout):
+            info, name = to_text(entry).split('\t', 1)
+            mode, kind, oid, size = info.split()
+            if kind == 'blob':  # Skips submodules
+                names.append(name)
+                path = os.path.join(self.root, name)
+                self.blob_sizes[path] = int(size)
+                self.blob_ids[path] = oid
+        p.communicate()
+        return names
 
     def collect_modules(self):
-        """Generator to look for git files in tree. Will handle all lines."""
-        for path, dirlist, filelist in os.walk(self.root):
-            for name in fnmatch.filter(filelist, self.filter):
-                if self.is_git_file(path, name):
-                    yield (os.path.join(path, name), [])
+        """Generator to look for git files in tree. Will handle all lines.
+
+        Include and exclude patterns are given to git, so that excluded
+        areas are not listed, but the final selection is always done here.
+        Files are grouped by directory. With a revision, the files are
+        listed from its tree, instead of the working tree.
+        """
+        if self.revision:
+            tracked = self.list_tree_files()
+        else:
+            tracked = self.list_tracked_files(self.matcher.pathspecs())
+        names = [name for name in tracked
+                 if fnmatch.fnmatch(os.path.basename(name), self.filter) and
+                 self.matcher.match(name)]
+        for name in sorted(names, key=os.path.split):
+            path = os.path.join(self.root, name)
+            # Skips submodules and deleted files
+            if self.revision or os.path.isfile(path):
+                yield (path, [])
+
+    def read_queries(self, stream, separator=b'\n'):
+        """Generator of the files and line ranges asked for in a stream.
+
+        Each query is a path (relative to the root, or absolute), which may
+        be followed by ':' and a comma separated list of lines and ranges of
+        lines (e.g. 'a.py:10-20,31'). Queries are provided as they arrive,
+        so that results can be reported before the stream ends.
+        """
+        for query in split_stream(stream, separator):
+            query = to_text(query).rstrip('\r\n')
+            if not query:
+                continue
+            path, colon, spec = query.rpartition(':')
+            ranges = []
+            if colon and line_ranges_re.match(spec):
+                for part in spec.split(','):
+                    first, dash, last = part.partition('-')
+                    first, last = int(first), int(last or first)
+                    ranges.append((min(first, last), max(first, last)))
+            else:
+                path = query
+            yield (os.path.normpath(os.path.join(self.root, self.tree_dir,
+                                                 path)), ranges)
+
+    def for_root(self, root):
+        """Owners with the same settings, for another repository.
+
+        Skipped files are shared, so that they are in the one report.
+        """
+        owners = copy.copy(self)
+        owners.root = os.path.abspath(root)
+        return owners
+
+    def line_count(self, filename):
+        """Number of lines in a file, from the revision's tree if used."""
+        if not self.revision:
+            return count_lines(filename)
+        source = self.read_source(filename)
+        return source.count(b'\n') + (source[-1:] not in (b'', b'\n'))
+
+    def file_size(self, filename):
+        """Size of a file in bytes, from the revision's tree if used."""
+        if self.blob_sizes is not None:
+            return self.blob_sizes.get(filename, 0)
+        try:
+            return os.path.getsize(filename)
+        except OSError:
+            return 0
+
+    def check_attributes(self, filenames):
+        """Get the skip attributes for files, using one git check-attr.
+
+        Returns a list with a dict of attribute values for each file.
+        """
+        if not filenames:
+            return []
+        command = ['git', 'check-attr', '--stdin', '-z']
+        if self.revision:  # Needs git 2.40, else attributes are not known
+            command.append('--source=%s' % self.revision)
+        command += self.skip_attributes
+        paths = ''.join(os.path.relpath(f, self.root) + '\0'
+                        for f in filenames)
+        p = subprocess.Popen(command, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             cwd=self.root)
+        out, err = p.communicate(paths.encode('utf-8'))
+        if p.returncode:
+            return [{} for _ in filenames]
+        # Output has path, attribute, and value fields, for each attribute
+        fields = to_text(out).split('\0')
+        num_attrs = len(self.skip_attributes)
+        return [dict(zip(fields[i + 1:i + 3 * num_attrs:3],
+                         fields[i + 2:i + 3 * num_attrs:3]))
+                for i in range(0, len(filenames) * 3 * num_attrs,
+                               3 * num_attrs)]
+
+    def unblameable_reason(self, filename, attributes, max_size=0):
+        """Cheaply determine if a file should not be blamed, and why."""
+        for attribute in self.skip_attributes:
+            if attributes.get(attribute) in ('set', 'true'):
+                return attribute.replace('linguist-', '')
+        name = os.path.basename(filename)
+        if any(fnmatch.fnmatch(name, p) for p in self.generated_patterns):
+            return 'generated'
+        if max_size and self.file_size(filename) > max_size:
+            return 'too large'
+        if self.revision:
+            return None  # Contents are not checked out, to look at
+        try:
+            with open(filename, 'rb') as f:
+                block = f.read(self.sniff_size)
+        except (IOError, OSError):
+            return None  # Let git blame report the problem
+        if b'\0' in block:
+            return 'binary'
+        average_line = len(block) / (block.count(b'\n') + 1)
+        if average_line > self.minified_line_length:
+            return 'minified'
+        return None
+
+    def exclude_unblameable(self, matches, max_size=0):
+        """Generator that drops files which are not worth blaming.
+
+        Binary, generated, and vendored files (from attributes or a quick
+        look at the start of the file, which is not done for a revision),
+        and ones larger than max_size bytes (if non-zero), are recorded as
+        skipped, instead of being blamed.
+        """
+        matches = list(matches)
+        all_attributes = self.check_attributes([f for f, r in matches])
+        for (filename, ranges), attributes in zip(matches, all_attributes):
+            reason = self.unblameable_reason(filename, attributes, max_size)
+            if reason:
+                self.skipped.append((filename, reason))
+            else:
+                yield (filename, ranges)
 
     @classmethod
     def build_line_range_filter(cls, ranges):
         return ['-L %d,%d' % r for r in ranges]
 
     @classmethod
-    def collect_blame_info(cls, matches):
-        """Runs git blame on files, for the specified sets of line ranges.
-
-        If no line range tuples are provided, it will do all lines.
+    def blame_file(cls, filename, ranges, timeout=None, bounds=(),
+                   root=None):
+        """Runs git blame on a file, returning the output and any error.
+
+        If no line range tuples are provided, it will do all lines. If a
+        timeout (in seconds) is given, a git blame running longer than that
+        will be killed, and an error returned. Any bounds (e.g. '--since',
+        or the revision to blame) limit how far back in history git blame
+        will go. With a root, git is run there, instead of in the file's
+        directory (which a bare repository does not have).
         """
-        old_area = None
-        for filename, ranges in matches:
+        if root:
+            area, name = root, os.path.relpath(filename, root)
+        else:
             area, name = os.path.split(filename)
-            if not area:
-                area = '.'
-            if area != old_area:
-                print("\n\n%s/\n" % area)
-                old_area = area
-            print("%s " % name, end="")
-            filter = cls.build_line_range_filter(ranges)
-            command = ['git', 'blame', '--line-porcelain'] + filter + [name]
-            os.chdir(area)
-            p = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
+        if not area:
+            area = '.'
+        filter = cls.build_line_range_filter(ranges)
+        # Root commits are not boundaries, so that only lines from before
+        # the history bounds are marked as such
+        command = (['git', 'blame', '--line-porcelain', '--root'] + filter +
+                   list(bounds) + (['--'] if root else []) + [name])
+        p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, cwd=area)
+        if not timeout:
+            return p.communicate()
+        killed = []
+
+        def kill():
+            killed.append(True)
+            p.kill()
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
             out, err = p.communicate()
-            if err:
-                print(" <<<<<<<<<< Unable to collect 'git blame' info:", err)
+        finally:
+            timer.cancel()
+        if killed:
+            return ('', "timed out after %g seconds, skipped" % timeout)
+        return (out, err)
+
+    def read_source(self, filename):
+        """Contents of a file, from the revision's tree if used."""
+        if not self.revision:
+            with open(filename, 'rb') as source:
+                return source.read()
+        if self.tree_prefix is None:
+            # Paths in the tree are from the top, even in a subdirectory
+            self.tree_prefix = git_output(self.root, 'rev-parse',
+                                          '--show-prefix') or ''
+        path = os.path.relpath(filename, self.root).replace(os.sep, '/')
+        p = subprocess.Popen(['git', 'cat-file', 'blob', '%s:%s%s' % (
+                              self.revision, self.tree_prefix, path)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             cwd=self.root)
+        out, err = p.communicate()
+        if p.returncode:
+            raise IOError(to_text(err).strip())
+        return out
+
+    def symbol_spans(self, filename):
+        """Line spans of the symbols in a Python file (see find_symbols).
+
+        Parsed files are cached by their git blob id, so that the same
+        contents are only parsed once.
+        """
+        source = self.read_source(filename)
+        blob_id = hashlib.sha1(b'blob %d\0' % len(source) + source).hexdigest()
+        if blob_id not in self.symbol_cache:
+            self.symbol_cache[blob_id] = find_symbols(source)
+        return self.symbol_cache[blob_id]
+
+    def blame(self, filename, ranges, timeout=None):
+        """Runs git blame on a file, within the history bounds.
+
+        For a symbol in a file (e.g. 'a.py::Class.method'), only its lines
+        are blamed.
+        """
+        filename, separator, symbol = filename.partition(symbol_separator)
+        if symbol:
+            try:
+                span = self.symbol_spans(filename).get(symbol)
+            except (IOError, OSError, SyntaxError, ValueError) as e:
+                return ('', "Unable to find symbols: %s" % e)
+            if not span:
+                return ('', "No symbol %s in the file" % symbol)
+            ranges = [span]
+        windows = self.line_windows(filename, ranges)
+        if windows:
+            return self.blame_in_windows(filename, *windows, timeout=timeout)
+        return self.blame_file(filename, ranges, timeout, self.history_bounds,
+                               self.root if self.revision else None)
+
+    def line_windows(self, filename, ranges):
+        """Splits the lines to blame into windows, if there are too many.
+
+        Returns the windows (each a list of line ranges), and how many of them
+        to blame at once, or None if the lines can be blamed in one go. The
+        blame output is estimated from the average line length, and windows
+        are made smaller and run fewer at a time, to stay within the memory
+        cap.
+        """
+        if not self.window:
+            return None
+        size = self.file_size(filename)
+        blamed = sum(last - first + 1 for first, last in ranges)
+        if (blamed if ranges else size) <= self.window:
+            return None  # Every line has at least its newline
+        try:
+            lines = self.line_count(filename)
+        except (IOError, OSError):
+            return None  # Let git blame report the problem
+        if not ranges:
+            ranges, blamed = [(1, lines)], lines
+        if blamed <= self.window:
+            return None
+        line_bytes = porcelain_line_bytes + size // max(lines, 1)
+        window = max(1, min(self.window, self.window_memory // line_bytes))
+        at_once = max(1, min(self.window_jobs,
+                             self.window_memory // (window * line_bytes)))
+        return split_ranges(ranges, window), at_once
+
+    def blame_in_windows(self, filename, windows, at_once, timeout=None):
+        """Runs git blame on windows of a file's lines, merging the output.
+
+        Up to at_once windows are blamed concurrently, and the output of each
+        is compacted as it arrives, in order (see compact_porcelain), so it
+        is parsed and ranked just like the output for the whole file. Any
+        timeout is for all of the windows.
+        """
+        root = self.root if self.revision else None
+        deadline = time.time() + timeout if timeout else None
+
+        def blame_window(ranges):
+            left = None
+            if deadline:
+                left = deadline - time.time()
+                if left <= 0:
+                    return ('', "timed out after %g seconds, skipped" %
+                            timeout)
+            return self.blame_file(filename, ranges, left,
+                                   self.history_bounds, root)
+
+        threads = multiprocessing.pool.ThreadPool(at_once)
+        try:
+            seen = set()
+            merged = []
+            for out, err in ordered_imap(threads, blame_window, windows,
+                                         window=at_once):
+                if err:
+                    return ('', err)
+                merged.append(compact_porcelain(out, seen,
+                                                self.full_records))
+        finally:
+            threads.terminate()
+            threads.join()
+        return (b''.join(merged), '')
+
+    def timed_blame(self, match, timeout=None, progress=None):
+        filename, ranges = match
+        if progress:
+            progress.started(filename)
+        start = time.time()
+        out, err = self.blame(filename, ranges, timeout)
+        if progress:
+            progress.blamed(filename)
+        return BlameOutput(filename, out, err, time.time() - start)
+
+    def rank_blame(self, blame):
+        """Parse and sort the blame output for a file.
+
+        Takes and returns plain tuples, so that it can be run in a worker
+        process. The summary in the result is None, if git blame failed.
+        """
+        if blame.error:
+            return FileOwnership(blame.filename, to_text(blame.error), None,
+                                 blame.elapsed)
+        start = clock()
+        commits = self.parse_info_records(blame.output)
+        # Authors with several identities are merged, using the mailmap
+        mailmap = self.mailmap_for(blame.filename)
+        if mailmap:
+            mailmap.apply(commits)
+        records = sum(commit.line_count for commit in commits)
+        # Any child process CPU time is from other threads' git commands
+        parse_time = time_since(start)[:2] + [0.0]
+        start = clock()
+        self.sort()
+        summary = self.summarize(self.max_match)
+        symbols = None
+        if self.by_symbol:
+            symbols = self.rank_symbols(blame, commits)
+        stats = {'parse': parse_time, 'sort': time_since(start)[:2] + [0.0],
+                 'bytes': len(blame.output), 'records': records}
+        table_rows = None
+        if self.table is not None:  # Added to the table by the caller
+            table_rows = (commits, self.blamed_lines)
+        return FileOwnership(blame.filename, None, summary, blame.elapsed,
+                             stats, symbols, table_rows)
+
+    def mailmap_for(self, filename):
+        """Mailmap of the repository a file is in, or None if it has none.
+
+        Files of the other roots (including submodules, inside root) are
+        mapped with their own repository's mailmap.
+        """
+        roots = [root for root in self.other_roots
+                 if filename.startswith(os.path.join(root, ''))]
+        if not roots:
+            return self.mailmap
+        return self.other_mailmaps.get(max(roots, key=len))
+
+    def rank_symbols(self, blame, commits):
+        """Rank the owners of each top-level symbol in a Python file.
+
+        The blame output for the whole file is used, so that one git blame
+        covers all of the symbols. Returns a list of (symbol, summary), in
+        the order of the file, or None if it is not Python that can be
+        parsed.
+        """
+        if not blame.filename.endswith('.py'):
+            return None
+        try:
+            spans = self.symbol_spans(blame.filename)
+        except (IOError, OSError, SyntaxError, ValueError):
+            return None
+        # Commits from before the history cutoff have a shortened ID
+        by_uuid = dict((c.uuid.lstrip('^')[:39], c) for c in commits)
+        blamed = sorted((int(number), uuid[:39]) for uuid, number in
+                        blamed_line_re.findall(to_text(blame.output)))
+        line_numbers = [number for number, uuid in blamed]
+        symbols = []
+        for name, (first, last) in sorted(spans.items(),
+                                          key=operator.itemgetter(1)):
+            if '.' in name:
+                continue
+            counts = collections.Counter(
+                uuid for number, uuid in
+                blamed[bisect.bisect_left(line_numbers, first):
+                       bisect.bisect_right(line_numbers, last)])
+            self.commits = []
+            for uuid, count in counts.items():
+                commit = copy.copy(by_uuid[uuid])
+                commit.line_count = count
+                self.commits.append(commit)
+            self.sort()
+            symbols.append((name, self.summarize(self.max_match)))
+        return symbols
+
+    def count_commits(self):
+        """Commits that touched each file, in all of the repositories."""
+        commit_counts = {}
+        for root in [self.root] + self.other_roots:
+            commit_counts.update(count_file_commits(root, self.history_bounds))
+        return commit_counts
+
+    def estimate_blame_costs(self, matches):
+        """Relative cost of blaming each file, from size and commit count.
+
+        The work done by git blame grows with both the size of the file and
+        the number of commits that have touched it.
+        """
+        commit_counts = self.count_commits()
+        costs = []
+        for filename, ranges in matches:
+            costs.append(self.file_size(filename) *
+                         (1 + commit_counts.get(filename, 0)))
+        return costs
+
+    def collect_ownership(self, matches, processes=0, jobs=1, timeout=None,
+                          stats=None, progress=None):
+        """Generator of ranked ownership for files, in the order provided.
+
+        When processes are requested, the raw blame output is handed off to
+        a pool of workers for parsing and sorting. With more than one job,
+        that many git blame commands are run concurrently. The time taken,
+        and work done, is added to the stats, and the progress is updated as
+        each file is blamed and ranked, if provided. When streaming, files are
+        blamed in the order they arrive, and each result is provided as soon
+        as it is done.
+        """
+        if stats is None:
+            stats = Stats()
+        pool = None
+        if processes:
+            pool = multiprocessing.Pool(processes, init_rank_worker, (self, ))
+        try:
+            if self.streaming and (jobs > 1 or pool):
+                results = self.collect_streaming(matches, pool, jobs, timeout,
+                                                 stats, progress)
+            elif jobs > 1:
+                results = self.collect_concurrently(matches, pool, jobs,
+                                                    timeout, stats, progress)
             else:
-                yield out
+                results = self.collect_serially(matches, pool, processes,
+                                                timeout, stats, progress)
+            for result in results:
+                if result.table_rows:
+                    self.table.add_records(result.filename,
+                                           *result.table_rows)
+                    result = result._replace(table_rows=None)
+                stats.add_result(result)
+                if progress:
+                    progress.finished(result)
+                yield result
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+    def collect_serially(self, matches, pool, processes, timeout, stats,
+                         progress):
+        blames = stats.timed('blame', (
+            self.timed_blame(match, timeout, progress) for match in matches))
+        if not pool:
+            return (self.rank_blame(blame) for blame in blames)
+        # Next file is blamed, while the workers rank the previous ones
+        return ordered_imap(pool, rank_in_worker, blames,
+                            window=processes * 2)
+
+    def collect_concurrently(self, matches, pool, jobs, timeout, stats,
+                             progress):
+        """Blame files using several threads, most costly files first.
+
+        Files are started in order of their estimated cost, so that the large
+        ones are not left until the end, but results are provided in the
+        original order.
+        """
+        matches = list(matches)
+        with stats.stage('schedule'):
+            costs = self.estimate_blame_costs(matches)
+        schedule = sorted(range(len(matches)), key=lambda i: costs[i],
+                          reverse=True)
+
+        def blame_and_rank(index):
+            return index, self.blame_and_rank(matches[index], pool, timeout,
+                                              stats, progress)
+
+        threads = multiprocessing.pool.ThreadPool(jobs)
+        try:
+            done = {}
+            next_index = 0
+            for index, result in threads.imap_unordered(blame_and_rank,
+                                                        schedule):
+                done[index] = result
+                while next_index in done:
+                    yield done.pop(next_index)
+                    next_index += 1
+        finally:
+            threads.terminate()
+            threads.join()
+
+    def collect_streaming(self, matches, pool, jobs, timeout, stats,
+                          progress):
+        """Blame files in the order they arrive, several at a time.
+
+        The matches are read in another thread, so that a finished result is
+        not held back waiting for the next match (e.g. when the caller waits
+        for it, before asking for more). Up to jobs files are outstanding,
+        and results are provided in the original order.
+        """
+        threads = multiprocessing.pool.ThreadPool(jobs)
+        pending = queue.Queue()
+        slots = threading.Semaphore(jobs)
+        failures = []
+
+        def read():
+            try:
+                for match in matches:
+                    slots.acquire()
+                    pending.put(threads.apply_async(
+                        self.blame_and_rank,
+                        (match, pool, timeout, stats, progress)))
+            except Exception as e:
+                failures.append(e)
+            finally:
+                pending.put(None)
+
+        reader = threading.Thread(target=read)
+        reader.daemon = True  # Could be blocked on input, at the end
+        reader.start()
+        try:
+            while True:
+                result = pending.get()
+                if result is None:
+                    break
+                yield result.get()
+                slots.release()
+            if failures:
+                raise failures[0]
+        finally:
+            threads.terminate()
+            threads.join()
+
+    def blame_and_rank(self, match, pool, timeout, stats, progress):
+        """Blame and rank one file, in a thread."""
+        with stats.stage('blame'):
+            blame = self.timed_blame(match, timeout, progress)
+        if pool:
+            return pool.apply(rank_in_worker, (blame, ))
+        # Each thread needs its own commit lists
+        return copy.copy(self).rank_blame(blame)
 
     def parse_info_records(self, lines, unique_commits=False):
         self.commits = []
-        commits = set()
+        self.has_boundary = False
+        # (line number, uuid) of each line, for the ownership table
+        self.blamed_lines = [] if self.table is not None else None
+        commits = {}
         in_new_record = False
-        for line in lines.splitlines():
+        for line in to_text(lines).splitlines():
             m = uuid_line_re.match(line)
             if m:
                 uuid = m.group(1)
                 line_number = int(m.group(2))
+                if self.blamed_lines is not None:
+                    self.blamed_lines.append((line_number, uuid))
                 if unique_commits or uuid not in commits:
                     record = BlameRecord(uuid, line_number)
-                    commits.add(uuid)
+                    commits[uuid] = record
                     in_new_record = True
                 else:
-                    record.line_count += 1
+                    commits[uuid].line_count += 1
                 continue
             if in_new_record:
                 if code_line_re.match(line):
@@ -242,6 +1117,8 @@ class Owners(object):
                 m = attr_line_re.match(line)
                 if m:
                     record.store_attribute(m.group(1), m.group(2))
+                elif line == 'boundary':
+                    record.boundary = self.has_boundary = True
         return self.commits
 
     def unique_authors(self, limit):
@@ -251,7 +1128,23 @@ class Owners(object):
             limit = None
         seen_add = seen.add  # Assign to variable, so not resolved each time
         return [x.author for x in self.sorted_commits[:limit]
-                if not (x.author in seen or seen_add(x.author))]
+                if not (x.boundary or x.author in seen or seen_add(x.author))]
+
+    def summarize(self, limit):
+        """Reduce the sorted commits to what is needed for the report.
+
+        Returns a tuple of the unique authors, and (if showing details) the
+        summary records for the commits, limited as requested. If the
+        results are being saved, all the records are kept.
+        """
+        authors = self.unique_authors(limit)
+        if self.keep_records:  # Saving results, so need everything
+            limit = 0
+        elif not self.details:
+            return (authors, [])
+        if limit == 0:
+            limit = None
+        return (authors, [c.as_summary() for c in self.sorted_commits[:limit]])
 
     def show_details(self, limit):
         if limit == 0:
@@ -312,27 +1205,287 @@ class SizeOwners(Owners):
                                           operator.attrgetter('author_mail')):
             if group:
                 users.append(self.merge_user_commits(group))
-        # Finally sort by the (aggregated) commits' line counts
+        # Finally sort by the (aggregated) commits' line counts, with any
+        # lines from before the history cutoff last
         self.sorted_commits = sorted(users,
                                      key=operator.attrgetter('line_count'),
                                      reverse=True)
+        if self.has_boundary:
+            self.sorted_commits.sort(key=operator.attrgetter('boundary'))
         return self.sorted_commits
 
 
+class SampledOwners(SizeOwners):
+    """Ownership by size, estimated from a random sample of the lines.
+
+    Runs of sample_run lines are picked at random (but repeatably, for the
+    same path), to cover about sample_lines lines of each file. Each
+    author's share is given with a 95% confidence interval, and where the
+    intervals for the top two authors overlap, the sample is doubled (up to
+    the whole file), so that the effort goes to files that are too close to
+    call. With sample_files, only that many files, picked at random, are
+    blamed in each directory, and the rest are skipped.
+    """
+
+    sample_run = 5
+    z = 1.96  # For a 95% confidence interval
+
+    def __init__(self, root, filter="*", details=False, verbose=False,
+                 max_match=0, includes=None, excludes=None, sample_lines=0,
+                 sample_files=0):
+        super(SampledOwners, self).__init__(root, filter, details, verbose,
+                                            max_match, includes, excludes)
+        self.sample_lines = sample_lines
+        self.sample_files = sample_files
+        self.timeout = None
+
+    def sample_runs(self, filename, num_lines):
+        """All the runs of lines in the file, in a repeatable random order.
+
+        Also provides how many of the runs to blame at first.
+        """
+        runs = [(first, min(first + self.sample_run - 1, num_lines))
+                for first in range(1, num_lines + 1, self.sample_run)]
+        random.Random(os.path.relpath(filename, self.root)).shuffle(runs)
+        wanted = -(-self.sample_lines // self.sample_run)
+        if not self.sample_lines or wanted >= len(runs):
+            wanted = len(runs)
+        return runs, wanted
+
+    @classmethod
+    def join_runs(cls, runs):
+        """Line ranges for blaming runs, with adjacent runs combined."""
+        ranges = []
+        for first, last in sorted(runs):
+            if ranges and ranges[-1][1] + 1 == first:
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+        return ranges
+
+    def sample_matches(self, matches):
+        """Generator of the sampled files, with the line ranges to blame."""
+        for area, files in itertools.groupby(
+                matches, key=lambda match: os.path.dirname(match[0])):
+            files = list(files)
+            if self.sample_files and len(files) > self.sample_files:
+                chosen = set(random.Random(area).sample(
+                    range(len(files)), self.sample_files))
+                for i, (filename, ranges) in enumerate(files):
+                    if i not in chosen:
+                        self.skipped.append((filename, 'not sampled'))
+                files = [files[i] for i in sorted(chosen)]
+            for filename, ranges in files:
+                try:
+                    num_lines = count_lines(filename)
+                except (IOError, OSError):
+                    num_lines = 0  # Let git blame report the problem
+                runs, wanted = self.sample_runs(filename, num_lines)
+                if wanted < len(runs):
+                    ranges = self.join_runs(runs[:wanted])
+                yield (filename, ranges)
+
+    def collect_ownership(self, matches, processes=0, jobs=1, timeout=None,
+                          stats=None, progress=None):
+        self.timeout = timeout  # For blaming more lines, while ranking
+        return super(SampledOwners, self).collect_ownership(
+            self.sample_matches(matches), processes, jobs, timeout, stats,
+            progress)
+
+    @classmethod
+    def share_interval(cls, count, sampled, num_lines, run_length=1):
+        """Share of lines, with a confidence interval, as fractions.
+
+        Uses the Wilson score interval, treating each run as one sample (as
+        lines in a run tend to have the same author). It is narrowed towards
+        the share for the fraction of the file that was sampled, so it always
+        contains the share, and shrinks to it as the whole file is sampled.
+        """
+        share = float(count) / sampled
+        if sampled >= num_lines:
+            return share, share, share
+        n = max(1.0, float(sampled) / run_length)
+        z2 = cls.z * cls.z
+        centre = (share + z2 / (2 * n)) / (1 + z2 / n)
+        spread = (cls.z / (1 + z2 / n) *
+                  math.sqrt(share * (1 - share) / n + z2 / (4 * n * n)))
+        low, high = max(0.0, centre - spread), min(1.0, centre + spread)
+        correction = math.sqrt(float(num_lines - sampled) /
+                               max(num_lines - 1, 1))
+        return (share, share - (share - low) * correction,
+                share + (high - share) * correction)
+
+    def too_close(self, sampled, num_lines):
+        """Whether the top two authors' share intervals overlap."""
+        if len(self.sorted_commits) < 2:
+            return False
+        first, second = [self.share_interval(c.line_count, sampled,
+                                             num_lines, self.sample_run)
+                         for c in self.sorted_commits[:2]]
+        return first[1] <= second[2]
+
+    def rank_blame(self, blame):
+        """Rank the sampled lines, blaming more where it is too close."""
+        if blame.error:
+            return super(SampledOwners, self).rank_blame(blame)
+        try:
+            num_lines = count_lines(blame.filename)
+        except (IOError, OSError):
+            num_lines = 0
+        runs, taken = self.sample_runs(blame.filename, num_lines)
+        output = to_text(blame.output)
+        elapsed = blame.elapsed
+        while True:
+            result = super(SampledOwners, self).rank_blame(
+                blame._replace(output=output))
+            sampled = sum(c.line_count for c in self.sorted_commits)
+            if taken >= len(runs) or not self.too_close(sampled, num_lines):
+                break
+            more = runs[taken:taken * 2]
+            taken += len(more)
+            start = time.time()
+            out, err = self.blame(blame.filename, self.join_runs(more),
+                                  self.timeout)
+            elapsed += time.time() - start
+            if err:
+                break  # Report on what was sampled
+            output += to_text(out)
+        for commit in self.sorted_commits:
+            share, low, high = self.share_interval(
+                commit.line_count, sampled, num_lines, self.sample_run)
+            commit.line_count = int(round(share * max(num_lines, sampled)))
+            if low == high:
+                commit.lines = '%d%%' % round(100 * share)
+            else:
+                commit.lines = '%d%% (%d-%d%%)' % (
+                    round(100 * share), round(100 * low), round(100 * high))
+        return result._replace(summary=self.summarize(self.max_match),
+                               elapsed=elapsed)
+
+    def show(self, commit):
+        """Display one commit line, with the author's share of the file."""
+        line = super(SampledOwners, self).show(commit)
+        if commit.lines:
+            line += ' %s' % commit.lines
+        return line
+
+
 class DateOwners(Owners):
 
     def sort(self):
-        """Sort commits by the committer date/time."""
+        """Sort commits by the committer date/time.
+
+        Lines from before the history cutoff are last, whatever their date.
+        """
         self.sorted_commits = sorted(self.commits,
                                      key=lambda x: x.committer_time,
                                      reverse=True)
+        if self.has_boundary:
+            self.sorted_commits.sort(key=operator.attrgetter('boundary'))
         return self.sorted_commits
 
 
+class HistoryOwners(Owners):
+    """Approximate ownership, from the lines each author added to files.
+
+    One 'git log --numstat' for the whole tree is used, instead of blaming
+    each file, so this is much faster, but lines since changed or removed by
+    others still count. Lines added are weighted by how recent the commit is
+    (halving every half_life seconds before the latest commit), so that
+    current owners are ranked first. The line count shown is lines added.
+    """
+
+    half_life = 365 * 24 * 3600
+    description = ("Approximate owners, from lines added in the commit "
+                   "history (weighted to recent commits), not git blame.")
+    # Identities are mapped with the mailmap, like git blame does, unless
+    # asked not to (with the raw_log_format)
+    log_format = '%x1e%H%x1f%aN%x1f%aE%x1f%cN%x1f%cE%x1f%ct%x1f%ci'
+    raw_log_format = '%x1e%H%x1f%an%x1f%ae%x1f%cn%x1f%ce%x1f%ct%x1f%ci'
+
+    def read_history(self):
+        """Lines added to each file by each author, from one git log.
+
+        Returns {path: {author_mail: [weight, lines, latest commit]}}, with
+        paths relative to the root.
+        """
+        log_format = (self.log_format if self.use_mailmap else
+                      self.raw_log_format)
+        command = (['git', 'log', '-z', '--numstat', '--no-renames',
+                   '--relative', '--format=' + log_format] +
+                   self.history_bounds + ['--'] + self.matcher.pathspecs())
+        p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, cwd=self.root)
+        history = collections.defaultdict(dict)
+        commit = newest = None
+        for field in split_stream(p.stdout):
+            field = to_text(field).lstrip('\n')
+            if field.startswith('\x1e'):
+                (uuid, author, author_mail, committer, committer_mail,
+                 committer_time, committer_date) = field[1:].split('\x1f')
+                commit = BlameRecord(uuid, 0)
+                commit.author = author
+                commit.author_mail = '<%s>' % author_mail
+                commit.committer = committer
+                commit.committer_mail = '<%s>' % committer_mail
+                commit.committer_time = int(committer_time)
+                commit.committer_tz = committer_date[-5:]
+                if newest is None:  # Log starts with the latest commit
+                    newest = commit.committer_time
+                decay = 0.5 ** ((newest - commit.committer_time) /
+                                float(self.half_life))
+                continue
+            if not field or commit is None:
+                continue
+            added, deleted, path = field.split('\t', 2)
+            added = int(added) if added != '-' else 0  # Binary file
+            authors = history[path]
+            if commit.author_mail not in authors:  # Latest commit by author
+                authors[commit.author_mail] = [0.0, 0, commit]
+            entry = authors[commit.author_mail]
+            entry[0] += added * decay
+            entry[1] += added
+        p.communicate()
+        return history
+
+    def rank_history(self, filename, authors):
+        """Rank the authors of a file, by their weighted lines added."""
+        ranked = sorted(authors.values(), key=lambda entry: -entry[0])
+        self.sorted_commits = []
+        for weight, lines, commit in ranked:
+            commit = copy.copy(commit)
+            commit.line_count = lines
+            self.sorted_commits.append(commit)
+        return FileOwnership(filename, None, self.summarize(self.max_match),
+                             0.0)
+
+    def collect_ownership(self, matches, processes=0, jobs=1, timeout=None,
+                          stats=None, progress=None):
+        """Generator of approximate ownership for files, from the history.
+
+        As git blame is not used, the options for running it do not apply.
+        """
+        if stats is None:
+            stats = Stats()
+        with stats.stage('history'):
+            history = self.read_history()
+        prefix = len(os.path.join(self.root, ''))
+        for filename, ranges in matches:
+            with stats.stage('sort'):
+                result = self.rank_history(filename,
+                                           history.get(filename[prefix:], {}))
+            if progress:
+                progress.finished(result)
+            yield result
+
+
 class CoverageOwners(Owners):
 
-    def __init__(self, root, verbose=False):
+    full_records = True  # Each line is shown, with its commit
+
+    def __init__(self, root, verbose=False, data_file=None):
         self.commits = []
+        self.data_file = data_file  # From coverage.py, instead of HTML
         super(CoverageOwners, self).__init__(root, filter="*.html",
                                              details=True, verbose=verbose)
 
@@ -382,6 +1535,91 @@ class CoverageOwners(Owners):
         return (source_file, line_ranges)
 
     def collect_modules(self):
+        """Lines of interest, from the coverage data file or HTML reports."""
+        if self.data_file:
+            return self.collect_from_data()
+        return self.collect_from_reports()
+
+    def collect_from_data(self):
+        """Generator to obtain lines of interest from coverage.py data.
+
+        The missing lines, and lines with missing branches, are found with
+        coverage.py (using the project's configuration), as coverage html
+        would, or from the SQLite file alone, if it is not installed. Only
+        files within the project tree are used.
+        """
+        coverage = optional_module('coverage')
+        if coverage:
+            files = self.read_coverage_api(coverage)
+        else:
+            files = self.read_coverage_data()
+        for src_file, lines in sorted(files):
+            src_file = os.path.abspath(os.path.join(self.root, src_file))
+            if not lines or os.path.relpath(
+                    src_file, self.root).split(os.sep)[0] == os.pardir:
+                continue
+            if not os.path.isfile(src_file):
+                raise SourceNotFound(
+                    "Source file %(file)s not found at %(area)s" %
+                    {'file': os.path.basename(src_file),
+                     'area': os.path.dirname(src_file)})
+            yield (src_file, self.make_ranges(sorted(lines)))
+
+    def read_coverage_api(self, coverage):
+        """Provides (measured file, uncovered lines), using coverage.py.
+
+        Lines with a branch that was never taken are included, with a
+        coverage.py that reports them (7.7 and later).
+        """
+        config = os.path.join(self.root, '.coveragerc')
+        cov = coverage.Coverage(data_file=self.data_file, config_file=(
+            config if os.path.isfile(config) else True))
+        cov.load()
+        for filename in cov.get_data().measured_files():
+            try:
+                missing = set(cov.analysis2(filename)[3])
+                if hasattr(cov, 'branch_stats'):
+                    missing.update(
+                        line for line, (exits, taken) in
+                        cov.branch_stats(filename).items() if taken < exits)
+            except coverage.CoverageException:  # E.g. no source, not Python
+                continue
+            yield (filename, missing)
+
+    def read_coverage_data(self):
+        """Provides (measured file, missing lines), from the SQLite file.
+
+        The executed lines (or ends of executed arcs) are read from the data,
+        and compared with the statements in the source (see
+        find_statements). Lines with missing branches are not found this way.
+        """
+        connection = sqlite3.connect(self.data_file)
+        try:
+            paths = dict(connection.execute("select id, path from file"))
+            executed = collections.defaultdict(set)
+            for file_id, numbits in connection.execute(
+                    "select file_id, numbits from line_bits"):
+                executed[file_id].update(numbits_to_lines(numbits))
+            for file_id, first, last in connection.execute(
+                    "select file_id, fromno, tono from arc"):
+                executed[file_id].update(n for n in (first, last) if n > 0)
+        finally:
+            connection.close()
+        for file_id, path in paths.items():
+            try:
+                with open(os.path.join(self.root, path), 'rb') as source:
+                    statements = find_statements(source.read())
+            except (IOError, OSError, SyntaxError, ValueError):
+                continue
+            lines = sorted(executed[file_id])
+            missing = set()
+            for first, last in statements.items():
+                index = bisect.bisect_left(lines, first)
+                if index == len(lines) or lines[index] > last:
+                    missing.add(first)
+            yield (path, missing)
+
+    def collect_from_reports(self):
         """Generator to obtain lines of interest from coverage report files.
 
         Will verify that the source file is within the project tree, relative
@@ -464,6 +1702,1436 @@ class CoverageOwners(Owners):
             commit_date, committer)
 
 
+worker_owners = None
+
+
+class Mailmap(object):
+    """Maps author identities through .mailmap, with one git process.
+
+    Identities are sent to a long-lived 'git check-mailmap --stdin' in
+    batches, and the results are kept (and can be saved, with the
+    fingerprint of the mailmap they are for), so each distinct identity is
+    only resolved once. If git can't check the mailmap, identities are left
+    as they are.
+    """
+
+    batch_size = 200  # Identities written at once, within a pipe's buffer
+
+    def __init__(self, root):
+        self.root = root
+        self.identities = {}  # {(name, mail): (name, mail)}
+        self.process = None
+        self.lock = threading.Lock()  # Files may be ranked in threads
+
+    @classmethod
+    def for_repository(cls, root):
+        """Mailmap for the repository, or None if it has no mailmap."""
+        mailmap = cls(root)
+        return mailmap if mailmap.sources() else None
+
+    def __getstate__(self):
+        """Worker processes start their own git, when needed."""
+        state = self.__dict__.copy()
+        state.update(process=None, lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def resolve(self, identities):
+        """Resolve any of the (name, mail) identities not already known."""
+        with self.lock:
+            unknown = sorted(set(identity for identity in identities
+                                 if identity not in self.identities))
+            for start in range(0, len(unknown), self.batch_size):
+                self.check(unknown[start:start + self.batch_size])
+
+    def check(self, batch):
+        if self.process is None:
+            try:
+                self.process = subprocess.Popen(
+                    ['git', 'check-mailmap', '--stdin'], cwd=self.root,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+            except OSError:
+                self.process = False
+        # Anything git can't parse would stop it, so is left as it is
+        contacts = [identity for identity in batch
+                    if identity_re.match('%s %s' % identity)]
+        self.identities.update((identity, identity) for identity in batch)
+        try:
+            if not self.process:
+                return
+            self.process.stdin.write(b''.join(
+                ('%s %s\n' % identity).lstrip().encode('utf-8')
+                for identity in contacts))
+            self.process.stdin.flush()
+            for identity in contacts:
+                m = identity_re.match(
+                    to_text(self.process.stdout.readline()).rstrip('\n'))
+                if not m:
+                    raise IOError("git check-mailmap stopped")
+                self.identities[identity] = m.groups()
+        except (IOError, OSError, ValueError):
+            self.process = False
+
+    def apply(self, commits):
+        """Replace the author of each commit, with the mapped identity."""
+        self.resolve((c.author, c.author_mail) for c in commits)
+        for commit in commits:
+            commit.author, commit.author_mail = self.identities[
+                commit.author, commit.author_mail]
+
+    def sources(self):
+        """Where the repository's mailmap comes from, if anywhere.
+
+        Returns the mailmap settings, and the hash of the .mailmap file (or
+        its blob id, in a bare repository), for those it has.
+        """
+        parts = [git_output(self.root, 'config', '--get-regexp',
+                            r'^mailmap\.')]
+        top = git_output(self.root, 'rev-parse', '--show-toplevel')
+        if top:
+            try:
+                with open(os.path.join(top, '.mailmap'), 'rb') as mailmap:
+                    parts.append(hashlib.sha1(mailmap.read()).hexdigest())
+            except (IOError, OSError):
+                pass
+        else:
+            parts.append(git_output(self.root, 'rev-parse', '--verify',
+                                    '--quiet', 'HEAD:.mailmap'))
+        return [part for part in parts if part]
+
+    def fingerprint(self):
+        """Identifies the mailmap, so saved identities can be checked."""
+        return hashlib.sha1(
+            '\n'.join(self.sources()).encode('utf-8')).hexdigest()
+
+    def close(self):
+        if self.process:
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+
+class OwnershipTable(object):
+    """Ownership of all of the blamed lines, as columns of NumPy arrays.
+
+    Each row is a run of consecutive lines in a file, that were last changed
+    by one commit, with file_id, start (line), length, commit_id, author_id,
+    and committer_time columns. The ids index the files (relative to the
+    root), commits, and authors (by email, with author_names) lists. The
+    rankings and rollups work on whole columns at once, so that they are
+    quick for millions of lines.
+    """
+
+    columns = ('file_id', 'start', 'length', 'commit_id', 'author_id',
+               'committer_time')
+
+    def __init__(self, root):
+        global numpy
+        numpy = optional_module('numpy')
+        if numpy is None:
+            raise ImportError("NumPy is needed for ownership tables")
+        self.root = root
+        self.files = []
+        self.commits = []
+        self.authors = []
+        self.author_names = []
+        self.commit_ids = {}
+        self.author_ids = {}
+        self.commit_authors = []
+        self.commit_times = []
+        self.runs = []  # (file_id, start, length, commit_id) for each file
+        self.lock = threading.Lock()  # Results may be added from threads
+
+    def __getstate__(self):
+        """Worker processes only need to know that there is a table."""
+        state = self.__dict__.copy()
+        state.update(lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add_commit(self, commit):
+        """Id for a commit, adding it (and its author) if new."""
+        key = commit.uuid.lstrip('^')[:39]  # Boundary IDs are shortened
+        if key not in self.commit_ids:
+            if commit.author_mail not in self.author_ids:
+                self.author_ids[commit.author_mail] = len(self.authors)
+                self.authors.append(commit.author_mail)
+                self.author_names.append(commit.author)
+            self.commit_ids[key] = len(self.commits)
+            self.commits.append(commit.uuid)
+            self.commit_authors.append(self.author_ids[commit.author_mail])
+            self.commit_times.append(commit.committer_time)
+        return self.commit_ids[key]
+
+    def add_records(self, filename, commits, blamed_lines):
+        """Add the runs of lines for a file, from its parsed blame records.
+
+        Takes the commit records, and the (line number, uuid) of each blamed
+        line, as parse_info_records leaves them. The authors are expected to
+        have been mapped already, as when ranking.
+        """
+        # Ids within the file, until the commits are added to the table
+        # (commits from before the history cutoff have a shortened ID)
+        local_ids = dict((commit.uuid.lstrip('^')[:39], i)
+                         for i, commit in enumerate(commits))
+        lines = numpy.array([n for n, uuid in blamed_lines],
+                            dtype=numpy.int64)
+        ids = numpy.array([local_ids[uuid.lstrip('^')[:39]]
+                           for n, uuid in blamed_lines], dtype=numpy.int64)
+        order = numpy.argsort(lines, kind='stable')
+        lines, ids = lines[order], ids[order]
+        # A run ends where the commit changes, or lines are not consecutive
+        starts = numpy.flatnonzero(numpy.concatenate((
+            [True], (numpy.diff(ids) != 0) | (numpy.diff(lines) != 1))))
+        lengths = numpy.diff(numpy.append(starts, len(lines)))
+        with self.lock:
+            commit_ids = numpy.array([self.add_commit(commit)
+                                      for commit in commits],
+                                     dtype=numpy.int64)
+            self.runs.append((len(self.files), lines[starts], lengths,
+                              commit_ids[ids[starts]]))
+            self.files.append(os.path.relpath(filename, self.root))
+
+    def arrays(self):
+        """The columns of the table, as a dict of arrays."""
+        with self.lock:
+            runs = list(self.runs)
+        int64 = numpy.int64
+        file_id = numpy.concatenate(
+            [numpy.full(len(starts), f, dtype=int64)
+             for f, starts, lengths, ids in runs] + [numpy.zeros(0, int64)])
+        start, length, commit_id = [
+            numpy.concatenate([run[i] for run in runs] +
+                              [numpy.zeros(0, int64)]) for i in (1, 2, 3)]
+        return {'file_id': file_id, 'start': start, 'length': length,
+                'commit_id': commit_id,
+                'author_id': numpy.array(self.commit_authors,
+                                         dtype=int64)[commit_id],
+                'committer_time': numpy.array(self.commit_times,
+                                              dtype=int64)[commit_id]}
+
+    @classmethod
+    def group_sum(cls, outer, inner, weights):
+        """Total weight of each (outer, inner) pair of ids.
+
+        Returns (outer, inner, total) arrays, ordered by the outer id, and
+        then by largest total.
+        """
+        width = int(inner.max()) + 1 if len(inner) else 1
+        keys, inverse = numpy.unique(outer * width + inner,
+                                     return_inverse=True)
+        totals = numpy.bincount(inverse.ravel(), weights=weights,
+                                minlength=len(keys)).astype(numpy.int64)
+        outer, inner = keys // width, keys % width
+        order = numpy.lexsort((-totals, outer))
+        return outer[order], inner[order], totals[order]
+
+    def size_ranking(self):
+        """Lines by each author in each file, like SizeOwners.
+
+        Returns (file_id, author_id, lines) arrays, ordered by file, and
+        then by most lines.
+        """
+        data = self.arrays()
+        return self.group_sum(data['file_id'], data['author_id'],
+                              data['length'])
+
+    def date_ranking(self):
+        """Lines from each commit in each file, like DateOwners.
+
+        Returns (file_id, commit_id, lines, committer_time) arrays, ordered
+        by file, and then by latest commit, with any lines from before the
+        history cutoff last.
+        """
+        data = self.arrays()
+        file_id, commit_id, lines = self.group_sum(
+            data['file_id'], data['commit_id'], data['length'])
+        times = numpy.array(self.commit_times, dtype=numpy.int64)[commit_id]
+        boundary = numpy.array([uuid.startswith('^')
+                                for uuid in self.commits], dtype=bool)
+        order = numpy.lexsort((-times, boundary[commit_id], file_id))
+        return (file_id[order], commit_id[order], lines[order],
+                times[order])
+
+    def directory_rollup(self):
+        """Lines by each author under each directory (and below it).
+
+        Returns the list of directories ('.' for the whole tree), and
+        (directory_id, author_id, lines) arrays, ordered by directory, and
+        then by most lines.
+        """
+        directories = ['.']
+        directory_ids = {'.': 0}
+        levels = []  # Directory id of each file, at each depth (or -1)
+        for file_id, name in enumerate(self.files):
+            area = os.path.dirname(name)
+            depth = area.count('/') + 1 if area else 0
+            while len(levels) <= depth:
+                levels.append(numpy.full(len(self.files), -1,
+                                         dtype=numpy.int64))
+            levels[0][file_id] = 0
+            while area:
+                if area not in directory_ids:
+                    directory_ids[area] = len(directories)
+                    directories.append(area)
+                levels[depth][file_id] = directory_ids[area]
+                area = os.path.dirname(area)
+                depth -= 1
+        file_id, author_id, lines = self.size_ranking()
+        level_ids = [level[file_id] for level in levels]
+        within = [ids >= 0 for ids in level_ids]
+        return (directories,) + self.group_sum(
+            numpy.concatenate([ids[w] for ids, w in zip(level_ids, within)] +
+                              [numpy.zeros(0, numpy.int64)]),
+            numpy.concatenate([author_id[w] for w in within] +
+                              [numpy.zeros(0, numpy.int64)]),
+            numpy.concatenate([lines[w] for w in within] +
+                              [numpy.zeros(0, numpy.int64)]))
+
+    def save(self, filename):
+        """Save the columns, and the lists of names, as a .npz file."""
+        data = self.arrays()
+        for name in ('files', 'commits', 'authors', 'author_names'):
+            data[name] = numpy.array(getattr(self, name), dtype=str)
+        numpy.savez_compressed(filename, **data)
+
+
+def find_symbols(source):
+    """Line spans of the classes and functions in Python source.
+
+    Returns {qualified name: (first line, last line)}, where nested symbols
+    are named like 'Class.method', and the span includes any decorators.
+    """
+    spans = {}
+
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.ClassDef, ast.FunctionDef,
+                                  ast.AsyncFunctionDef)):
+                name = prefix + child.name
+                first = min([child.lineno] +
+                            [d.lineno for d in child.decorator_list])
+                spans[name] = (first, child.end_lineno)
+                visit(child, name + '.')
+    visit(ast.parse(source), '')
+    return spans
+
+
+def find_statements(source):
+    """Lines of the statements in Python source, as coverage.py counts them.
+
+    Returns {first line: last line}, where a statement is executed if any
+    line from first to last is (its header, for a compound statement, which
+    starts at any decorators). Docstrings and declarations are left out, as
+    are statements marked with '# pragma: no cover' (and all of their body).
+    """
+    text = to_text(source).splitlines()
+    statements = {}
+    excluded = []
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, (ast.Global, ast.Nonlocal)) or (
+                isinstance(node, ast.Expr) and
+                isinstance(node.value, ast.Constant) and
+                isinstance(node.value.value, str)):
+            continue
+        if not isinstance(node, (ast.stmt, ast.excepthandler)):
+            continue
+        first = min([node.lineno] + [d.lineno for d in
+                                     getattr(node, 'decorator_list', [])])
+        body = getattr(node, 'body', None)
+        last = max(first, body[0].lineno - 1) if body else node.end_lineno
+        statements[first] = last
+        if any('pragma: no cover' in line for line in text[first - 1:last]):
+            excluded.append((first, node.end_lineno))
+    for start, end in excluded:
+        for first in [first for first in statements if start <= first <= end]:
+            del statements[first]
+    return statements
+
+
+def numbits_to_lines(numbits):
+    """Line numbers in a coverage.py numbits blob (bit n set for line n)."""
+    lines = []
+    for index, byte in enumerate(bytearray(numbits)):
+        for bit in range(8):
+            if byte & (1 << bit):
+                lines.append(index * 8 + bit)
+    return lines
+
+
+def count_lines(filename):
+    lines = 0
+    last = b'\n'
+    with open(filename, 'rb') as source:
+        for chunk in iter(lambda: source.read(65536), b''):
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    return lines + (last != b'\n')
+
+
+def split_ranges(ranges, size):
+    """Splits line ranges into windows, of up to size lines each."""
+    windows = [[]]
+    room = size
+    for first, last in ranges:
+        while first <= last:
+            if not room:
+                windows.append([])
+                room = size
+            end = min(last, first + room - 1)
+            windows[-1].append((first, end))
+            room -= end - first + 1
+            first = end + 1
+    return windows
+
+
+def compact_porcelain(output, seen, full_records=False):
+    """Shrinks git blame --line-porcelain output, for merging windows.
+
+    The source code of each line is dropped, and unless full records are
+    wanted, so are the details of commits already seen (as git blame
+    --porcelain does). Commits in the output are added to seen.
+    """
+    compacted = []
+    header = True
+    keep = True
+    for line in output.split(b'\n'):
+        if not line:
+            continue
+        if header:
+            uuid = line[:40]
+            keep = full_records or uuid not in seen
+            seen.add(uuid)
+            compacted.append(line)
+            header = False
+        elif line[:1] == b'\t':
+            if keep:
+                compacted.append(b'\t')
+            header = True
+        elif keep:
+            compacted.append(line)
+    return b''.join(line + b'\n' for line in compacted)
+
+
+def split_stream(stream, separator=b'\0', chunk_size=65536):
+    """Generator of the fields in a stream of separated fields.
+
+    Fields are provided as soon as they are read, without waiting for a
+    whole chunk (e.g. from a pipe).
+    """
+    read = getattr(stream, 'read1', stream.read)
+    pending = b''
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        fields = (pending + chunk).split(separator)
+        pending = fields.pop()
+        for field in fields:
+            yield field
+    if pending:
+        yield pending
+
+
+def find_submodules(root):
+    """Checked out submodules under root (and theirs), as absolute paths."""
+    out = git_output(root, 'ls-files', '-z', '--stage')
+    submodules = []
+    for entry in (out or '').split('\0'):
+        info, tab, path = entry.partition('\t')
+        if not info.startswith('160000 '):  # Not a gitlink
+            continue
+        path = os.path.join(root, path)
+        if os.path.exists(os.path.join(path, '.git')):
+            submodules.append(path)
+            submodules += find_submodules(path)
+    return submodules
+
+
+def count_file_commits(root, revisions=()):
+    """Count commits for each file under root, from one pass of git log.
+
+    Any revisions (or options like '--since') limit the commits counted.
+    Returns a dict, keyed by the absolute path of the file.
+    """
+    command = (['git', 'log', '-z', '--format=', '--name-only',
+                '--no-renames', '--relative'] + list(revisions) +
+               ['--', '.'])
+    p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, cwd=root)
+    counts = collections.defaultdict(int)
+    for field in split_stream(p.stdout):
+        name = to_text(field).lstrip('\n')
+        if name:
+            counts[os.path.join(root, name)] += 1
+    p.communicate()
+    return counts
+
+
+# A conservative estimate of how many times faster git blame is, when the
+# repository has a commit-graph with changed-path Bloom filters
+bloom_speedup = 2.0
+
+# Rough time taken by git blame (without a commit-graph), as the seconds to
+# start it, and the seconds for each byte of the file, times the number of
+# commits that touched it (measured on the synthetic benchmark repository)
+blame_startup = 0.002
+blame_rate = 4e-8
+
+# Bytes of git blame --line-porcelain output for each line, besides the line
+# itself (measured on the recorded fixtures)
+porcelain_line_bytes = 350
+
+
+def tree_target(path, revision):
+    """Find a file or directory in the tree of a revision.
+
+    The path need not exist on disk (e.g. in a bare repository), so is found
+    from the closest directory above it that does. Returns that directory,
+    the path from it (with '/', and '' for the directory itself), and the
+    type of object at the path ('tree', 'blob', or '' if it is not in the
+    tree), or None for the type if the revision is unknown.
+    """
+    top, names = os.path.abspath(path), []
+    while not os.path.isdir(top) and os.path.dirname(top) != top:
+        top, name = os.path.split(top)
+        names.insert(0, name)
+    path = '/'.join(names)
+    if git_output(top, 'rev-parse', '--verify', '--quiet',
+                  revision + '^{tree}') is None:
+        return top, path, None
+    # Paths in the tree are from the top, even in a subdirectory
+    prefix = git_output(top, 'rev-parse', '--show-prefix') or ''
+    kind = git_output(top, 'cat-file', '-t', '%s:%s%s' % (revision, prefix,
+                                                         path))
+    return top, path, kind or ''
+
+
+def optional_module(name):
+    """Import a module that is not always needed, or None if it is missing."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def git_output(root, *args):
+    """Output of a git command, or None if it fails."""
+    p = subprocess.Popen(['git'] + list(args), stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, cwd=root)
+    out, err = p.communicate()
+    if p.returncode:
+        return None
+    return to_text(out).strip()
+
+
+def read_commit_graph(filename, oid=None):
+    """Read the chunk table of a commit-graph file.
+
+    Returns the number of commits, the IDs of the chunks, and whether the
+    commit with the (binary) oid is in the file. Only the header, fan-out
+    table, and the entries needed to find the commit are read.
+    """
+    with open(filename, 'rb') as graph:
+        signature, version, hash_version, num_chunks, bases = struct.unpack(
+            '>4sBBBB', graph.read(8))
+        if signature != b'CGPH':
+            raise ValueError("%s is not a commit-graph file" % filename)
+        table = graph.read(12 * num_chunks)
+        chunks = dict(struct.unpack('>4sQ', table[i:i + 12])
+                      for i in range(0, len(table), 12))
+        graph.seek(chunks[b'OIDF'])
+        fanout = struct.unpack('>256I', graph.read(1024))
+        found = False
+        if oid:
+            first = bytearray(oid)[0]
+            low, high = fanout[first - 1] if first else 0, fanout[first]
+            while low < high and not found:
+                middle = (low + high) // 2
+                graph.seek(chunks[b'OIDL'] + middle * len(oid))
+                entry = graph.read(len(oid))
+                found = entry == oid
+                if entry < oid:
+                    low = middle + 1
+                else:
+                    high = middle
+    return fanout[255], set(chunks), found
+
+
+def commit_graph_state(root):
+    """Check the commit-graph of the repository at root.
+
+    Returns None, if root is not in a git repository.
+    """
+    info = git_output(root, 'rev-parse', '--git-path', 'objects/info')
+    if info is None:
+        return None
+    info = os.path.join(root, info)
+    head = git_output(root, 'rev-parse', '--verify', '-q', 'HEAD')
+    chain = os.path.join(info, 'commit-graphs', 'commit-graph-chain')
+    if os.path.isfile(chain):
+        with open(chain) as chain_file:
+            files = [os.path.join(info, 'commit-graphs',
+                                  'graph-%s.graph' % line.strip())
+                     for line in chain_file if line.strip()]
+    elif os.path.isfile(os.path.join(info, 'commit-graph')):
+        files = [os.path.join(info, 'commit-graph')]
+    else:
+        files = []
+    oid = binascii.unhexlify(head) if head else None
+    commits, changed_paths, covers_head = 0, bool(files), not head
+    for filename in files:
+        try:
+            count, chunk_ids, found = read_commit_graph(filename, oid)
+        except (IOError, OSError, KeyError, ValueError, struct.error):
+            return CommitGraphState(files, 0, False, False)
+        commits += count
+        changed_paths = changed_paths and b'BDAT' in chunk_ids
+        covers_head = covers_head or found
+    return CommitGraphState(files, commits, changed_paths, covers_head)
+
+
+def commit_graph_problems(state):
+    """Why the commit-graph will not speed up git blame, if it won't."""
+    if state is None:
+        return []
+    if not state.files:
+        return ['no commit-graph']
+    problems = []
+    if not state.changed_paths:
+        problems.append('no changed-path Bloom filters')
+    if not state.covers_head:
+        problems.append('commit-graph is out of date')
+    return problems
+
+
+def init_rank_worker(owners):
+    """Give the worker process the owners to use for ranking."""
+    global worker_owners
+    worker_owners = owners
+
+
+def rank_in_worker(blame):
+    return worker_owners.rank_blame(blame)
+
+
+def ordered_imap(pool, func, iterable, window):
+    """Like pool.imap(), but only lets window tasks be outstanding.
+
+    Results are provided in order. Limiting the tasks queued prevents the
+    pool from consuming the iterable (and buffering all the blame output)
+    ahead of the workers.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item, )))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class Report(object):
+    """Prints ranked ownership for files, grouped by directory."""
+
+    def __init__(self, owners, slowest=0):
+        self.owners = owners
+        self.slowest = slowest
+        self.all_authors = []
+        self.timings = []
+        self.old_area = None
+
+    def add(self, result):
+        filename, error, summary = result[:3]
+        self.timings.append((result.elapsed, filename))
+        area, name = os.path.split(filename)
+        if not area:
+            area = '.'
+        if area != self.old_area:
+            print("\n\n%s/\n" % area)
+            self.old_area = area
+        print("%s " % name, end="")
+        if error:
+            print(" <<<<<<<<<< Unable to collect 'git blame' info:", error)
+            return
+        authors, records = summary
+        self.all_authors += authors
+        # Don't alter ordering, as names in sort (date/size) order
+        print("(%s)" % ', '.join(authors))
+        if self.owners.details:
+            for record in records[:self.owners.max_match or None]:
+                print(self.owners.show(record))
+        for symbol, (authors, records) in result.symbols or []:
+            print("    %s (%s)" % (symbol, ', '.join(authors)))
+            if self.owners.details:
+                for record in records[:self.owners.max_match or None]:
+                    print("    %s" % self.owners.show(record))
+
+    def finish(self):
+        print("\n\nAll authors: %s" % ', '.join(
+            sort_by_name(self.all_authors)))
+        if self.owners.description:
+            print("\n\n%s" % self.owners.description)
+        if self.owners.skipped:
+            reasons = collections.Counter(r for f, r in self.owners.skipped)
+            counts = ['%s (%d)' % item for item in sorted(reasons.items())]
+            print("\n\nSkipped %d files: %s" % (len(self.owners.skipped),
+                                               ', '.join(counts)))
+        if self.slowest:
+            print("\n\nSlowest files:\n")
+            for elapsed, filename in heapq.nlargest(self.slowest,
+                                                    self.timings):
+                print("    %8.2fs %s" % (elapsed, filename))
+
+
+class Progress(object):
+    """Shows the progress of a run on stderr, while files are blamed.
+
+    The time remaining is estimated from the size of the files done, as the
+    time to blame a file grows with its size. The status is refreshed by a
+    background thread, so that a file taking a long time is noticed. When
+    stderr is not a terminal, a line is written every log_interval seconds.
+    Sizes are from the files, unless a file_size function is given.
+    """
+
+    interval = 0.5
+    log_interval = 10.0
+
+    def __init__(self, matches, root, stream=None, file_size=None):
+        self.root = root
+        self.stream = stream or sys.stderr
+        self.sizes = {}
+        file_size = file_size or os.path.getsize
+        for filename, ranges in matches:
+            try:
+                self.sizes[filename] = file_size(filename)
+            except OSError:
+                self.sizes[filename] = 0
+        self.total_files = len(self.sizes)
+        self.total_size = sum(self.sizes.values())
+        self.done_files = 0
+        self.done_size = 0
+        self.lines = 0
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.refresher = None
+        self.width = 0
+        self.start_time = time.time()
+
+    def started(self, filename):
+        with self.lock:
+            self.in_flight[filename] = time.time()
+
+    def blamed(self, filename):
+        with self.lock:
+            self.in_flight.pop(filename, None)
+
+    def finished(self, result):
+        with self.lock:
+            self.done_files += 1
+            self.done_size += self.sizes.get(result.filename, 0)
+            if result.stats:
+                self.lines += result.stats['records']
+
+    @classmethod
+    def format_duration(cls, seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+    def status(self, now=None):
+        if now is None:
+            now = time.time()
+        elapsed = max(now - self.start_time, 1e-6)
+        with self.lock:
+            parts = ['%d/%d files (%d%%)' % (
+                self.done_files, self.total_files,
+                100 * self.done_files // max(self.total_files, 1))]
+            parts.append('%d lines/s' % (self.lines / elapsed))
+            if self.total_size:
+                done = float(self.done_size) / self.total_size
+            else:
+                done = float(self.done_files) / max(self.total_files, 1)
+            if done:
+                parts.append('ETA %s' % self.format_duration(
+                    elapsed * (1 - done) / done))
+            if self.in_flight:
+                filename, since = min(self.in_flight.items(),
+                                      key=operator.itemgetter(1))
+                parts.append('slowest: %s (%ds)' % (
+                    os.path.relpath(filename, self.root), now - since))
+        return ', '.join(parts)
+
+    def is_terminal(self):
+        return hasattr(self.stream, 'isatty') and self.stream.isatty()
+
+    def show(self):
+        text = self.status()
+        if self.is_terminal():
+            self.stream.write('\r' + text.ljust(self.width))
+            self.width = len(text)
+        else:
+            self.stream.write(text + '\n')
+        self.stream.flush()
+
+    def refresh(self):
+        interval = self.interval if self.is_terminal() else self.log_interval
+        while not self.stopped.wait(interval):
+            self.show()
+
+    def begin(self):
+        self.start_time = time.time()
+        self.refresher = threading.Thread(target=self.refresh)
+        self.refresher.daemon = True
+        self.refresher.start()
+
+    def end(self):
+        self.stopped.set()
+        if self.refresher:
+            self.refresher.join()
+        self.show()
+        if self.is_terminal():
+            self.stream.write('\n')
+            self.stream.flush()
+
+
+class Stats(object):
+    """Time spent in each stage of a run, and counts of the work done.
+
+    The times for a stage exclude any stage nested within it. They are summed
+    over threads, so with concurrent blames they can add up to more than the
+    run, and child process CPU time is then shared by the overlapping stages
+    (the total for the run is exact). Parsing and sorting are timed where
+    they are done, which may be in worker processes.
+    """
+
+    counter_names = ['files_scanned', 'files_blamed', 'files_skipped',
+                     'blame_errors', 'porcelain_bytes', 'records_parsed',
+                     'cache_hits']
+    time_names = ['wall_seconds', 'cpu_seconds', 'child_cpu_seconds']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict(
+            (name, 0) for name in self.counter_names)
+        self.gauges = collections.OrderedDict()
+        self.start_time = time.time()
+        self.start_times = os.times()
+
+    def add_time(self, stage, times):
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0.0] * len(times))
+            for i, spent in enumerate(times):
+                totals[i] += spent
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        """Record a measurement about the run, other than a time or count."""
+        with self.lock:
+            self.gauges[name] = value
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        outer = getattr(self.local, 'nested', None)
+        nested = self.local.nested = [0.0, 0.0, 0.0]
+        start = clock()
+        try:
+            yield
+        finally:
+            spent = time_since(start)
+            self.local.nested = outer
+            if outer is not None:
+                for i, t in enumerate(spent):
+                    outer[i] += t
+            self.add_time(name, [t - n for t, n in zip(spent, nested)])
+
+    def timed(self, name, iterable, counter=None):
+        """Generator, charging the time to get each item to the stage."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            if counter:
+                self.count(counter)
+            yield item
+
+    def add_result(self, result):
+        """Count a blamed file, and the time taken to parse and sort it."""
+        self.count('files_blamed')
+        if result.error:
+            self.count('blame_errors')
+        if result.stats:
+            self.add_time('parse', result.stats['parse'])
+            self.add_time('sort', result.stats['sort'])
+            self.count('porcelain_bytes', result.stats['bytes'])
+            self.count('records_parsed', result.stats['records'])
+
+    def as_dict(self):
+        now = os.times()
+        total = [time.time() - self.start_time,
+                 sum(now[:2]) - sum(self.start_times[:2]),
+                 sum(now[2:4]) - sum(self.start_times[2:4])]
+        return {'stages': collections.OrderedDict(
+                    (stage, dict(zip(self.time_names, times)))
+                    for stage, times in self.stages.items()),
+                'total': dict(zip(self.time_names, total)),
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges)}
+
+    def as_openmetrics(self):
+        """The stats in the OpenMetrics text format."""
+        data = self.as_dict()
+        lines = []
+        for name in self.time_names:
+            metric = 'whodunit_stage_' + name
+            lines.append('# TYPE %s gauge' % metric)
+            for stage, times in data['stages'].items():
+                lines.append('%s{stage="%s"} %.6f' % (metric, stage,
+                                                      times[name]))
+            metric = 'whodunit_run_' + name
+            lines.append('# TYPE %s gauge' % metric)
+            lines.append('%s %.6f' % (metric, data['total'][name]))
+        for name, value in self.counters.items():
+            metric = 'whodunit_' + name
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s_total %d' % (metric, value))
+        for name, value in self.gauges.items():
+            metric = 'whodunit_' + name
+            lines.append('# TYPE %s gauge' % metric)
+            lines.append('%s %s' % (metric, value))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, format='json'):
+        with open(filename, 'w') as stats_file:
+            if format == 'openmetrics':
+                stats_file.write(self.as_openmetrics())
+            else:
+                json.dump(self.as_dict(), stats_file, indent=2)
+                stats_file.write('\n')
+
+
+def write_results(filename, owners, args, results):
+    """Save ownership results in JSON, so that they can be merged later.
+
+    File paths are relative to the root, so that results from different
+    machines can be combined.
+    """
+    files = []
+    for result in results:
+        authors, records = result.summary or ([], [])
+        files.append({'path': os.path.relpath(result.filename, owners.root),
+                      'error': result.error,
+                      'elapsed': result.elapsed,
+                      'authors': authors,
+                      'records': [list(record) for record in records]})
+    data = {'version': 1,
+            'root': owners.root,
+            'sort_by': args.sort_by,
+            'details': owners.details,
+            'verbose': owners.verbose,
+            'max': owners.max_match,
+            'shard': args.shard,
+            'files': files,
+            'skipped': [[os.path.relpath(f, owners.root), reason]
+                        for f, reason in owners.skipped]}
+    with open(filename, 'w') as results_file:
+        json.dump(data, results_file)
+
+
+def read_results(filename):
+    """Load saved results, providing the settings and file ownerships."""
+    with open(filename) as results_file:
+        data = json.load(results_file)
+    data['files'] = [
+        FileOwnership(f['path'], f['error'],
+                      None if f['error'] else
+                      (f['authors'],
+                       [SummaryRecord(*record) for record in f['records']]),
+                      f['elapsed'])
+        for f in data['files']]
+    return data
+
+
+def prepare(argv):
+    """Write a commit-graph, with changed-path Bloom filters, if needed."""
+    parser = setup_prepare_parser()
+    args = parser.parse_args(argv)
+    root = os.path.abspath(args.root)
+    state = commit_graph_state(root)
+    if state is None:
+        parser.error("%s is not in a git repository" % args.root)
+    problems = commit_graph_problems(state)
+    if not problems:
+        print("Commit-graph is up to date, with %d commits and changed "
+              "paths" % state.commits)
+        return
+    print("Commit-graph needs writing: %s" % ', '.join(problems))
+    if args.check:
+        sys.exit(1)
+    p = subprocess.Popen(['git', 'commit-graph', 'write', '--reachable',
+                          '--changed-paths'], cwd=root)
+    if p.wait():
+        parser.error("Unable to write the commit-graph")
+    state = commit_graph_state(root)
+    print("Wrote commit-graph, with %d commits and changed paths" %
+          state.commits)
+
+
+def merge(argv):
+    """Combine saved results (e.g. from shards) into one report."""
+    parser = setup_merge_parser()
+    args = parser.parse_args(argv)
+    all_results = [read_results(filename) for filename in args.results]
+    first = all_results[0]
+    for results in all_results[1:]:
+        if results['sort_by'] != first['sort_by']:
+            parser.error("Cannot merge results sorted by %s and %s" %
+                         (first['sort_by'], results['sort_by']))
+    if first['sort_by'] == 'cover':
+        owners = CoverageOwners(first['root'], first['verbose'])
+    else:
+        owner_class = {'size': SizeOwners,
+                       'history': HistoryOwners}.get(first['sort_by'],
+                                                     DateOwners)
+        owners = owner_class(first['root'], details=first['details'],
+                             verbose=first['verbose'],
+                             max_match=first['max'])
+    files = {}
+    for results in all_results:
+        files.update((f.filename, f) for f in results['files'])
+        owners.skipped += [(os.path.join(owners.root, name), reason)
+                           for name, reason in results['skipped']]
+    report = Report(owners, args.slowest)
+    for name in sorted(files, key=os.path.split):
+        report.add(files[name]._replace(
+            filename=os.path.join(owners.root, name)))
+    report.finish()
+
+
+def ownership_timeline(owners, revisions, jobs=1, timeout=None, max_size=0,
+                       all_files=False, stats=None, known=None,
+                       identity='author'):
+    """Lines owned by each author, in each file, at each revision.
+
+    The files are listed from each revision's tree, and only the ones with a
+    path and blob that have not been blamed at an earlier revision (or are
+    not already known, e.g. from a cache) are blamed, so unchanged files
+    cost nothing. Authors are identified by the identity attribute of the
+    commits. Provides (revision, {path: {author: lines}}, number of files
+    blamed) for each revision.
+    """
+    if stats is None:
+        stats = Stats()
+    owners.details = True  # Need the line counts of all the authors
+    if known is None:
+        known = {}  # {(path, blob id): {author: lines}}
+    for revision in revisions:
+        owners.revision = revision
+        owners.history_bounds = [revision]
+        matches = owners.collect_modules()
+        if not all_files:
+            matches = owners.exclude_unblameable(matches, max_size)
+        files = {}
+        changed = []
+        for filename, ranges in matches:
+            key = (os.path.relpath(filename, owners.root),
+                   owners.blob_ids[filename])
+            if key in known:
+                files[key[0]] = known[key]
+                stats.count('cache_hits')
+            else:
+                changed.append((filename, ranges))
+        blob_ids = owners.blob_ids  # Before the next revision replaces them
+        for result in owners.collect_ownership(changed, jobs=jobs,
+                                               timeout=timeout, stats=stats):
+            path = os.path.relpath(result.filename, owners.root)
+            if result.error:
+                print("whodunit: %s at %s: %s" % (path, revision,
+                                                  result.error.strip()),
+                      file=sys.stderr)
+                continue
+            counts = collections.Counter()
+            for record in result.summary[1]:
+                counts[getattr(record, identity)] += record.line_count
+            files[path] = known[path, blob_ids[result.filename]] = counts
+        yield (revision, files, len(changed))
+
+
+def directory_ownership(files):
+    """Lines owned by each author, under each directory.
+
+    Takes {path: {author: lines}} and provides the same for each directory
+    (with '.' for the whole tree), including all of the files below it.
+    """
+    directories = collections.defaultdict(collections.Counter)
+    for path, counts in files.items():
+        area = os.path.dirname(path)
+        while True:
+            directories[area or '.'].update(counts)
+            if not area:
+                break
+            area = os.path.dirname(area)
+    return directories
+
+
+def read_ownership_cache(filename, mailmap=None):
+    """Lines by each author, for each (path, blob id), saved by a run.
+
+    A missing or unreadable cache is treated as empty. With a mailmap, the
+    cache is only used if it was saved with the same mailmap, and the saved
+    identities are added to it.
+    """
+    try:
+        with open(filename) as cache:
+            data = json.load(cache)
+    except (IOError, OSError, ValueError):
+        return {}
+    if data.get('version') != 1:
+        return {}
+    if mailmap:
+        if data.get('mailmap') != mailmap.fingerprint():
+            return {}  # Authors may be mapped differently
+        mailmap.identities.update(
+            ((name, mail), (mapped_name, mapped_mail)) for
+            name, mail, mapped_name, mapped_mail in data.get('identities', []))
+    return dict(((path, blob_id), collections.Counter(counts))
+                for path, blob_id, counts in data['files'])
+
+
+def write_ownership_cache(filename, known, blob_ids, mailmap=None, keep=()):
+    """Save the known line counts, dropping old blobs of current paths.
+
+    The blob_ids are {path: blob id} for the files just processed. Others
+    are kept, so that runs on parts of the tree share the cache, as are any
+    (path, blob id) to keep (e.g. from an earlier revision). With a mailmap,
+    the resolved identities are saved too.
+    """
+    files = [[path, blob_id, counts]
+             for (path, blob_id), counts in sorted(known.items())
+             if blob_ids.get(path, blob_id) == blob_id or
+             (path, blob_id) in keep]
+    data = {'version': 1, 'files': files}
+    if mailmap:
+        data['mailmap'] = mailmap.fingerprint()
+        data['identities'] = [list(identity + mapped) for identity, mapped
+                              in sorted(mailmap.identities.items())]
+    temporary = filename + '.tmp'
+    with open(temporary, 'w') as cache:
+        json.dump(data, cache)
+    os.rename(temporary, filename)  # Never leave a partly written cache
+
+
+class OwnershipCache(object):
+    """The results cache for a command, with the part of it under root.
+
+    The cache file (whodunit-cache.json in the git directory, unless given
+    with --cache, or none with --no-cache) has paths from the top of the
+    tree, so any directory can use it. The known results are for the files
+    under root, with paths relative to it, for ownership_timeline to use and
+    add to.
+    """
+
+    def __init__(self, root, args, mailmap=None):
+        self.root = root
+        self.mailmap = mailmap
+        self.filename = args.cache
+        if not self.filename and not args.no_cache:
+            self.filename = os.path.join(root, git_output(
+                root, 'rev-parse', '--git-path', 'whodunit-cache.json'))
+        self.prefix = git_output(root, 'rev-parse', '--show-prefix') or ''
+        self.cached = {}
+        if self.filename:
+            self.cached = read_ownership_cache(self.filename, mailmap)
+        self.known = dict(((path[len(self.prefix):], blob_id), counts)
+                          for (path, blob_id), counts in self.cached.items()
+                          if path.startswith(self.prefix))
+
+    def save(self, owners, keep=()):
+        """Save the known results, for the files owners last listed.
+
+        Any (path, blob id) to keep, from earlier revisions, are saved too.
+        """
+        if not self.filename:
+            return
+        prefix = self.prefix
+        self.cached.update(((prefix + path, blob_id), counts)
+                           for (path, blob_id), counts in self.known.items())
+        write_ownership_cache(self.filename, self.cached, dict(
+            (prefix + os.path.relpath(path, self.root), blob_id)
+            for path, blob_id in owners.blob_ids.items()), self.mailmap,
+            set((prefix + path, blob_id) for path, blob_id in keep))
+
+
+def primary_owner(counts):
+    """Author with the most lines (first by name, on a tie), and share."""
+    total = float(sum(counts.values()))
+    if not total:
+        return (None, 0.0)
+    author, lines = min(counts.items(), key=lambda item: (-item[1], item[0]))
+    return (author, lines / total)
+
+
+def owner_changes(old, new):
+    """Names with a different primary owner in new than in old.
+
+    Takes {name: {author: lines}} for each side (e.g. files, or directories
+    from directory_ownership). Returns a list of (name, old owner, old
+    share, new owner, new share), for names on both sides, sorted by name.
+    """
+    changes = []
+    for name in sorted(set(old) & set(new)):
+        old_owner, old_share = primary_owner(old[name])
+        new_owner, new_share = primary_owner(new[name])
+        if old_owner != new_owner:
+            changes.append((name, old_owner, old_share, new_owner, new_share))
+    return changes
+
+
+def share_changes(old, new, min_change=0.05):
+    """Authors whose share of the lines changed by at least min_change.
+
+    Takes {name: {author: lines}} for each side, and returns {name:
+    [(author, change)]}, largest changes first, for names on both sides.
+    """
+    changes = {}
+    for name in set(old) & set(new):
+        old_total = float(sum(old[name].values())) or 1.0
+        new_total = float(sum(new[name].values())) or 1.0
+        deltas = []
+        for author in set(old[name]) | set(new[name]):
+            change = (new[name].get(author, 0) / new_total -
+                      old[name].get(author, 0) / old_total)
+            if abs(change) >= min_change:
+                deltas.append((author, change))
+        if deltas:
+            changes[name] = sorted(deltas,
+                                   key=lambda item: (-abs(item[1]), item[0]))
+    return changes
+
+
+def codeowners_entries(directories, threshold=0.2, max_owners=3, prefix=''):
+    """CODEOWNERS patterns and owners, from the lines in each directory.
+
+    Takes {directory: {author: lines}}, for every directory (with '.' for
+    the whole tree), as from directory_ownership. The owners are the authors
+    with at least threshold of the lines (at most max_owners, and always at
+    least the top one). Directories with the same owners as the closest
+    directory listed above them are left out. The directories are under
+    prefix (e.g. 'pkg/'), when not from the top of the repository. Returns a
+    list of (pattern, owners), with parents before their subdirectories.
+    """
+    entries = []
+    effective = {}
+    for area in sorted(directories,
+                       key=lambda area: [] if area == '.' else
+                       area.split('/')):
+        counts = directories[area]
+        total = float(sum(counts.values()))
+        if not total:
+            continue
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        chosen = [author for author, lines in ranked[:max_owners]
+                  if lines / total >= threshold] or [ranked[0][0]]
+        inherited = effective.get(os.path.dirname(area) or '.')
+        if area != '.' and inherited and set(inherited) == set(chosen):
+            effective[area] = inherited
+            continue
+        effective[area] = chosen
+        path = prefix if area == '.' else prefix + area + '/'
+        entries.append(('/%s' % path if path else '*', chosen))
+    return entries
+
+
+def codeowners(argv):
+    """Write a CODEOWNERS file, from the lines owned in each directory."""
+    parser = setup_codeowners_parser()
+    args = parser.parse_args(argv)
+    root = os.path.abspath(args.root)
+    if not os.path.isdir(root):
+        parser.error("Must specify a directory in the repository")
+    if git_output(root, 'rev-parse', '--verify', '--quiet',
+                  args.rev + '^{tree}') is None:
+        parser.error("Unknown revision: %s" % args.rev)
+    if not 0 < args.threshold <= 1:
+        parser.error("Threshold must be more than 0, and at most 1")
+    if args.max_owners < 1:
+        parser.error("Must have at least one owner")
+    owners = SizeOwners(root, includes=args.include, excludes=args.exclude)
+    if not args.no_mailmap:
+        owners.mailmap = Mailmap.for_repository(root)
+    cache = OwnershipCache(root, args, owners.mailmap)
+    stats = Stats()
+    for revision, files, blamed in ownership_timeline(
+            owners, [args.rev], args.jobs, args.timeout, args.max_size,
+            args.all_files, stats, cache.known, identity='author_mail'):
+        print("%d files, %d blamed, %d from the cache" % (
+            len(files), blamed, stats.counters['cache_hits']),
+            file=sys.stderr)
+    cache.save(owners)
+    if owners.mailmap:
+        owners.mailmap.close()
+    lines = ["# Generated by whodunit codeowners, from the lines owned at %s"
+             % args.rev, ""]
+    for pattern, emails in codeowners_entries(
+            directory_ownership(files), args.threshold, args.max_owners,
+            cache.prefix):
+        lines.append("%s %s" % (pattern.replace(' ', '\\ '), ' '.join(
+            email.strip('<>') for email in emails)))
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write('\n'.join(lines) + '\n')
+    else:
+        print('\n'.join(lines))
+
+
+def timeline(argv):
+    """Show the share of lines owned by each author, at several revisions."""
+    parser = setup_timeline_parser()
+    args = parser.parse_args(argv)
+    root = os.path.abspath(args.root)
+    if not os.path.isdir(root):
+        parser.error("Must specify a directory in the repository")
+    for revision in args.revisions:
+        if git_output(root, 'rev-parse', '--verify', '--quiet',
+                      revision + '^{tree}') is None:
+            parser.error("Unknown revision: %s" % revision)
+    owners = SizeOwners(root, includes=args.include, excludes=args.exclude)
+    if not args.no_mailmap:
+        owners.mailmap = Mailmap.for_repository(root)
+    series = []
+    for revision, files, blamed in ownership_timeline(
+            owners, args.revisions, args.jobs, args.timeout, args.max_size,
+            args.all_files):
+        series.append((revision, files, directory_ownership(files)))
+        print("%s: %d files, %d blamed" % (revision, len(files), blamed),
+              file=sys.stderr)
+    if owners.mailmap:
+        owners.mailmap.close()
+    shares = []
+    for revision, files, directories in series:
+        total = float(sum(directories['.'].values())) or 1.0
+        shares.append(dict((author, lines / total)
+                           for author, lines in directories['.'].items()))
+    authors = sorted(set().union(*shares),
+                     key=lambda author: (-shares[-1].get(author, 0), author))
+    width = max([len(author) for author in authors] + [6])
+    columns = [max(len(revision), 6) for revision in args.revisions]
+    print("%-*s %s" % (width, 'Author', ' '.join(
+        '%*s' % (column, revision)
+        for column, revision in zip(columns, args.revisions))))
+    for author in authors:
+        print("%-*s %s" % (width, author, ' '.join(
+            '%*.1f%%' % (column - 1, 100 * share.get(author, 0))
+            for column, share in zip(columns, shares))))
+    if args.json:
+        data = {'root': root, 'revisions': args.revisions,
+                'files': dict((revision, files)
+                              for revision, files, directories in series),
+                'directories': dict((revision, directories)
+                                    for revision, files, directories in
+                                    series)}
+        with open(args.json, 'w') as json_file:
+            json.dump(data, json_file, sort_keys=True)
+
+
+def diff(argv):
+    """Show the files and directories that changed owner between revisions.
+
+    Stored results (see OwnershipCache) are joined, so only files without
+    results for their contents at either revision are blamed.
+    """
+    parser = setup_diff_parser()
+    args = parser.parse_args(argv)
+    root = os.path.abspath(args.root)
+    if not os.path.isdir(root):
+        parser.error("Must specify a directory in the repository")
+    for revision in (args.old, args.new):
+        if git_output(root, 'rev-parse', '--verify', '--quiet',
+                      revision + '^{tree}') is None:
+            parser.error("Unknown revision: %s" % revision)
+    if not 0 <= args.min_change <= 1:
+        parser.error("Minimum change must be from 0 to 1")
+    owners = SizeOwners(root, includes=args.include, excludes=args.exclude)
+    if not args.no_mailmap:
+        owners.mailmap = Mailmap.for_repository(root)
+    cache = OwnershipCache(root, args, owners.mailmap)
+    stats = Stats()
+    sides = []
+    keep = set()  # Results for the old revision are kept in the cache too
+    for revision, files, blamed in ownership_timeline(
+            owners, [args.old, args.new], args.jobs, args.timeout,
+            args.max_size, args.all_files, stats, cache.known,
+            identity='author_mail'):
+        print("%s: %d files, %d blamed" % (revision, len(files), blamed),
+              file=sys.stderr)
+        keep.update((os.path.relpath(path, root), blob_id)
+                    for path, blob_id in owners.blob_ids.items())
+        sides.append((files, directory_ownership(files)))
+    cache.save(owners, keep)
+    if owners.mailmap:
+        owners.mailmap.close()
+    (old_files, old_areas), (new_files, new_areas) = sides
+    file_changes = owner_changes(old_files, new_files)
+    area_changes = owner_changes(old_areas, new_areas)
+    shares = share_changes(old_areas, new_areas, args.min_change)
+
+    def owner(author, share):
+        return "%s (%d%%)" % (author.strip('<>'), round(100 * share))
+
+    def area_key(area):
+        return [] if area == '.' else area.split('/')
+    print("Ownership drift from %s to %s\n" % (args.old, args.new))
+    print("Files with a new primary owner (%d of %d, %d added, %d "
+          "removed):\n" % (len(file_changes), len(new_files),
+                           len(set(new_files) - set(old_files)),
+                           len(set(old_files) - set(new_files))))
+    if not file_changes:
+        print("    None")
+    for name, old_owner, old_share, new_owner, new_share in file_changes:
+        print("    %s: %s -> %s" % (name, owner(old_owner, old_share),
+                                    owner(new_owner, new_share)))
+    print("\nDirectories with a new primary owner:\n")
+    for name, old_owner, old_share, new_owner, new_share in sorted(
+            area_changes, key=lambda change: area_key(change[0])):
+        print("    %s: %s -> %s" % (name, owner(old_owner, old_share),
+                                    owner(new_owner, new_share)))
+    if not area_changes:
+        print("    None")
+    print("\nShare changes of at least %g%%:\n" % (100 * args.min_change))
+    for name in sorted(shares, key=area_key):
+        print("    %s: %s" % (name, ', '.join(
+            "%s %+.1f%%" % (author.strip('<>'), 100 * change)
+            for author, change in shares[name])))
+    if not shares:
+        print("    None")
+    if args.json:
+        data = {'root': root, 'old': args.old, 'new': args.new,
+                'files': [list(change) for change in file_changes],
+                'directories': [list(change) for change in area_changes],
+                'file_shares': share_changes(old_files, new_files,
+                                             args.min_change),
+                'directory_shares': shares}
+        with open(args.json, 'w') as json_file:
+            json.dump(data, json_file, sort_keys=True)
+
+
 def sort_by_name(names):
     """Sort by last name, uniquely."""
 
@@ -479,20 +3147,96 @@ def sort_by_name(names):
 
 def validate(parser, provided_args=None):
     args = parser.parse_args(provided_args)
+    args.root, separator, args.symbol = args.root.partition(symbol_separator)
+    args.tree_dir, args.tree_file = '', False
+    is_dir, is_file = os.path.isdir(args.root), os.path.isfile(args.root)
+    if args.rev:
+        if args.sort_by == 'cover' or args.sample or args.sample_files:
+            parser.error("Coverage and sampling need the files checked out, "
+                         "so cannot be used with --rev")
+        # The file or directory is looked for in the revision's tree, so
+        # need not be in the working tree (or there be one)
+        top, path, kind = tree_target(args.root, args.rev)
+        if kind is None:
+            parser.error("Unknown revision: %s" % args.rev)
+        if not kind:
+            parser.error("No file or directory %s in %s" % (args.root,
+                                                            args.rev))
+        is_dir, is_file = kind == 'tree', kind == 'blob'
+        if is_dir or is_file:
+            args.root, args.tree_dir, args.tree_file = top, path, is_file
+    if args.symbol or args.symbols:
+        if args.sort_by not in ('date', 'size') or args.sample or \
+                args.sample_files:
+            parser.error("Symbols can only be ranked by date or size, "
+                         "without sampling")
+        if args.symbol and not is_file:
+            parser.error("Must specify a file, for a symbol in it")
     if args.sort_by == 'cover':
         if not os.path.isdir(args.root):
             parser.error("Must specify a directory, when sorting by coverage")
-        if not os.path.isdir(os.path.join(args.root, 'cover')):
-            parser.error("Missing 'cover' directory under root of repo")
+        reports = os.path.join(args.root, 'cover')
+        data_file = os.path.join(args.root, '.coverage')
+        if not args.coverage_data and not os.path.isdir(reports) and \
+                os.path.isfile(data_file):
+            args.coverage_data = data_file
+        if not args.coverage_data and not os.path.isdir(reports):
+            parser.error("Missing 'cover' directory, or .coverage data "
+                         "file, under root of repo")
+        if args.coverage_data and not os.path.isfile(args.coverage_data):
+            parser.error("Coverage data file %s not found" %
+                         args.coverage_data)
         if args.details:
             parser.error("Details option is implied, when using 'cover' mode")
-        if args.filter != "*":
+        if args.filter != "*" or args.include or args.exclude:
             parser.error("You cannot filter modules, when in 'cover' mode")
         if args.max != 0:
             parser.error("Cannot specify a limit to number of users/commits "
                          "to show, when sorting coverage reports")
-    elif not os.path.isdir(args.root) and not os.path.isfile(args.root):
+    elif not is_dir and not is_file:
         parser.error("Must specify a file or a directory to process")
+    elif args.coverage_data:
+        parser.error("Coverage data is only used, when sorting by coverage")
+    if args.other_roots or args.recurse_submodules:
+        if not all(os.path.isdir(root)
+                   for root in [args.root] + args.other_roots):
+            parser.error("Must specify directories, for several "
+                         "repositories")
+        if args.sort_by in ('cover', 'history') or args.rev or args.stdin:
+            parser.error("Several repositories cannot be used with --rev, "
+                         "--stdin, or sorting by coverage or history")
+    if args.processes < 0:
+        parser.error("Number of processes cannot be negative")
+    if args.jobs < 1:
+        parser.error("Must have at least one job")
+    if args.max_size < 0:
+        parser.error("Maximum file size cannot be negative")
+    if args.since and args.since_rev:
+        parser.error("Cannot specify both --since and --since-rev")
+    if args.sample < 0 or args.sample_files < 0:
+        parser.error("Sample sizes cannot be negative")
+    if (args.sample or args.sample_files) and args.sort_by != 'size':
+        parser.error("Sampling is only available, when sorting by size")
+    if (args.plan or args.window) and args.sort_by == 'history':
+        parser.error("Git blame is not used, when sorting by history")
+    if args.window < 0:
+        parser.error("The window cannot be negative")
+    if args.window_jobs < 1 or args.window_memory < 1:
+        parser.error("Need at least one window job, and one MB of memory")
+    if args.npz:
+        if args.sort_by not in ('date', 'size') or args.sample or \
+                args.sample_files:
+            parser.error("Ownership tables need git blame, without sampling")
+        if optional_module('numpy') is None:
+            parser.error("NumPy is needed for --npz")
+    if args.stdin:
+        if not is_dir:
+            parser.error("Must specify a directory, when reading queries")
+        if args.sort_by == 'cover' or args.sample or args.sample_files:
+            parser.error("Cannot read queries, with coverage or sampling")
+        if args.progress:
+            parser.error("Progress needs all of the files up front, so "
+                         "cannot be shown when reading queries")
     args.root = os.path.abspath(args.root)
     return args
 
@@ -500,38 +3244,244 @@ def validate(parser, provided_args=None):
 def build_owner(args):
     """Factory for creating owners, based on --sort option."""
     if args.sort_by == 'cover':
-        return CoverageOwners(args.root, args.verbose)
-    if os.path.isdir(args.root):
-        pass
-    else:  # File
+        return CoverageOwners(args.root, args.verbose,
+                              args.coverage_data and
+                              os.path.abspath(args.coverage_data))
+    if args.tree_file:  # File in the revision's tree
+        args.tree_dir, args.filter = posixpath.split(args.tree_dir)
+    elif not args.tree_dir and not os.path.isdir(args.root):  # File
         args.root, args.filter = os.path.split(args.root)
     if args.sort_by == 'date':
         return DateOwners(args.root, args.filter, args.details,
-                          args.verbose, args.max)
+                          args.verbose, args.max, args.include, args.exclude)
+    elif args.sort_by == 'history':
+        return HistoryOwners(args.root, args.filter, args.details,
+                             args.verbose, args.max, args.include,
+                             args.exclude)
+    elif args.sample or args.sample_files:
+        return SampledOwners(args.root, args.filter, args.details,
+                             args.verbose, args.max, args.include,
+                             args.exclude, args.sample, args.sample_files)
     else:  # by size
         return SizeOwners(args.root, args.filter, args.details,
-                          args.verbose, args.max)
-
-
-def main():
-    args = validate(setup_parser())
+                          args.verbose, args.max, args.include, args.exclude)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in commands:
+        return commands[argv[0]](argv[1:])
+    args = validate(setup_parser(), argv)
+    stats = Stats()
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        report_ownership(args, stats)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+    if args.stats:
+        stats.write(args.stats, args.stats_format)
+
+
+def report_ownership(args, stats):
     owners = build_owner(args)
+    owners.keep_records = bool(args.results)
+    owners.history_bounds = history_bounds(args)
+    owners.revision = args.rev
+    owners.tree_dir = args.tree_dir
+    owners.by_symbol = args.symbols
+    owners.window = args.window
+    owners.window_jobs = args.window_jobs
+    owners.window_memory = args.window_memory * 1024 * 1024
+    owners.streaming = args.stdin
+    other_roots = [os.path.abspath(root) for root in args.other_roots]
+    if args.recurse_submodules:
+        for root in [owners.root] + list(other_roots):
+            other_roots += find_submodules(root)
+    owners.other_roots = other_roots
+    owners.use_mailmap = not args.no_mailmap
+    if not args.no_mailmap:
+        owners.mailmap = Mailmap.for_repository(owners.root)
+        owners.other_mailmaps = dict(
+            (root, Mailmap.for_repository(root)) for root in other_roots)
+    if args.npz:
+        owners.table = OwnershipTable(owners.root)
+    graph_problems = []
+    if args.sort_by != 'history':  # Otherwise git blame isn't used
+        graph_problems = commit_graph_problems(commit_graph_state(owners.root))
+        stats.set('commit_graph_prepared', int(not graph_problems))
+    if graph_problems:
+        print("whodunit: warning: %s, so git blame will be slower (run "
+              "'whodunit prepare %s')" % (', '.join(graph_problems),
+                                          owners.root), file=sys.stderr)
 
     # Generators to get the owner info
-    matches = owners.collect_modules()
-    blame_infos = owners.collect_blame_info(matches)
-
-    all_authors = []
-    for info in blame_infos:
-        owners.parse_info_records(info)
-        owners.sort()
-        top_n = owners.unique_authors(args.max)
-        all_authors += top_n
-        # Don't alter ordering, as names in sort (date/size) order
-        print("(%s)" % ', '.join(top_n))
-        if owners.details:
-            owners.show_details(args.max)
-    print("\n\nAll authors: %s" % ', '.join(sort_by_name(all_authors)))
+    if args.stdin:
+        queries = owners.read_queries(getattr(sys.stdin, 'buffer', sys.stdin),
+                                      b'\0' if args.null else b'\n')
+        matches = stats.timed('enumerate', queries, 'files_scanned')
+        if args.shard:
+            matches = owners.select_shard(matches, args.shard)
+    elif args.symbol:
+        target = os.path.join(owners.root, owners.tree_dir, owners.filter)
+        matches = stats.timed('enumerate', [(
+            target + symbol_separator + args.symbol, [])], 'files_scanned')
+    else:
+        # Files of all the repositories are blamed together, so that they
+        # share the jobs and processes
+        matches = itertools.chain.from_iterable(
+            list_repository(repository, args, stats) for repository in
+            [owners] + [owners.for_root(root) for root in other_roots])
+    if args.plan:
+        return plan_ownership(owners, matches, args, graph_problems)
+    progress = None
+    if args.progress:
+        matches = list(matches)  # Need the total number of files up front
+        progress = Progress(matches, owners.root, file_size=owners.file_size)
+        progress.begin()
+    report = Report(owners, args.slowest)
+    results = []
+    try:
+        for result in owners.collect_ownership(matches, args.processes,
+                                               args.jobs, args.timeout, stats,
+                                               progress):
+            with stats.stage('report'):
+                report.add(result)
+                if args.stdin:  # Caller may be waiting for each result
+                    sys.stdout.flush()
+            if args.results:
+                results.append(result)
+    finally:
+        if progress:
+            progress.end()
+    with stats.stage('report'):
+        report.finish()
+    stats.count('files_skipped', len(owners.skipped))
+    if graph_problems:
+        blame_time = stats.stages.get('blame', [0.0])[0]
+        stats.set('estimated_blame_savings_seconds',
+                  round(blame_time * (1 - 1 / bloom_speedup), 3))
+    if args.results:
+        with stats.stage('save'):
+            write_results(args.results, owners, args, results)
+    if args.npz:
+        with stats.stage('save'):
+            owners.table.save(args.npz)
+    for mailmap in [owners.mailmap] + list(owners.other_mailmaps.values()):
+        if mailmap:
+            mailmap.close()
+
+
+def plan_ownership(owners, matches, args, graph_problems, stream=None):
+    """Show the estimated cost of blaming the files, without blaming them.
+
+    Uses the size, number of lines (unless from a revision), and commits
+    that touched each file (from one pass over the history), along with the
+    lines that would be blamed, for coverage or sampling.
+    """
+    stream = stream or sys.stdout
+    if args.sample or args.sample_files:
+        matches = owners.sample_matches(matches)
+    commit_counts = owners.count_commits()
+    speedup = 1.0 if graph_problems else bloom_speedup
+    rows = []
+    for filename, ranges in matches:
+        size = owners.file_size(filename)
+        lines = 0
+        if not owners.revision:
+            try:
+                lines = count_lines(filename)
+            except (IOError, OSError):
+                pass
+        commits = commit_counts.get(filename, 0)
+        blamed = sum(last - first + 1 for first, last in ranges) or lines
+        share = float(blamed) / lines if ranges and lines else 1.0
+        seconds = blame_startup + (blame_rate * size * share * (1 + commits) /
+                                   speedup)
+        rows.append((seconds, filename, lines, blamed, size, commits))
+    total = sum(row[0] for row in rows)
+    longest = max([row[0] for row in rows] + [0.0])
+    duration = Progress.format_duration
+    top = args.slowest or 10
+
+    def show(text=''):
+        print(text, file=stream)
+    show("Plan for %s (nothing was blamed):\n" % owners.root)
+    show("    %-22s %d (%d skipped)" % ('Files to blame:', len(rows),
+                                        len(owners.skipped)))
+    if not owners.revision:
+        show("    %-22s %d of %d" % ('Lines to blame:',
+                                     sum(row[3] for row in rows),
+                                     sum(row[2] for row in rows)))
+    show("    %-22s %d" % ('Bytes:', sum(row[4] for row in rows)))
+    commits = sorted(row[5] for row in rows) or [0]
+    show("    %-22s median %d, most %d" % ('Commits per file:',
+                                           commits[len(commits) // 2],
+                                           commits[-1]))
+    show("    %-22s %s, with %d %s %s" % (
+        'Estimated blame time:', duration(total), args.jobs,
+        'job' if args.jobs == 1 else 'jobs',
+        duration(max(total / args.jobs, longest))))
+    if graph_problems:
+        show("    %-22s %s (could be %gx faster, after 'whodunit prepare')" %
+             ('Commit-graph:', ', '.join(graph_problems), bloom_speedup))
+    areas = collections.Counter()
+    for row in rows:
+        areas[os.path.relpath(os.path.dirname(row[1]), owners.root)] += row[0]
+    show("\nMost costly directories:\n")
+    for area, seconds in areas.most_common(top):
+        show("    %s %3d%% %s" % (duration(seconds),
+                                  round(100 * seconds / (total or 1)), area))
+    show("\nMost costly files:\n")
+    for seconds, filename, lines, blamed, size, commits in heapq.nlargest(
+            top, rows):
+        show("    %s %8d lines %6d commits %s" % (
+            duration(seconds), blamed, commits,
+            os.path.relpath(filename, owners.root)))
+
+
+def list_repository(owners, args, stats):
+    """Generator of the files to blame in a repository.
+
+    Files asked for with --stdin or a symbol are always blamed, so this is
+    only used when looking for files.
+    """
+    matches = stats.timed('enumerate', owners.collect_modules(),
+                          'files_scanned')
+    if args.shard:
+        matches = owners.select_shard(matches, args.shard)
+    if not args.all_files:
+        matches = stats.timed('classify', owners.exclude_unblameable(
+            matches, args.max_size))
+    return matches
+
+
+def history_bounds(args):
+    """Git options to limit how far back in history to look."""
+    if args.since_rev:
+        return ['%s..%s' % (args.since_rev, args.rev or '')]
+    bounds = []
+    if args.since:
+        bounds.append('--since=%s' % args.since)
+    if args.rev:
+        bounds.append(args.rev)
+    return bounds
+
+
+def shard_spec(value):
+    """Convert a shard argument of the form i/N, into a tuple."""
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Shard must be of the form i/N")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("Shard index must be from 1 to N")
+    return (index, count)
 
 
 def setup_parser():
@@ -546,10 +3496,284 @@ def setup_parser():
                         help='Maximum number of users/commits to show. '
                         'Default=0 (show all).')
     parser.add_argument('-s', '--sort', dest='sort_by', action='store',
-                        choices={'date', 'size', 'cover'}, default='date',
-                        help="Sort order for report. Default='date'.")
+                        choices={'date', 'size', 'history', 'cover'},
+                        default='date',
+                        help="Sort order for report. Default='date'. "
+                        "'history' is approximate, from the lines each "
+                        "author added, without running git blame.")
+    parser.add_argument('--coverage-data', action='store', metavar='FILE',
+                        help="coverage.py data file to find the missing and "
+                        "partial lines in, when sorting by coverage, "
+                        "instead of HTML reports in the cover directory. "
+                        "Default is .coverage, if there is no cover "
+                        "directory.")
     parser.add_argument('-f', '--filter', action='store', default="*",
                         help="Filter regular expression for file name. "
                              "Default='*', which includes hidden files")
-    parser.add_argument(dest='root', metavar='file-or-dir')
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        help="Only process files whose path (relative to "
+                        "the directory) matches. Can be repeated.")
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help="Skip files whose path (relative to the "
+                        "directory) matches. Can be repeated.")
+    parser.add_argument('-p', '--processes', action='store', type=int,
+                        default=0,
+                        help='Number of worker processes to parse and rank '
+                        'blame output. Default=0 (done in-process).')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                        help='Number of git blame commands to run '
+                        'concurrently. Default=1.')
+    parser.add_argument('--timeout', action='store', type=float,
+                        help='Skip files where git blame takes longer than '
+                        'this many seconds.')
+    parser.add_argument('--since', action='store', metavar='DATE',
+                        help='Only look at history since DATE. Older lines '
+                        'are shown as from before the cutoff.')
+    parser.add_argument('--since-rev', action='store', metavar='REV',
+                        help='Only look at history after revision REV. Older '
+                        'lines are shown as from before the cutoff.')
+    parser.add_argument('--rev', action='store', metavar='REV',
+                        help='Report on the files in revision REV, without '
+                        'using the working tree (so bare repositories '
+                        'work).')
+    parser.add_argument('--all-files', action='store_true',
+                        help='Blame binary, generated, and vendored files, '
+                        'instead of skipping them.')
+    parser.add_argument('--max-size', action='store', type=int, default=0,
+                        help='Skip files larger than this many bytes. '
+                        'Default=0 (no limit).')
+    parser.add_argument('--window', action='store', type=int, default=0,
+                        metavar='LINES',
+                        help='Blame files with more lines than this in '
+                        'windows of this many lines, merging the results. '
+                        'Default=0 (whole files).')
+    parser.add_argument('--window-jobs', action='store', type=int, default=1,
+                        metavar='N',
+                        help='Number of windows of a file to blame at once. '
+                        'Default=1.')
+    parser.add_argument('--window-memory', action='store', type=int,
+                        default=256, metavar='MB',
+                        help='Cap on the blame output held at once, for the '
+                        'windows of a file. Windows are made smaller, or run '
+                        'fewer at once, to stay within it. Default=256.')
+    parser.add_argument('--sample', action='store', type=int, default=0,
+                        metavar='LINES',
+                        help='Estimate ownership by size from a random '
+                        'sample of about LINES lines of each file, blaming '
+                        'more where the top owners are too close to call. '
+                        'Default=0 (all lines).')
+    parser.add_argument('--sample-files', action='store', type=int,
+                        default=0, metavar='N',
+                        help='Only blame N files, picked at random, in each '
+                        'directory, when sorting by size. Default=0 (all).')
+    parser.add_argument('--slowest', action='store', type=int, default=0,
+                        help='Show the N slowest files at the end of the '
+                        'report. Default=0 (none).')
+    parser.add_argument('--shard', action='store', type=shard_spec,
+                        metavar='i/N',
+                        help='Only process the i-th of N shards of the files '
+                        '(i is from 1 to N).')
+    parser.add_argument('--results', action='store', metavar='FILE',
+                        help='Save the results in JSON to FILE, so that '
+                        'shards can be merged later.')
+    parser.add_argument('--symbols', action='store_true',
+                        help='Also show the owners of each top-level class '
+                        'and function, in Python files.')
+    parser.add_argument('--npz', action='store', metavar='FILE',
+                        help='Save the ownership of every blamed line, as '
+                        'NumPy arrays, to FILE (needs NumPy).')
+    parser.add_argument('--stdin', action='store_true',
+                        help='Read paths to report on (relative to the '
+                        'directory), with optional line ranges (e.g. '
+                        'a.py:10-20,31) or a symbol (e.g. '
+                        'a.py::Class.method), one per line from stdin.')
+    parser.add_argument('-z', dest='null', action='store_true',
+                        help='With --stdin, paths are separated by NUL '
+                        'characters, instead of newlines.')
+    parser.add_argument('--no-mailmap', action='store_true',
+                        help="Don't map authors with several identities "
+                        "to one, using the repository's .mailmap.")
+    parser.add_argument('--plan', action='store_true',
+                        help='Only show an estimate of the time blaming '
+                        'would take, and the most costly files and '
+                        'directories (see --slowest), without blaming.')
+    parser.add_argument('--progress', action='store_true',
+                        help='Show the progress of the run, and an estimate '
+                        'of the time remaining, on stderr.')
+    parser.add_argument('--stats', action='store', metavar='FILE',
+                        help='Save the time taken by each stage of the run, '
+                        'and counts of the work done, to FILE.')
+    parser.add_argument('--stats-format', action='store', default='json',
+                        choices=['json', 'openmetrics'],
+                        help="Format of the stats file. Default='json'.")
+    parser.add_argument('--profile', action='store', metavar='FILE',
+                        help='Save cProfile data for the run to FILE (the '
+                        'main thread only).')
+    parser.add_argument('--recurse-submodules', action='store_true',
+                        help='Also process the files in (checked out) '
+                        'submodules.')
+    parser.add_argument(dest='root', metavar='file-or-dir',
+                        help="A directory, a file, or a class or function "
+                        "in a Python file (e.g. 'a.py::Class.method').")
+    parser.add_argument(dest='other_roots', metavar='dir', nargs='*',
+                        help='Directories of other repositories, to include '
+                        'in the same report.')
+    return parser
+
+
+def setup_prepare_parser():
+    parser = argparse.ArgumentParser(
+        prog='whodunit prepare',
+        description='Write a commit-graph with changed-path Bloom filters, '
+        'which makes git blame faster, if it is missing or out of date.')
+    parser.add_argument('--check', action='store_true',
+                        help='Only check the commit-graph, exiting with 1 '
+                        'if it needs writing.')
+    parser.add_argument(dest='root', metavar='dir', nargs='?', default='.',
+                        help='Directory in the repository. Default=.')
+    return parser
+
+
+def setup_merge_parser():
+    parser = argparse.ArgumentParser(
+        prog='whodunit merge',
+        description='Combine saved results into one report.')
+    parser.add_argument('--slowest', action='store', type=int, default=0,
+                        help='Show the N slowest files at the end of the '
+                        'report. Default=0 (none).')
+    parser.add_argument(dest='results', metavar='results-file', nargs='+')
+    return parser
+
+
+def setup_timeline_parser():
+    parser = argparse.ArgumentParser(
+        prog='whodunit timeline',
+        description='Show the share of lines owned by each author, at each '
+        'revision (e.g. release tags), only blaming the files that changed.')
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        help='Only process files matching the glob.')
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help='Skip files matching the glob.')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                        help='Number of git blame commands to run at once. '
+                        'Default=1.')
+    parser.add_argument('--timeout', action='store', type=float,
+                        help='Skip files where git blame takes longer than '
+                        'this many seconds.')
+    parser.add_argument('--all-files', action='store_true',
+                        help='Blame binary, generated, and vendored files, '
+                        'instead of skipping them.')
+    parser.add_argument('--max-size', action='store', type=int, default=0,
+                        help='Skip files larger than this many bytes. '
+                        'Default=0 (no limit).')
+    parser.add_argument('--no-mailmap', action='store_true',
+                        help="Don't map authors with several identities "
+                        "to one, using the repository's .mailmap.")
+    parser.add_argument('--json', action='store', metavar='FILE',
+                        help='Save the lines owned by each author, for each '
+                        'file and directory at each revision, to FILE.')
+    parser.add_argument(dest='root', metavar='dir',
+                        help='Directory in the repository.')
+    parser.add_argument(dest='revisions', metavar='rev', nargs='+',
+                        help='Revisions, from oldest to newest.')
+    return parser
+
+
+def setup_codeowners_parser():
+    parser = argparse.ArgumentParser(
+        prog='whodunit codeowners',
+        description='Write a CODEOWNERS file, with the authors owning the '
+        'most lines in each directory. Results for each file are cached, '
+        'so that only changed files are blamed the next time.')
+    parser.add_argument('--rev', action='store', default='HEAD',
+                        help="Revision to find the owners at. Default=HEAD.")
+    parser.add_argument('--threshold', action='store', type=float,
+                        default=0.2,
+                        help='Smallest share of the lines in a directory, '
+                        'for an author to be an owner. Default=0.2.')
+    parser.add_argument('--max-owners', action='store', type=int, default=3,
+                        help='Most owners for a directory. Default=3.')
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        help='Only process files matching the glob.')
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help='Skip files matching the glob.')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                        help='Number of git blame commands to run at once. '
+                        'Default=1.')
+    parser.add_argument('--timeout', action='store', type=float,
+                        help='Skip files where git blame takes longer than '
+                        'this many seconds.')
+    parser.add_argument('--all-files', action='store_true',
+                        help='Blame binary, generated, and vendored files, '
+                        'instead of skipping them.')
+    parser.add_argument('--max-size', action='store', type=int, default=0,
+                        help='Skip files larger than this many bytes. '
+                        'Default=0 (no limit).')
+    parser.add_argument('--cache', action='store', metavar='FILE',
+                        help='File to keep the results for each file in. '
+                        'Default is whodunit-cache.json in the git '
+                        'directory.')
+    parser.add_argument('--no-mailmap', action='store_true',
+                        help="Don't map authors with several identities "
+                        "to one, using the repository's .mailmap.")
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Blame every file, without using a cache.')
+    parser.add_argument('-o', '--output', action='store', metavar='FILE',
+                        help='Write to FILE, instead of stdout.')
+    parser.add_argument(dest='root', metavar='dir', nargs='?', default='.',
+                        help='Directory in the repository. Default=.')
     return parser
+
+
+def setup_diff_parser():
+    parser = argparse.ArgumentParser(
+        prog='whodunit diff',
+        description='Show the files and directories with a new primary '
+        'owner, and the changes in the share of lines owned by each author, '
+        'between two revisions. Results for each file are cached, and '
+        'shared with the codeowners command, so only files without results '
+        'are blamed.')
+    parser.add_argument('--min-change', action='store', type=float,
+                        default=0.05,
+                        help='Smallest change in an author\'s share of the '
+                        'lines in a directory to show. Default=0.05.')
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        help='Only process files matching the glob.')
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help='Skip files matching the glob.')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                        help='Number of git blame commands to run at once. '
+                        'Default=1.')
+    parser.add_argument('--timeout', action='store', type=float,
+                        help='Skip files where git blame takes longer than '
+                        'this many seconds.')
+    parser.add_argument('--all-files', action='store_true',
+                        help='Blame binary, generated, and vendored files, '
+                        'instead of skipping them.')
+    parser.add_argument('--max-size', action='store', type=int, default=0,
+                        help='Skip files larger than this many bytes. '
+                        'Default=0 (no limit).')
+    parser.add_argument('--cache', action='store', metavar='FILE',
+                        help='File to keep the results for each file in. '
+                        'Default is whodunit-cache.json in the git '
+                        'directory.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Blame every file, without using a cache.')
+    parser.add_argument('--no-mailmap', action='store_true',
+                        help="Don't map authors with several identities "
+                        "to one, using the repository's .mailmap.")
+    parser.add_argument('--json', action='store', metavar='FILE',
+                        help='Save the owner and share changes, for each '
+                        'file and directory, to FILE.')
+    parser.add_argument(dest='root', metavar='dir',
+                        help='Directory in the repository.')
+    parser.add_argument(dest='old', metavar='old-rev',
+                        help='Earlier revision.')
+    parser.add_argument(dest='new', metavar='new-rev',
+                        help='Later revision.')
+    return parser
+
+
+# Sub-commands, which can be given instead of a file or directory
+commands = {'codeowners': codeowners, 'diff': diff, 'merge': merge,
+            'prepare': prepare, 'timeline': timeline}